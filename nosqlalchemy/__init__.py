@@ -1,2 +1,4 @@
 from __future__ import absolute_import
 from nosqlalchemy.nosql import *
+from nosqlalchemy.cache import *
+from nosqlalchemy.memory import *
@@ -0,0 +1,405 @@
+"""
+Aggregation pipelines over Collection classes.
+
+totals = session.query(Order).filter({Order.state: 'paid'}).aggregate() \
+    .group(Order.customer, total={'$sum': Order.amount}, orders={'$sum': 1}) \
+    .sort('total', DESCENDING).limit(10)
+for record in totals:
+    print(record._id, record.total, record.orders)
+
+The filter, sort, skip, limit and only() of the query become the first
+stages of the pipeline. Key class attributes may be used wherever the
+pipeline takes a field, in expressions they stand for '$name'.
+
+Results stream from the server as records, instances of a Record class
+with a slot for each field the pipeline produces. Fields missing from a
+result are None. Stages given as raw dicts with stage() make the shape of
+the results unknown, results are then plain dicts.
+"""
+from collections import OrderedDict
+
+import bson
+
+from nosqlalchemy.nosql import Key
+
+
+__all__ = [
+    'Aggregation',
+    'Record',
+    'record_type'
+]
+
+
+class Record(object):
+    """
+    A lightweight result. Fields are attributes, records also unpack and
+    compare like tuples of their values.
+    """
+    __slots__ = ()
+    _fields = ()
+    _nested = None
+
+    def __init__(self, *args, **kwargs):
+        values = dict(zip(self._fields, args))
+        values.update(kwargs)
+        for field in self._fields:
+            object.__setattr__(self, field, values.get(field))
+
+    @classmethod
+    def _make(cls, document):
+        record = cls.__new__(cls)
+        nested = cls._nested
+        for field in cls._fields:
+            value = document.get(field)
+            if nested is not None and field in nested and value is not None:
+                value = [nested[field]._make(item) for item in value]
+            object.__setattr__(record, field, value)
+        return record
+
+    def _asdict(self):
+        return OrderedDict((field, getattr(self, field))
+                           for field in self._fields)
+
+    def __iter__(self):
+        return iter([getattr(self, field) for field in self._fields])
+
+    def __getitem__(self, field):
+        if isinstance(field, int):
+            return getattr(self, self._fields[field])
+        if field not in self._fields:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return self._fields == other._fields and \
+                tuple(self) == tuple(other)
+        return tuple(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            '%s=%r' % (field, getattr(self, field))
+            for field in self._fields))
+
+    def __reduce__(self):
+        # record classes are made at runtime, pickles name the fields
+        return _unpickle_record, (type(self).__name__, self._fields,
+                                  tuple(self))
+
+
+_record_types = dict()
+
+
+def record_type(name, fields, nested=None):
+    """
+    The Record class with the given fields, created once per name and
+    fields. nested maps fields holding lists of results, such as facets,
+    to the Record class of their items.
+    """
+    key = (name, tuple(fields), tuple(sorted((nested or dict()).items())))
+    cls = _record_types.get(key)
+    if cls is None:
+        cls = _record_types[key] = type(str(name), (Record,), dict(
+            __slots__=tuple(fields), _fields=tuple(fields),
+            _nested=dict(nested) if nested else None))
+    return cls
+
+
+def _unpickle_record(name, fields, values):
+    return record_type(name, fields)(*values)
+
+
+def _expression(value):
+    """
+    An aggregation expression with Key class attributes replaced by field
+    paths.
+    """
+    if isinstance(value, Key):
+        return '$' + value.name
+    if isinstance(value, dict):
+        return dict((k, _expression(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_expression(v) for v in value]
+    return value
+
+
+def _field_name(field):
+    if isinstance(field, Key):
+        return field.name
+    return field[1:] if field.startswith('$') else field
+
+
+class Aggregation(object):
+    """
+    A chainable aggregation pipeline, made by Mquery.aggregate(). Each
+    method returns a new Aggregation, the pipeline runs when it is
+    iterated.
+    """
+    def __init__(self, query):
+        self.query = query
+        self.stages = list()
+        if query.loaded_fields is None:
+            self.fields = query.col.__schema__.names
+        else:
+            self.fields = query.loaded_names or tuple(
+                name for name in query.col.__schema__.names
+                if name in query.loaded_fields)
+        self.nested = dict()
+        self.allow_disk_use_flag = False
+        self.batch_size_count = query.batch_size_count
+
+    def _clone(self, stage=None, fields=_field_name, nested=None):
+        aggregation = Aggregation.__new__(type(self))
+        aggregation.__dict__.update(self.__dict__)
+        aggregation.stages = list(self.stages)
+        if stage is not None:
+            aggregation.stages.append(stage)
+        if fields is not _field_name:
+            aggregation.fields = None if fields is None else tuple(fields)
+            aggregation.nested = dict(nested or dict())
+        return aggregation
+
+    def _key_name(self, field):
+        if isinstance(field, Key):
+            return self.query._key_name(field)
+        return _field_name(field)
+
+    def _add_fields(self, *names):
+        if self.fields is None:
+            return None
+        return self.fields + tuple(n for n in names if n not in self.fields)
+
+    def pipeline(self):
+        """
+        The stages sent to the server, those of the query first.
+        """
+        query = self.query
+        stages = list()
+        if query.spec:
+            stages.append({'$match': query.spec})
+        if query.sort_keys:
+            stages.append({'$sort': OrderedDict(query.sort_keys)})
+        if query.skip_count:
+            stages.append({'$skip': query.skip_count})
+        if query.limit_count:
+            stages.append({'$limit': query.limit_count})
+        if query.projection:
+            stages.append({'$project': query.projection})
+        return stages + self.stages
+
+    @property
+    def record_cls(self):
+        """
+        The Record class of the results, None when their shape is unknown.
+        """
+        if self.fields is None:
+            return None
+        return record_type('%sRecord' % self.query.col.__name__,
+                           self.fields, self.nested)
+
+    def stage(self, stage):
+        """
+        Append a stage as it is. The shape of the results becomes unknown,
+        they are read as dicts.
+        """
+        return self._clone(stage, fields=None)
+
+    def match(self, spec=None, **kwargs):
+        conditions = dict(spec or {}, **kwargs)
+        conditions = dict((self._key_name(k), _expression(v))
+                          for k, v in conditions.items())
+        return self._clone({'$match': conditions})
+
+    def group(self, by=None, **accumulators):
+        """
+        Group by a key, a list of keys, which makes a compound _id, or an
+        expression, None puts every document in one group. accumulators
+        are the other fields of the results, such as
+        total={'$sum': Order.amount}.
+        """
+        if isinstance(by, (Key, str)):
+            by = '$' + self._key_name(by)
+        elif isinstance(by, (list, tuple)):
+            by = OrderedDict((self._key_name(k), '$' + self._key_name(k))
+                             for k in by)
+        else:
+            by = _expression(by)
+        spec = OrderedDict([('_id', by)])
+        for name, accumulator in accumulators.items():
+            spec[name] = _expression(accumulator)
+        return self._clone({'$group': spec},
+                           fields=['_id'] + list(accumulators))
+
+    def project(self, *fields, **expressions):
+        """
+        Keep fields, as keys or names, and compute expressions. _id is
+        kept unless _id=False is given.
+        """
+        spec = OrderedDict()
+        keep_id = expressions.pop('_id', True)
+        if not keep_id:
+            spec['_id'] = 0
+        for field in fields:
+            spec[self._key_name(field)] = 1
+        for name, expression in expressions.items():
+            spec[name] = _expression(expression)
+        names = [name for name in spec if name != '_id']
+        return self._clone({'$project': spec},
+                           fields=(['_id'] if keep_id else []) + names)
+
+    def sort(self, key_or_list, direction=1):
+        if not isinstance(key_or_list, list):
+            key_or_list = [(key_or_list, direction)]
+        return self._clone({'$sort': OrderedDict(
+            (self._key_name(k), d) for k, d in key_or_list)})
+
+    def skip(self, skip):
+        return self._clone({'$skip': skip})
+
+    def limit(self, limit):
+        return self._clone({'$limit': limit})
+
+    def lookup(self, collection, local_field, foreign_field, as_):
+        """
+        Join the documents of collection, a Collection class of the same
+        database or a collection name, whose foreign_field equals
+        local_field, as a list in the as_ field.
+        """
+        name = getattr(collection, '__collection_name__', collection)
+        return self._clone({'$lookup': OrderedDict([
+            ('from', name),
+            ('localField', self._key_name(local_field)),
+            ('foreignField', _field_name(foreign_field)),
+            ('as', as_)])}, fields=self._add_fields(as_),
+            nested=self.nested)
+
+    def unwind(self, field, preserve_empty=False, index_field=None):
+        """
+        One result per element of the array in field. With
+        preserve_empty, documents where it is missing, None or empty are
+        kept. index_field is set to the index of the element.
+        """
+        spec = OrderedDict([('path', '$' + self._key_name(field))])
+        if preserve_empty:
+            spec['preserveNullAndEmptyArrays'] = True
+        if index_field:
+            spec['includeArrayIndex'] = index_field
+        nested = dict(self.nested)
+        nested.pop(self._key_name(field), None)
+        return self._clone({'$unwind': spec},
+                           fields=self._add_fields(index_field)
+                           if index_field else self.fields, nested=nested)
+
+    def facet(self, **facets):
+        """
+        Run several pipelines over the same documents, each facet is a
+        list of stages or an Aggregation without filter, sort, skip or
+        limit, made with session.query(Cls).aggregate(). The result has a
+        field per facet, the list of its results, as records of the facet
+        Aggregation.
+        """
+        spec = OrderedDict()
+        nested = dict()
+        for name, facet in facets.items():
+            if isinstance(facet, Aggregation):
+                query = facet.query
+                if query.spec or query.sort_keys or query.skip_count or \
+                        query.limit_count or query.loaded_fields is not None:
+                    raise ValueError('the query of facet %s has a filter, '
+                                     'sort, skip, limit or only()' % name)
+                if facet.record_cls is not None:
+                    nested[name] = facet.record_cls
+                facet = facet.stages
+            spec[name] = list(facet)
+        return self._clone({'$facet': spec}, fields=list(facets),
+                           nested=nested)
+
+    def count(self, field='count'):
+        """
+        A single result holding the number of documents in field, no result
+        when there are none.
+        """
+        return self._clone({'$count': field}, fields=[field])
+
+    def allow_disk_use(self, allow=True):
+        """
+        Let stages which exceed the server memory limit, such as large
+        sorts and groups, write temporary files.
+        """
+        aggregation = self._clone()
+        aggregation.allow_disk_use_flag = allow
+        return aggregation
+
+    def batch_size(self, batch_size):
+        aggregation = self._clone()
+        aggregation.batch_size_count = batch_size
+        return aggregation
+
+    def _options(self):
+        options = dict()
+        if self.allow_disk_use_flag:
+            options['allowDiskUse'] = True
+        if self.batch_size_count:
+            options['batchSize'] = self.batch_size_count
+        return options
+
+    def cursor(self):
+        """
+        The pymongo command cursor of the pipeline, of RawBSONDocument
+        objects.
+        """
+        collection = self.query._read_collection(raw=True)
+        return collection.aggregate(self.pipeline(), **self._options())
+
+    def _converter(self):
+        record_cls = self.record_cls
+        codec_options = self.query.collection.codec_options
+        if record_cls is None:
+            return lambda raw: bson.decode(raw.raw, codec_options)
+        make = record_cls._make
+        return lambda raw: make(bson.decode(raw.raw, codec_options))
+
+    def __iter__(self):
+        if self.query._listeners():
+            return self._timed_iter()
+        return self._iter()
+
+    def _iter(self):
+        convert = self._converter()
+        for raw in self.cursor():
+            yield convert(raw)
+
+    def _timed_iter(self):
+        convert = self._converter()
+        query = self.query
+        with query.session._timer('aggregate', query.col,
+                                  query.spec) as timer:
+            for raw in self.cursor():
+                timer.driver()
+                record = convert(raw)
+                timer.hydration()
+                timer.count += 1
+                timer.bytes += len(raw.raw)
+                yield record
+                timer.restart()
+            timer.driver()
+
+    def all(self):
+        """
+        The results as a list.
+        """
+        return list(self)
+
+    def first(self):
+        for record in self.limit(1):
+            return record
+        return None
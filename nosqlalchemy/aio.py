@@ -0,0 +1,673 @@
+"""
+asyncio counterparts of MongoSession and Mquery.
+
+They use pymongo's AsyncMongoClient (pymongo 4.9+), or motor when it is
+installed and pymongo is older:
+
+client = AsyncMongoDBConnection()
+session = AsyncMongoSession(client)
+
+oid = await session.add(user)
+async for user in session.query(User).filter({User.email: email}):
+    ...
+
+AsyncMemoryDBConnection is the in-process counterpart, see
+nosqlalchemy.memory.
+
+Documents, queries and write semantics are shared with the blocking API,
+only the methods which talk to the server are coroutines. Collection
+methods which write through the instance, remove() and collection_update(),
+are session coroutines here and raise TypeError on the instance. The numpy
+and worker process reads of queries, to_columns(), to_numpy() and
+parallel_scan(), need a MongoSession.
+"""
+import asyncio
+import inspect
+from collections import OrderedDict
+
+from bson.raw_bson import RawBSONDocument
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError
+
+try:
+    from pymongo import AsyncMongoClient
+except ImportError:
+    from motor.motor_asyncio import AsyncIOMotorClient as AsyncMongoClient
+
+from nosqlalchemy.aggregation import Aggregation
+from nosqlalchemy.changestreams import AsyncChangeStream
+from nosqlalchemy.memory import MemoryClient
+from nosqlalchemy.nosql import (
+    BulkResult,
+    BulkWriteException,
+    MongoDBConnection,
+    MongoSession,
+    Mquery,
+    _find_one_spec,
+)
+
+
+__all__ = [
+    'AsyncMongoDBConnection',
+    'AsyncMongoSession',
+    'AsyncMquery',
+    'AsyncAggregation',
+    'AsyncMemoryDBConnection'
+]
+
+
+class AsyncMongoDBConnection(MongoDBConnection):
+    """
+    asyncio driver bindings interface.
+
+    Clients are bound to the event loop they run in, they are not shared.
+    """
+    client_cls = AsyncMongoClient
+    shared = False
+
+
+class AsyncMongoSession(MongoSession):
+    """
+    MongoSession with awaitable writes.
+
+    Sessions hold no state between awaits other than the unit_of_work queue,
+    so bulk writes may run concurrently with asyncio.gather(). With
+    ordered=False the batches of one bulk write are also sent concurrently,
+    up to concurrency batches at a time.
+
+    Documents of the session are removed and updated with await
+    session.remove(document) and session.collection_update(document, ...),
+    their own remove() and collection_update() raise TypeError.
+    """
+    asynchronous = True
+
+    def __init__(self, client=None, unit_of_work=False, batch_size=1000,
+                 ordered=True, identity_map=False, cache=None,
+                 concurrency=4, plan_check=None, listeners=None):
+        super(AsyncMongoSession, self).__init__(
+            client, unit_of_work, batch_size, ordered, identity_map, cache,
+            plan_check, listeners)
+        self.concurrency = concurrency
+
+    def query(self, collection_cls=None):
+        return AsyncMquery(self.connection, collection_cls, self)
+
+    def watch(self, collection_cls, filter=None, operations=None,
+              pipeline=None, full_document=None, resume_after=None,
+              start_after=None, start_at_operation_time=None,
+              batch_size=None, max_await_time_ms=None, apply=None):
+        """
+        An AsyncChangeStream, see MongoSession.watch().
+        """
+        return AsyncChangeStream(self, collection_cls, filter, operations,
+                                 pipeline, full_document, resume_after,
+                                 start_after, start_at_operation_time,
+                                 batch_size, max_await_time_ms, apply)
+
+    async def _write(self, pending_write):
+        if pending_write is None:
+            return None
+        if self.unit_of_work:
+            self.pending.append(pending_write)
+            self._track(pending_write)
+            return None
+        collection = self._get_collection_from_object(
+            pending_write.collection_cls)
+        try:
+            result = await getattr(collection, pending_write.method)(
+                *pending_write.args)
+        except Exception:
+            self._restore_snapshot(pending_write)
+            raise
+        self._track(pending_write)
+        return result
+
+    async def _write_one(self, operation, prepare, *args):
+        if not self.listeners:
+            return await self._write(prepare(*args))
+        with self._timer(operation) as timer:
+            self._write_timer_start(timer, args)
+            pending_write = prepare(*args)
+            self._write_timer_prepared(timer, pending_write)
+            result = await self._write(pending_write)
+            timer.driver()
+            return result
+
+    async def add(self, collection_obj):
+        await self._write_one('add', self._add_write, collection_obj)
+        return collection_obj._id
+
+    async def save(self, collection_obj):
+        await self._write_one('save', self._save_write, collection_obj)
+        return collection_obj._id
+
+    async def remove(self, collection_obj):
+        await self._write_one('remove', self._remove_write, collection_obj)
+
+    async def collection_update(self, collection_obj, update_data,
+                                fetch=True):
+        """
+        Collection.collection_update() of a document of this session.
+        """
+        spec, update_data = collection_obj._prepare_update(update_data)
+        collection = self._get_collection_from_object(type(collection_obj))
+        if not fetch:
+            await collection.update_one(spec, {'$set': update_data})
+            collection_obj._patch_update(update_data)
+            return
+        collection_obj._patch_fetched(await collection.find_one_and_update(
+            spec, {'$set': update_data},
+            collection_obj._fetched_fields(update_data),
+            return_document=ReturnDocument.AFTER))
+
+    async def add_all(self, collection_objs):
+        return await self._write_all(
+            (self._add_write(obj) for obj in collection_objs), 'add_all')
+
+    async def save_all(self, collection_objs):
+        return await self._write_all(
+            (self._save_write(obj) for obj in collection_objs), 'save_all')
+
+    async def remove_all(self, collection_objs):
+        return await self._write_all(
+            (self._remove_write(obj) for obj in collection_objs),
+            'remove_all')
+
+    async def _write_all(self, pending_writes, operation='bulk_write'):
+        pending_writes = (pw for pw in pending_writes if pw is not None)
+        if self.unit_of_work:
+            self.pending.extend(pending_writes)
+            return None
+        return await self._bulk_write(pending_writes, operation=operation)
+
+    async def flush(self, ordered=None):
+        """
+        Send the writes queued by unit_of_work mode, returns a BulkResult.
+        """
+        pending, self.pending = self.pending, list()
+        return await self._bulk_write(pending, ordered, 'flush')
+
+    async def _bulk_write(self, pending_writes, ordered=None,
+                          operation='bulk_write'):
+        """
+        MongoSession._bulk_write, unordered batches are written
+        concurrently. Their events only count the time of their own
+        bulk_write, as driver time.
+        """
+        if ordered is None:
+            ordered = self.ordered
+        timer = self._timer(operation) if self.listeners else None
+        result = BulkResult()
+        batches = OrderedDict()
+        in_flight = list()
+        pending_writes = iter(pending_writes)
+        for pending_write in pending_writes:
+            batch = batches.setdefault(pending_write.collection_cls, list())
+            batch.append(pending_write)
+            if len(batch) < self.batch_size:
+                continue
+            del batches[pending_write.collection_cls]
+            if not ordered:
+                in_flight.append(self._write_batch(batch, ordered, result,
+                                                   timer))
+                if len(in_flight) >= self.concurrency:
+                    await asyncio.gather(*in_flight)
+                    in_flight = list()
+            elif not await self._write_batch(batch, ordered, result, timer):
+                for pw in pending_writes:
+                    result.unprocessed.append(pw.document)
+                    self._restore_snapshot(pw)
+                break
+        else:
+            for collection_cls, batch in list(batches.items()):
+                del batches[collection_cls]
+                if not ordered:
+                    in_flight.append(self._write_batch(batch, ordered, result,
+                                                       timer))
+                elif not await self._write_batch(batch, ordered, result,
+                                                 timer):
+                    break
+        if in_flight:
+            await asyncio.gather(*in_flight)
+        for batch in batches.values():
+            result.unprocessed.extend(pw.document for pw in batch)
+            for pw in batch:
+                self._restore_snapshot(pw)
+        if result.errors:
+            raise BulkWriteException(result)
+        return result
+
+    async def _write_batch(self, batch, ordered, result, timer=None):
+        collection = self._get_collection_from_object(batch[0].collection_cls)
+        requests = self._batch_requests(batch)
+        if timer is not None and not ordered:
+            timer = self._timer(timer.operation)
+        elif timer is not None:
+            timer.hydration()
+        try:
+            bulk_result = await collection.bulk_write(requests,
+                                                      ordered=ordered)
+        except BulkWriteError as e:
+            self._batch_event(timer, batch, e)
+            return self._batch_errors(batch, ordered, result, e.details)
+        except Exception as e:
+            self._batch_event(timer, batch, e)
+            for pw in batch:
+                self._restore_snapshot(pw)
+            raise
+        self._batch_event(timer, batch)
+        result._add_bulk_result(bulk_result)
+        return True
+
+    async def drop_all(self, collection_cls):
+        collection = self._get_collection_from_object(collection_cls)
+        if self.listeners:
+            with self._timer('drop_all', collection_cls, {}) as timer:
+                await collection.delete_many({})
+                timer.driver()
+        else:
+            await collection.delete_many({})
+        self._invalidate_collection(collection_cls)
+
+    async def ensure_indexes(self, collection_cls):
+        models = self._index_models(collection_cls)
+        if not models:
+            return list()
+        collection = self._get_collection_from_object(collection_cls)
+        return await collection.create_indexes(models)
+
+    async def update(self, collection_cls, update_spec, update_data,
+                     multi=False):
+        result = await self._write_one('update', self._mass_update_write,
+                                       collection_cls, update_spec,
+                                       update_data, multi)
+        if result is not None:
+            return result.raw_result
+
+
+class AsyncMquery(Mquery):
+    """
+    Mquery over an asyncio driver. Queries are built the same way, results
+    are read with async for, or awaited from find_one() and count().
+
+    While one batch of results is hydrated the next one is already being
+    fetched.
+    """
+    prefetch_size = 100
+
+    async def explain(self):
+        return await self._cursor().explain()
+
+    def _verify_plan(self):
+        # explain() is a coroutine, _averify_plan() checks the plan before
+        # the cursor is made
+        pass
+
+    async def _averify_plan(self):
+        shape = self._plan_shape()
+        if shape is not None:
+            self._report_plan(shape, await self.explain())
+
+    async def _batches(self):
+        await self._averify_plan()
+        cursor = self.cursor(raw=True)
+        size = self.batch_size_count or self.prefetch_size
+        fetch = asyncio.ensure_future(cursor.to_list(size))
+        try:
+            while True:
+                batch = await fetch
+                if not batch:
+                    return
+                fetch = asyncio.ensure_future(cursor.to_list(size))
+                # let the fetch send its request before hydrating
+                await asyncio.sleep(0)
+                yield batch
+        finally:
+            if not fetch.done():
+                fetch.cancel()
+            await cursor.close()
+
+    def __aiter__(self):
+        if self._listeners():
+            return self._timed_aiter()
+        return self._aiter()
+
+    async def _aiter(self):
+        async for batch in self._batches():
+            for item in batch:
+                yield self._load(item)
+
+    async def _timed_aiter(self):
+        load = self._load
+        with self.session._timer('find', self.col, self.spec) as timer:
+            async for batch in self._batches():
+                timer.driver()
+                for item in batch:
+                    timer.restart()
+                    instance = load(item)
+                    timer.hydration()
+                    timer.count += 1
+                    timer.bytes += len(item.raw)
+                    yield instance
+                timer.restart()
+            timer.driver()
+
+    def __iter__(self):
+        raise TypeError('AsyncMquery results are read with async for')
+
+    def _blocking_only(self, name):
+        raise TypeError('AsyncMquery has no %s(), use the query of a '
+                        'MongoSession' % name)
+
+    def parallel_scan(self, fn, workers=None, reduce=None, ranges=None,
+                      start_method=None):
+        self._blocking_only('parallel_scan')
+
+    def to_columns(self, fields, batch_size=10000, dtypes=None):
+        self._blocking_only('to_columns')
+
+    def to_numpy(self, fields, batch_size=10000, dtypes=None):
+        self._blocking_only('to_numpy')
+
+    def all(self):
+        """
+        async generator of baked Collection objects.
+        """
+        return self.__aiter__()
+
+    async def to_list(self):
+        return [inst async for inst in self]
+
+    async def pages(self, page_size, direction=ASCENDING):
+        """
+        async generator of lists of up to page_size Collection objects, see
+        Mquery.pages().
+        """
+        if [k for k, d in self.sort_keys if k != '_id']:
+            raise ValueError('pages() can only order by _id')
+        first = self.sort('_id', direction).limit(page_size)
+        query = first
+        while True:
+            page = await query.to_list()
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            query = first.skip(0).after(page[-1]['_id'], direction)
+
+    async def _find_one_raw(self, kw):
+        cache_key = self._cache_key(kw)
+        if cache_key is not None:
+            raw = self.session.cache.get(cache_key)
+            if raw is not None:
+                return RawBSONDocument(raw)
+        query = self.filter(kw).limit(1)
+        await query._averify_plan()
+        cursor = query.cursor(raw=True)
+        for data in await cursor.to_list(1):
+            if cache_key is not None:
+                self.session.cache.put(cache_key, data.raw)
+            return data
+        return None
+
+    async def find_one(self, kw):
+        kw = _find_one_spec(kw)
+        if not self._listeners():
+            data = await self._find_one_raw(kw)
+            return None if data is None else self._load(data)
+        with self.session._timer('find_one', self.col,
+                                 self.filter(kw).spec) as timer:
+            data = await self._find_one_raw(kw)
+            timer.driver()
+            if data is None:
+                return None
+            timer.count = 1
+            timer.bytes = len(data.raw)
+            instance = self._load(data)
+            timer.hydration()
+            return instance
+
+    def find(self, kw):
+        return self.filter(kw).__aiter__()
+
+    async def remove(self, kw=None):
+        spec = self._remove_spec(kw)
+        if self._listeners():
+            with self.session._timer('delete_many', self.col, spec) as timer:
+                result = await self.collection.delete_many(spec)
+                timer.driver()
+                timer.count = result.deleted_count
+            result = result.raw_result
+        else:
+            result = (await self.collection.delete_many(spec)).raw_result
+        if self.session is not None:
+            self.session._invalidate_collection(self.col)
+        return result
+
+    async def count(self, kw=None):
+        spec = self.filter(kw).spec if kw else self.spec
+        if self._listeners():
+            with self.session._timer('count', self.col, spec) as timer:
+                count = await self._count(spec)
+                timer.driver()
+            return count
+        return await self._count(spec)
+
+    async def _count(self, spec):
+        collection = self._read_collection()
+        if not spec:
+            return await collection.estimated_document_count()
+        return await collection.count_documents(spec)
+
+    async def update(self, set=None, unset=None, inc=None, push=None,
+                     add_to_set=None, pull=None, min=None, max=None,
+                     current_date=None, upsert=False):
+        """
+        See Mquery.update().
+        """
+        arguments = dict(set=set, unset=unset, inc=inc, push=push,
+                         add_to_set=add_to_set, pull=pull, min=min, max=max,
+                         current_date=current_date)
+        return await self.session._write_one(
+            'update', *self._update_args(arguments, upsert))
+
+    def aggregate(self):
+        """
+        An aggregation pipeline read with async for, see Mquery.aggregate().
+        """
+        return AsyncAggregation(self)
+
+
+class AsyncAggregation(Aggregation):
+    """
+    Aggregation over an asyncio driver, results are read with async for or
+    awaited from to_list() and first().
+    """
+    async def cursor(self):
+        collection = self.query._read_collection(raw=True)
+        cursor = collection.aggregate(self.pipeline(), **self._options())
+        if inspect.isawaitable(cursor):
+            # pymongo's AsyncCollection.aggregate() is a coroutine, motor's
+            # returns the cursor
+            cursor = await cursor
+        return cursor
+
+    def __aiter__(self):
+        if self.query._listeners():
+            return self._timed_aiter()
+        return self._aiter()
+
+    async def _aiter(self):
+        convert = self._converter()
+        cursor = await self.cursor()
+        try:
+            async for raw in cursor:
+                yield convert(raw)
+        finally:
+            await cursor.close()
+
+    async def _timed_aiter(self):
+        convert = self._converter()
+        query = self.query
+        with query.session._timer('aggregate', query.col,
+                                  query.spec) as timer:
+            cursor = await self.cursor()
+            try:
+                async for raw in cursor:
+                    timer.driver()
+                    record = convert(raw)
+                    timer.hydration()
+                    timer.count += 1
+                    timer.bytes += len(raw.raw)
+                    yield record
+                    timer.restart()
+            finally:
+                await cursor.close()
+            timer.driver()
+
+    def __iter__(self):
+        raise TypeError('AsyncAggregation results are read with async for')
+
+    def all(self):
+        return self.__aiter__()
+
+    async def to_list(self):
+        return [record async for record in self]
+
+    async def first(self):
+        async for record in self.limit(1):
+            return record
+        return None
+
+
+def _awaitable(name):
+    async def method(self, *args, **kwargs):
+        return getattr(self._delegate, name)(*args, **kwargs)
+    method.__name__ = name
+    return method
+
+
+class AsyncMemoryCursor(object):
+    """
+    MemoryCursor with the asyncio cursor interface.
+    """
+    def __init__(self, cursor):
+        self._delegate = cursor
+
+    def _chain(name):
+        def method(self, *args, **kwargs):
+            getattr(self._delegate, name)(*args, **kwargs)
+            return self
+        method.__name__ = name
+        return method
+
+    sort = _chain('sort')
+    skip = _chain('skip')
+    limit = _chain('limit')
+    batch_size = _chain('batch_size')
+    hint = _chain('hint')
+    del _chain
+
+    close = _awaitable('close')
+    explain = _awaitable('explain')
+
+    async def to_list(self, length=None):
+        documents = list()
+        for document in self._delegate:
+            documents.append(document)
+            if length is not None and len(documents) >= length:
+                break
+        return documents
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._delegate)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class AsyncMemoryCollection(object):
+    """
+    MemoryCollection with awaitable methods.
+    """
+    def __init__(self, collection):
+        self._delegate = collection
+        self.name = collection.name
+        self.full_name = collection.full_name
+        self.codec_options = collection.codec_options
+
+    def find(self, *args, **kwargs):
+        return AsyncMemoryCursor(self._delegate.find(*args, **kwargs))
+
+    async def aggregate(self, *args, **kwargs):
+        return AsyncMemoryCursor(self._delegate.aggregate(*args, **kwargs))
+
+    def with_options(self, *args, **kwargs):
+        return AsyncMemoryCollection(
+            self._delegate.with_options(*args, **kwargs))
+
+    find_one = _awaitable('find_one')
+    count_documents = _awaitable('count_documents')
+    estimated_document_count = _awaitable('estimated_document_count')
+    insert_one = _awaitable('insert_one')
+    insert_many = _awaitable('insert_many')
+    replace_one = _awaitable('replace_one')
+    update_one = _awaitable('update_one')
+    update_many = _awaitable('update_many')
+    find_one_and_update = _awaitable('find_one_and_update')
+    delete_one = _awaitable('delete_one')
+    delete_many = _awaitable('delete_many')
+    bulk_write = _awaitable('bulk_write')
+    create_indexes = _awaitable('create_indexes')
+    create_index = _awaitable('create_index')
+    index_information = _awaitable('index_information')
+    drop_index = _awaitable('drop_index')
+    drop_indexes = _awaitable('drop_indexes')
+    drop = _awaitable('drop')
+    watch = _awaitable('watch')
+
+
+class AsyncMemoryDatabase(object):
+    def __init__(self, database):
+        self._delegate = database
+        self.name = database.name
+
+    def __getitem__(self, name):
+        return AsyncMemoryCollection(self._delegate[name])
+
+    def get_collection(self, name, *args, **kwargs):
+        return AsyncMemoryCollection(
+            self._delegate.get_collection(name, *args, **kwargs))
+
+    list_collection_names = _awaitable('list_collection_names')
+    drop_collection = _awaitable('drop_collection')
+
+
+class AsyncMemoryClient(object):
+    """
+    MemoryClient with the asyncio client interface.
+    """
+    def __init__(self, *args, **kwargs):
+        self._delegate = MemoryClient(*args, **kwargs)
+
+    def __getitem__(self, name):
+        return AsyncMemoryDatabase(self._delegate[name])
+
+    def get_database(self, name, **kwargs):
+        return self[name]
+
+    list_database_names = _awaitable('list_database_names')
+    drop_database = _awaitable('drop_database')
+    close = _awaitable('close')
+
+
+class AsyncMemoryDBConnection(MongoDBConnection):
+    """
+    AsyncMongoDBConnection over an in-process AsyncMemoryClient.
+    """
+    client_cls = AsyncMemoryClient
+    shared = False
+    reconnect_after_fork = False
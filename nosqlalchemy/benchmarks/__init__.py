@@ -0,0 +1,229 @@
+"""
+Benchmarks of the ORM layer.
+
+python -m nosqlalchemy.benchmarks [--backend memory|mongodb] [-o out.json]
+
+Each scenario times a number of calls of one operation and reports ops/sec,
+p50/p99 latency per call and the peak memory allocated during a call,
+measured with tracemalloc in a separate pass so it does not slow down the
+timed one. Scenarios which count round trips also report the driver calls
+and the time spent in the driver per call. Results are written as JSON
+with the environment they were measured in, --compare prints the change
+from an earlier run. Use the in-process backend to measure the ORM alone,
+and a local mongod for end to end numbers.
+"""
+import gc
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import pymongo
+
+from nosqlalchemy.memory import MemoryDBConnection
+from nosqlalchemy.nosql import MongoDBConnection, MongoSession
+
+
+__all__ = [
+    'Case',
+    'BenchmarkContext',
+    'SCENARIOS',
+    'scenario',
+    'run',
+    'compare'
+]
+
+
+SCENARIOS = OrderedDict()
+
+
+def scenario(name):
+    """
+    Register a scenario, a function of a BenchmarkContext returning a Case.
+    """
+    def register(fn):
+        SCENARIOS[name] = fn
+        return fn
+    return register
+
+
+class Case(object):
+    """
+    What a scenario times: op() is called calls times, each call processes
+    units documents. stats, an OperationStats listening to the session op()
+    uses, counts the driver calls of the timed calls.
+    """
+    def __init__(self, op, units=1, calls=None, stats=None):
+        self.op = op
+        self.units = units
+        self.calls = calls
+        self.stats = stats
+
+
+class BenchmarkContext(object):
+    """
+    The session scenarios run against, and the sizes they use.
+    """
+    def __init__(self, backend='memory', uri='127.0.0.1:27017', size=10000,
+                 calls=1000, batch_size=1000):
+        self.backend = backend
+        if backend == 'mongodb':
+            self.client = MongoDBConnection(uri)
+        else:
+            self.client = MemoryDBConnection()
+        self.session = MongoSession(self.client, batch_size=batch_size)
+        self.size = size
+        self.calls = calls
+        self.batch_size = batch_size
+        self.used = list()
+
+    def reset(self, collection_cls):
+        if collection_cls not in self.used:
+            self.used.append(collection_cls)
+        self.session.drop_all(collection_cls)
+
+    def cleanup(self):
+        """
+        Empty the collections used by the scenarios.
+        """
+        for collection_cls in self.used:
+            self.session.drop_all(collection_cls)
+
+    def populate(self, collection_cls, make_data, count):
+        """
+        Replace the contents of a collection with count documents, returns
+        their _ids.
+        """
+        self.reset(collection_cls)
+        docs = [collection_cls(**make_data(i)) for i in range(count)]
+        self.session.add_all(docs)
+        return [doc._id for doc in docs]
+
+
+def _percentile(sorted_values, fraction):
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def measure(case, calls):
+    """
+    Time calls of case.op, then measure the peak memory of one call.
+    """
+    op = case.op
+    for _ in range(max(1, calls // 10)):
+        op()
+    timings = list()
+    if case.stats is not None:
+        case.stats.reset()
+    gc.collect()
+    started = time.perf_counter()
+    for _ in range(calls):
+        t = time.perf_counter()
+        op()
+        timings.append(time.perf_counter() - t)
+    total = time.perf_counter() - started
+    timings.sort()
+    driver = None
+    if case.stats is not None:
+        driver = case.stats.snapshot().values()
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        op()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    result = OrderedDict([
+        ('calls', calls),
+        ('units_per_call', case.units),
+        ('ops_per_sec', calls * case.units / total),
+        ('mean_us', total / calls * 1e6),
+        ('p50_us', _percentile(timings, 0.5) * 1e6),
+        ('p99_us', _percentile(timings, 0.99) * 1e6),
+        ('peak_memory_bytes', peak),
+    ])
+    if driver is not None:
+        result['driver_calls_per_call'] = \
+            sum(stats['count'] for stats in driver) / float(calls)
+        result['driver_us_per_call'] = \
+            sum(stats['driver_ms'] for stats in driver) / calls * 1e3
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment(context):
+    return OrderedDict([
+        ('commit', _git_commit()),
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('python', platform.python_version()),
+        ('implementation', platform.python_implementation()),
+        ('platform', platform.platform()),
+        ('pymongo', pymongo.version),
+        ('backend', context.backend),
+        ('size', context.size),
+        ('calls', context.calls),
+        ('batch_size', context.batch_size),
+    ])
+
+
+def run(context, names=None, report=None):
+    """
+    Run the named scenarios, all of them by default, returns the results
+    as a dictionary ready to be dumped as JSON.
+    """
+    from nosqlalchemy.benchmarks import scenarios  # noqa, registers them
+
+    results = OrderedDict()
+    try:
+        for name in names or list(SCENARIOS):
+            case = SCENARIOS[name](context)
+            results[name] = measure(case, case.calls or context.calls)
+            if report is not None:
+                report(name, results[name])
+    finally:
+        context.cleanup()
+    return OrderedDict([('environment', environment(context)),
+                        ('results', results)])
+
+
+def format_result(name, result):
+    line = '%-24s %12.0f ops/s  p50 %10.1f us  p99 %10.1f us  %10d B' % (
+        name, result['ops_per_sec'], result['p50_us'], result['p99_us'],
+        result['peak_memory_bytes'])
+    if 'driver_calls_per_call' in result:
+        line += '  %.1f driver calls' % result['driver_calls_per_call']
+    return line
+
+
+def compare(baseline, current):
+    """
+    Lines comparing the ops/sec of two runs, as loaded from their JSON.
+    """
+    lines = list()
+    for name, result in current['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            lines.append('%-24s %12s' % (name, 'new'))
+            continue
+        lines.append('%-24s %12.0f -> %12.0f ops/s  x%.2f' % (
+            name, before['ops_per_sec'], result['ops_per_sec'],
+            result['ops_per_sec'] / before['ops_per_sec']))
+    return lines
+
+
+def dump(results, fp):
+    json.dump(results, fp, indent=2)
+    fp.write('\n')
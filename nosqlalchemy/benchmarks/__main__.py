@@ -0,0 +1,62 @@
+import argparse
+import json
+import sys
+
+from nosqlalchemy.benchmarks import (
+    SCENARIOS,
+    BenchmarkContext,
+    compare,
+    dump,
+    format_result,
+    run,
+)
+from nosqlalchemy.benchmarks import scenarios  # noqa, registers them
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m nosqlalchemy.benchmarks',
+        description='Benchmark the nosqlalchemy ORM layer.')
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help='scenarios to run, all by default: %s' %
+                        ', '.join(SCENARIOS))
+    parser.add_argument('-b', '--backend', choices=['memory', 'mongodb'],
+                        default='memory')
+    parser.add_argument('--uri', default='127.0.0.1:27017',
+                        help='mongod to use with --backend mongodb')
+    parser.add_argument('-n', '--size', type=int, default=10000,
+                        help='documents in query scenarios')
+    parser.add_argument('-c', '--calls', type=int, default=1000,
+                        help='timed calls per single document scenario')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('-o', '--output',
+                        help='write the JSON results to this file instead '
+                             'of stdout')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='results of an earlier run to compare with')
+    args = parser.parse_args(argv)
+
+    unknown = set(args.scenarios).difference(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: %s' % ', '.join(sorted(unknown)))
+
+    context = BenchmarkContext(args.backend, args.uri, args.size, args.calls,
+                               args.batch_size)
+
+    def report(name, result):
+        sys.stderr.write(format_result(name, result) + '\n')
+
+    results = run(context, args.scenarios, report)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            dump(results, fp)
+    else:
+        dump(results, sys.stdout)
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        sys.stderr.write('\n'.join(compare(baseline, results)) + '\n')
+
+
+if __name__ == '__main__':
+    main()
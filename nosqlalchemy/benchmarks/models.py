@@ -0,0 +1,133 @@
+"""
+Benchmark documents, modelled on the TempCollection test document.
+
+FlatDocument only holds scalar keys, NestedDocument has sub collections,
+lists of sub collections, lazy collections and a sub collection nested
+two levels deep. LargeListDocument and CompactListDocument hold one long
+list of items, as SubCollection and as CompactSubCollection elements.
+"""
+from bson.objectid import ObjectId
+
+from nosqlalchemy.nosql import (
+    Collection,
+    CompactSubCollection,
+    Key,
+    LazyCollection,
+    ListCollection,
+    SubCollection,
+)
+
+
+DATABASE = 'nosqlalchemy_benchmarks'
+
+
+class FlatDocument(Collection):
+    __collection_name__ = 'flat'
+    __database__ = DATABASE
+
+    name = Key()
+    email = Key()
+    age = Key()
+    score = Key()
+    active = Key()
+    counter = Key()
+    tag_1 = Key()
+    tag_2 = Key()
+
+
+class ItemSubCollection(SubCollection):
+    sku = Key()
+    quantity = Key()
+    price = Key()
+
+
+class ItemList(ListCollection):
+    __list_element_type__ = ItemSubCollection
+
+
+class CompactItem(CompactSubCollection):
+    sku = Key()
+    quantity = Key()
+    price = Key()
+
+
+class CompactItemList(ListCollection):
+    __list_element_type__ = CompactItem
+
+
+class IntList(ListCollection):
+    __list_element_type__ = int
+
+
+class GeoSubCollection(SubCollection):
+    lat = Key()
+    lng = Key()
+
+
+class AddressSubCollection(SubCollection):
+    street = Key()
+    city = Key()
+    geo = GeoSubCollection()
+
+
+class ProfileSubCollection(SubCollection):
+    bio = Key()
+    address = AddressSubCollection()
+    settings = LazyCollection()
+
+
+class NestedDocument(Collection):
+    __collection_name__ = 'nested'
+    __database__ = DATABASE
+
+    name = Key()
+    counter = Key()
+    profile = ProfileSubCollection()
+    scores = IntList()
+    items = ItemList()
+    extra = LazyCollection()
+
+
+class LargeListDocument(Collection):
+    __collection_name__ = 'large_list'
+    __database__ = DATABASE
+
+    name = Key()
+    items = ItemList()
+
+
+class CompactListDocument(Collection):
+    __collection_name__ = 'compact_list'
+    __database__ = DATABASE
+
+    name = Key()
+    items = CompactItemList()
+
+
+def flat_data(i):
+    return dict(_id=ObjectId(), time_created=float(i), time_updated=float(i),
+                name='name %d' % i, email='user%d@example.com' % i, age=i % 90,
+                score=i * 0.5, active=bool(i % 2), counter=i,
+                tag_1='tag %d' % (i % 7), tag_2='tag %d' % (i % 11))
+
+
+def nested_data(i, items=10):
+    return dict(
+        _id=ObjectId(), time_created=float(i), time_updated=float(i),
+        name='name %d' % i, counter=i,
+        profile=dict(bio='bio %d' % i,
+                     address=dict(street='%d main st' % i, city='city',
+                                  geo=dict(lat=i * 0.1, lng=i * -0.1)),
+                     settings=dict(theme='dark', flags=[1, 2, 3])),
+        scores=list(range(i % 5, i % 5 + 10)),
+        items=[dict(sku='sku-%d' % j, quantity=j, price=j * 1.5)
+               for j in range(items)],
+        extra=dict(source='benchmark', seen=[i, i + 1]))
+
+
+def large_list_data(i, items=10000):
+    return dict(
+        _id=ObjectId(), time_created=float(i), time_updated=float(i),
+        name='name %d' % i,
+        items=[dict(sku='sku-%d' % j, quantity=j, price=j * 1.5)
+               for j in range(items)])
@@ -0,0 +1,251 @@
+"""
+The benchmark scenarios, registered in SCENARIOS in the order they run.
+"""
+import bson
+
+from nosqlalchemy.benchmarks import Case, scenario
+from nosqlalchemy.events import OperationStats
+from nosqlalchemy.benchmarks.models import (
+    CompactListDocument,
+    FlatDocument,
+    LargeListDocument,
+    NestedDocument,
+    flat_data,
+    large_list_data,
+    nested_data,
+)
+from nosqlalchemy.nosql import MongoSession
+
+try:
+    from nosqlalchemy.columns import concatenate_columns, iter_columns
+except ImportError:
+    # numpy is not installed
+    iter_columns = None
+
+
+@scenario('build_flat')
+def build_flat(context):
+    """
+    Hydrate a flat document from query results.
+    """
+    data = flat_data(1)
+    return Case(lambda: FlatDocument._load(None, data))
+
+
+@scenario('build_nested')
+def build_nested(context):
+    data = nested_data(1)
+    return Case(lambda: NestedDocument._load(None, data))
+
+
+@scenario('build_nested_lazy')
+def build_nested_lazy(context):
+    data = nested_data(1)
+    return Case(lambda: NestedDocument._load(None, data, lazy=True))
+
+
+@scenario('build_large_list')
+def build_large_list(context):
+    """
+    Hydrate a document holding a list of size SubCollection elements, the
+    peak memory is about the size of the document.
+    """
+    data = large_list_data(1, context.size)
+    raw = bson.encode(data)
+    return Case(lambda: LargeListDocument._load(None, data, raw=raw),
+                units=context.size, calls=max(3, context.calls // 100))
+
+
+@scenario('build_large_list_compact')
+def build_large_list_compact(context):
+    """
+    build_large_list with CompactSubCollection elements.
+    """
+    data = large_list_data(1, context.size)
+    raw = bson.encode(data)
+    return Case(lambda: CompactListDocument._load(None, data, raw=raw),
+                units=context.size, calls=max(3, context.calls // 100))
+
+
+@scenario('to_dict_flat')
+def to_dict_flat(context):
+    """
+    Convert a document back to plain dicts, the way the driver does when
+    it is written.
+    """
+    doc = FlatDocument(**flat_data(1))
+    return Case(lambda: bson.decode(bson.encode(doc)))
+
+
+@scenario('to_dict_nested')
+def to_dict_nested(context):
+    doc = NestedDocument(**nested_data(1))
+    return Case(lambda: bson.decode(bson.encode(doc)))
+
+
+@scenario('find_flat')
+def find_flat(context):
+    """
+    Iterate a query over size documents.
+    """
+    context.populate(FlatDocument, flat_data, context.size)
+    query = context.session.query(FlatDocument)
+
+    def op():
+        for _ in query:
+            pass
+    return Case(op, units=context.size, calls=max(3, context.calls // 100))
+
+
+@scenario('find_nested')
+def find_nested(context):
+    context.populate(NestedDocument, nested_data, context.size)
+    query = context.session.query(NestedDocument)
+
+    def op():
+        for _ in query:
+            pass
+    return Case(op, units=context.size, calls=max(3, context.calls // 100))
+
+
+@scenario('query')
+def query(context):
+    """
+    The cost of session.query() itself, no cursor is opened.
+    """
+    session = context.session
+    return Case(lambda: session.query(NestedDocument))
+
+
+@scenario('find_one')
+def find_one(context):
+    """
+    Look up documents by _id.
+    """
+    oids = context.populate(NestedDocument, nested_data, context.size)
+    query = context.session.query(NestedDocument)
+    lookups = iter(oids * (context.calls // len(oids) + 2))
+    return Case(lambda: query.find_one({'_id': next(lookups)}))
+
+
+@scenario('insert_single')
+def insert_single(context):
+    """
+    add() one document at a time.
+    """
+    context.reset(NestedDocument)
+    counter = iter(range(10 ** 9))
+    session = context.session
+    return Case(lambda: session.add(
+        NestedDocument(**nested_data(next(counter)))))
+
+
+@scenario('insert_bulk')
+def insert_bulk(context):
+    """
+    add_all() batch_size documents at a time.
+    """
+    context.reset(NestedDocument)
+    counter = iter(range(10 ** 9))
+    session = context.session
+    batch_size = context.batch_size
+
+    def op():
+        session.add_all(NestedDocument(**nested_data(next(counter)))
+                        for _ in range(batch_size))
+    return Case(op, units=batch_size, calls=max(3, context.calls // 100))
+
+
+@scenario('save_single')
+def save_single(context):
+    """
+    save() one changed document at a time.
+    """
+    context.populate(NestedDocument, nested_data, min(context.size, 1000))
+    docs = list(context.session.query(NestedDocument))
+    session = context.session
+    counter = iter(range(10 ** 9))
+
+    def op():
+        n = next(counter)
+        doc = docs[n % len(docs)]
+        doc.counter = n
+        session.save(doc)
+    return Case(op)
+
+
+@scenario('save_bulk')
+def save_bulk(context):
+    """
+    save_all() the same documents, all of them changed.
+    """
+    context.populate(NestedDocument, nested_data, min(context.size, 1000))
+    docs = list(context.session.query(NestedDocument))
+    session = context.session
+    counter = iter(range(10 ** 9))
+
+    def op():
+        n = next(counter)
+        for doc in docs:
+            doc.counter = n
+        session.save_all(docs)
+    return Case(op, units=len(docs), calls=max(3, context.calls // 100))
+
+
+def _collection_update(context, fetch):
+    context.populate(NestedDocument, nested_data, min(context.size, 1000))
+    stats = OperationStats()
+    session = MongoSession(context.client, listeners=[stats])
+    docs = list(session.query(NestedDocument))
+    counter = iter(range(10 ** 9))
+
+    def op():
+        n = next(counter)
+        docs[n % len(docs)].collection_update(
+            {'counter': n, 'profile.address.city': 'city %d' % n},
+            fetch=fetch)
+    return Case(op, stats=stats)
+
+
+@scenario('collection_update')
+def collection_update(context):
+    """
+    collection_update() of two paths, read back from the server in the same
+    round trip. Counts the driver calls per update.
+    """
+    return _collection_update(context, True)
+
+
+@scenario('collection_update_local')
+def collection_update_local(context):
+    """
+    collection_update() with fetch=False, the $set is applied locally.
+    """
+    return _collection_update(context, False)
+
+
+def _column_documents(rows):
+    for i in range(rows):
+        if i % 7:
+            yield {'n': i, 'x': i * 0.5, 'sub': {'flag': i % 2 == 0}}
+        else:
+            yield {'x': None, 'sub': {}}
+
+
+def iter_columns_synthetic(context):
+    """
+    Convert 200 * size decoded documents, two million by default, to numpy
+    masked arrays, every seventh row missing. No server is involved.
+    """
+    rows = context.size * 200
+    paths = ['n', 'x', 'sub.flag']
+
+    def op():
+        concatenate_columns(
+            iter_columns(_column_documents(rows), paths, {'n': 'int64'},
+                         batch_size=250000), paths)
+    return Case(op, units=rows, calls=3)
+
+
+if iter_columns is not None:
+    scenario('iter_columns')(iter_columns_synthetic)
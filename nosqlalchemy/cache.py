@@ -0,0 +1,109 @@
+import time
+import weakref
+from collections import OrderedDict
+
+
+__all__ = [
+    'IdentityMap',
+    'DocumentCache'
+]
+
+
+class IdentityMap(object):
+    """
+    Maps (database, collection, _id) to the live Collection instance.
+
+    References are weak, an instance leaves the map once nothing else
+    holds it.
+    """
+    def __init__(self):
+        self._instances = weakref.WeakValueDictionary()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        instance = self._instances.get(key)
+        if instance is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return instance
+
+    def peek(self, key):
+        """
+        get() without counting a hit or a miss.
+        """
+        return self._instances.get(key)
+
+    def add(self, key, instance):
+        self._instances[key] = instance
+
+    def discard(self, key):
+        self._instances.pop(key, None)
+
+    def __len__(self):
+        return len(self._instances)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self))
+
+
+class DocumentCache(object):
+    """
+    A bounded LRU cache of BSON encoded documents, keyed the same way as
+    IdentityMap. Entries older than ttl seconds are treated as missing,
+    with ttl=None they only leave the cache when they are evicted or
+    invalidated.
+    """
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def clock(self):
+        return time.time()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        stored_at, raw = entry
+        if self.ttl is not None and self.clock() - stored_at > self.ttl:
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries[key] = self._entries.pop(key)
+        self.hits += 1
+        return raw
+
+    def put(self, key, raw):
+        self._entries.pop(key, None)
+        self._entries[key] = (self.clock(), raw)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def invalidate_collection(self, database, collection):
+        for key in [k for k in self._entries
+                    if k[0] == database and k[1] == collection]:
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, expirations=self.expirations,
+                    size=len(self))
@@ -0,0 +1,451 @@
+"""
+Change streams over Collection classes.
+
+for change in session.watch(User, filter={User.active: True}):
+    print(change.operation, change.document_key, change.document)
+
+Events are ChangeEvent tuples: the operation, insert, update, replace,
+delete or one of the collection events such as drop and invalidate, the
+_id of the document, the document hydrated as a Collection object when the
+event carries it, and for updates the changed and removed (dotted) paths.
+
+filter conditions apply to the full document, with Key class attributes or
+names, update events then look the document up. Delete events have no
+full document and never match a filter, so filter is not combined with
+'delete' operations, nor with apply: the documents deleted or updated out
+of the filter would stay in the view. Watch deletes without a filter, or
+select them by documentKey in a raw pipeline.
+
+Each event has the resume token of the stream after it, also kept as
+stream.resume_token. Iterating the stream again, or a new watch() given
+the token as resume_after, continues after the last event seen, across
+restarts when the token is stored. pymongo resumes by itself after
+transient errors.
+
+apply keeps documents held by the process in line with the collection:
+
+* 'session' refreshes the instances of the identity map of the session in
+  place and the documents of its read cache, deleted documents leave both.
+  Update descriptions are applied to instances keeping their unsaved
+  changes, full documents replace them. Instances which an update
+  description does not fit leave the identity map.
+* a dict, or any mutable mapping, is kept as a materialized view of the
+  documents keyed by _id. Load it with a query before watching, from a
+  start_at_operation_time or a resume token taken before the query, so no
+  change is missed. Documents which an update description does not fit
+  are read again.
+
+Change streams need a replica set or a sharded cluster, the in-process
+backend raises OperationFailure like a standalone server.
+"""
+import inspect
+from collections import namedtuple
+
+import bson
+
+from nosqlalchemy.nosql import _key_path, _resolve_path, _set_path
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+
+__all__ = [
+    'ChangeEvent',
+    'ChangeStream',
+    'AsyncChangeStream'
+]
+
+
+class ChangeEvent(namedtuple('ChangeEvent',
+                             'operation collection_cls document_key '
+                             'document updated_fields removed_fields '
+                             'resume_token cluster_time raw')):
+    """
+    One change: the operationType, the Collection class watched, the _id
+    of the document, the document as a Collection object or None, the
+    updatedFields and removedFields of updates, the resume token after the
+    event, its clusterTime and the change document as the server sent it.
+    """
+    __slots__ = ()
+
+
+# Events after which the watched documents are gone or unknown.
+_COLLECTION_EVENTS = frozenset(['drop', 'rename', 'dropDatabase',
+                                'invalidate'])
+
+
+def _unset_path(target, path):
+    """
+    The $unset of a dotted path, list elements become None.
+    """
+    parts = path.split('.')
+    for part in parts[:-1]:
+        if isinstance(target, list):
+            target = target[int(part)]
+        else:
+            target = target.get(part)
+        if target is None:
+            return
+    if isinstance(target, list):
+        target[int(parts[-1])] = None
+    elif isinstance(target, dict):
+        target.pop(parts[-1], None)
+    elif parts[-1] in target:
+        target[parts[-1]] = None
+
+
+def _truncate(target, path, size):
+    """
+    Shorten the list at a dotted path to size items.
+    """
+    for part in path.split('.'):
+        if isinstance(target, list):
+            target = target[int(part)]
+        else:
+            target = target.get(part)
+    del target[size:]
+
+
+def _patch(instance, description):
+    """
+    Apply an update description to a loaded document and its snapshot, so
+    its own unsaved changes are still found by changes(). Arrays shortened
+    by the update are truncated first, as the server reports them.
+    """
+    stored = instance._stored()
+    for truncated in description.get('truncatedArrays') or ():
+        name, _, rest = truncated['field'].partition('.')
+        target = getattr(instance, name)
+        if rest:
+            _truncate(target, rest, truncated['newSize'])
+        else:
+            del target[truncated['newSize']:]
+        if stored is not None:
+            _truncate(stored, truncated['field'], truncated['newSize'])
+    updated_fields = description.get('updatedFields')
+    removed_fields = description.get('removedFields')
+    for path, value in (updated_fields or dict()).items():
+        instance._set_path(path, value)
+        if stored is not None:
+            _set_path(stored, path, value)
+    for path in removed_fields or ():
+        name, _, rest = path.partition('.')
+        if rest:
+            _unset_path(getattr(instance, name), rest)
+        else:
+            dict.pop(instance, name, None)
+        if stored is not None:
+            _unset_path(stored, path)
+    instance._store(stored)
+
+
+def _refresh(instance, data):
+    """
+    Replace the contents of a loaded document with the stored one.
+    """
+    dict.clear(instance)
+    type(instance).__schema__.hydrate(instance, data, instance._lazy)
+    object.__setattr__(instance, '_snapshot', bson.encode(data))
+
+
+class ChangeStream(object):
+    """
+    The changes of the documents of a Collection class, made by
+    MongoSession.watch(). The server stream is opened when it is iterated,
+    see the module documentation.
+    """
+    def __init__(self, session, collection_cls, filter=None,
+                 operations=None, pipeline=None, full_document=None,
+                 resume_after=None, start_after=None,
+                 start_at_operation_time=None, batch_size=None,
+                 max_await_time_ms=None, apply=None):
+        if apply not in (None, 'session') and \
+                not isinstance(apply, MutableMapping):
+            raise ValueError("apply is None, 'session' or a mapping")
+        if filter and apply is not None:
+            raise ValueError('filter can not be combined with apply, '
+                             'deleted documents would not be seen')
+        if filter and 'delete' in (operations or ()):
+            raise ValueError('delete events have no full document to '
+                             'filter')
+        self.session = session
+        self.collection_cls = collection_cls
+        self.match = dict()
+        if operations:
+            self.match['operationType'] = {'$in': list(operations)}
+        for field, condition in (filter or dict()).items():
+            path = _key_path(field)
+            _resolve_path(collection_cls, path)
+            self.match['fullDocument.' + path] = condition
+        self.extra_stages = list(pipeline or ())
+        if full_document is None and filter:
+            full_document = 'updateLookup'
+        self.full_document = full_document
+        self.resume_token = resume_after
+        self.start_after = start_after
+        self.start_at_operation_time = start_at_operation_time
+        self.batch_size = batch_size
+        self.max_await_time_ms = max_await_time_ms
+        self.apply = apply
+        self._stream = None
+        self._reloads = list()
+
+    def pipeline(self):
+        stages = list()
+        if self.match:
+            stages.append({'$match': self.match})
+        return stages + self.extra_stages
+
+    def _watch_options(self):
+        """
+        The watch() arguments, resuming after the last event seen.
+        """
+        options = dict(
+            full_document=self.full_document,
+            batch_size=self.batch_size,
+            max_await_time_ms=self.max_await_time_ms)
+        if self.resume_token is not None:
+            options['resume_after'] = self.resume_token
+        elif self.start_after is not None:
+            options['start_after'] = self.start_after
+        else:
+            options['start_at_operation_time'] = \
+                self.start_at_operation_time
+        return dict((k, v) for k, v in options.items() if v is not None)
+
+    def _watch(self):
+        collection = self.session._get_collection_from_object(
+            self.collection_cls)
+        return collection.watch(self.pipeline(), **self._watch_options())
+
+    def _open(self):
+        if self._stream is None:
+            self._stream = self._watch()
+        return self._stream
+
+    def __iter__(self):
+        stream = self._open()
+        for change in stream:
+            event = self._event(change, stream)
+            if self._reloads:
+                self._reload()
+            yield event
+
+    def try_next(self):
+        """
+        The next event, None when there is none yet.
+        """
+        stream = self._open()
+        change = stream.try_next()
+        if change is None:
+            self._track(None, stream)
+            return None
+        event = self._event(change, stream)
+        if self._reloads:
+            self._reload()
+        return event
+
+    def close(self):
+        stream, self._stream = self._stream, None
+        if stream is not None:
+            stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def _track(self, change, stream):
+        token = getattr(stream, 'resume_token', None)
+        if token is None and change is not None:
+            token = change.get('_id')
+        if token is not None:
+            self.resume_token = token
+        return self.resume_token
+
+    def _document(self, document_key, data):
+        """
+        The full document of an event, the live instance when one is kept
+        up to date.
+        """
+        cls = self.collection_cls
+        live = None
+        if self.apply == 'session':
+            identity_map = self.session.identity_map
+            key = self.session._identity_key(cls, document_key)
+            if identity_map is not None and key is not None:
+                live = identity_map.peek(key)
+        elif self.apply is not None:
+            live = self.apply.get(document_key)
+        if isinstance(live, cls) and live.loaded_fields is None:
+            _refresh(live, data)
+            return live
+        return cls._load(self.session, data)
+
+    def _event(self, change, stream):
+        resume_token = self._track(change, stream)
+        operation = change.get('operationType')
+        document_key = (change.get('documentKey') or dict()).get('_id')
+        data = change.get('fullDocument')
+        document = None
+        if data is not None:
+            document = self._document(document_key, data)
+        description = change.get('updateDescription') or dict()
+        event = ChangeEvent(
+            operation, self.collection_cls, document_key, document,
+            description.get('updatedFields'),
+            description.get('removedFields'), resume_token,
+            change.get('clusterTime'), change)
+        if self.apply == 'session':
+            self._apply_session(event)
+        elif self.apply is not None:
+            self._apply_view(event)
+        return event
+
+    def _apply_session(self, event):
+        session = self.session
+        if event.operation in _COLLECTION_EVENTS:
+            session._invalidate_collection(self.collection_cls)
+            return
+        key = session._identity_key(self.collection_cls, event.document_key)
+        if key is None:
+            return
+        identity_map = session.identity_map
+        cache = session.cache
+        if event.operation == 'delete':
+            if identity_map is not None:
+                identity_map.discard(key)
+            if cache is not None:
+                cache.invalidate(key)
+        elif event.document is not None:
+            if cache is not None and event.operation != 'insert':
+                cache.put(key, event.document._snapshot)
+        elif event.operation == 'update':
+            live = identity_map.peek(key) \
+                if identity_map is not None else None
+            if isinstance(live, self.collection_cls) and \
+                    live.loaded_fields is None and \
+                    not self._patched(live, event):
+                # the next query loads the document again
+                self._forget(event.document_key)
+            elif cache is not None:
+                cache.invalidate(key)
+
+    def _apply_view(self, event):
+        view = self.apply
+        if event.operation in _COLLECTION_EVENTS:
+            view.clear()
+        elif event.operation == 'delete':
+            view.pop(event.document_key, None)
+        elif event.document is not None:
+            view[event.document_key] = event.document
+        elif event.operation == 'update':
+            live = view.get(event.document_key)
+            if isinstance(live, self.collection_cls) and \
+                    not self._patched(live, event):
+                self._reloads.append(event.document_key)
+
+    def _patched(self, instance, event):
+        """
+        Whether the update description of event could be applied to a
+        loaded document. Those which could not are loaded again.
+        """
+        try:
+            _patch(instance, event.raw.get('updateDescription') or dict())
+        except (AttributeError, IndexError, KeyError, TypeError,
+                ValueError):
+            return False
+        return True
+
+    def _forget(self, document_key):
+        """
+        Drop a document from the identity map and the read cache, so it is
+        read from the server again.
+        """
+        key = self.session._identity_key(self.collection_cls, document_key)
+        if key is None:
+            return
+        if self.session.identity_map is not None:
+            self.session.identity_map.discard(key)
+        if self.session.cache is not None:
+            self.session.cache.invalidate(key)
+
+    def _reload(self):
+        """
+        Read the view documents which could not be patched from the server.
+        """
+        reloads, self._reloads = self._reloads, list()
+        query = self.session.query(self.collection_cls)
+        for document_key in reloads:
+            self._forget(document_key)
+            self._reloaded(document_key, query.find_one(document_key))
+
+    def _reloaded(self, document_key, document):
+        if document is None:
+            self.apply.pop(document_key, None)
+        else:
+            self.apply[document_key] = document
+
+
+class AsyncChangeStream(ChangeStream):
+    """
+    ChangeStream over an asyncio driver, events are read with async for or
+    awaited from try_next().
+    """
+    async def _open(self):
+        if self._stream is None:
+            stream = self._watch()
+            if inspect.isawaitable(stream):
+                # pymongo's AsyncCollection.watch() is a coroutine, motor's
+                # returns the stream
+                stream = await stream
+            self._stream = stream
+        return self._stream
+
+    def __iter__(self):
+        raise TypeError('AsyncChangeStream events are read with async for')
+
+    def __aiter__(self):
+        return self._aiter()
+
+    async def _aiter(self):
+        stream = await self._open()
+        async for change in stream:
+            event = self._event(change, stream)
+            if self._reloads:
+                await self._reload()
+            yield event
+
+    async def try_next(self):
+        stream = await self._open()
+        change = await stream.try_next()
+        if change is None:
+            self._track(None, stream)
+            return None
+        event = self._event(change, stream)
+        if self._reloads:
+            await self._reload()
+        return event
+
+    async def _reload(self):
+        reloads, self._reloads = self._reloads, list()
+        query = self.session.query(self.collection_cls)
+        for document_key in reloads:
+            self._forget(document_key)
+            self._reloaded(document_key, await query.find_one(document_key))
+
+    async def close(self):
+        stream, self._stream = self._stream, None
+        if stream is not None:
+            await stream.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+        return False
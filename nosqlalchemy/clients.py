@@ -0,0 +1,260 @@
+"""
+Shared clients and connection pool statistics.
+
+Each MongoClient holds a connection pool per server and monitor threads.
+MongoDBConnection objects for the same servers and options share one
+client through the process wide registry, rather than opening a pool
+each:
+
+a = MongoDBConnection('mongodb://db1,db2/?replicaSet=rs', max_pool_size=50)
+b = MongoDBConnection('db2:27017,db1', replica_set='rs', max_pool_size=50)
+assert a.connection is b.connection
+
+Clients do not survive os.fork(). The registry forgets its clients in the
+child process, connections made before the fork open a new client the next
+time they are used.
+"""
+import os
+import threading
+
+from pymongo import common, monitoring, uri_parser
+from pymongo.errors import ConfigurationError
+
+
+__all__ = [
+    'ClientRegistry',
+    'PoolStats',
+    'registry'
+]
+
+
+_POOL_COUNTERS = ('open', 'in_use', 'max_in_use', 'created', 'closed',
+                  'checkouts', 'checkout_failures', 'wait_ms', 'cleared')
+
+
+def _wait_ms(event):
+    # Check out durations are reported by pymongo 4.7 and later.
+    return (getattr(event, 'duration', None) or 0) * 1000
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """
+    Counts the connection pool events of a client, per server.
+
+    open and in_use are the connections open and checked out now,
+    max_in_use the most checked out at once, wait_ms the total time spent
+    waiting for a connection.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._servers = dict()
+
+    def _counters(self, address):
+        counters = self._servers.get(address)
+        if counters is None:
+            counters = self._servers[address] = dict.fromkeys(
+                _POOL_COUNTERS, 0)
+        return counters
+
+    def _count(self, event, **changes):
+        with self._lock:
+            counters = self._counters(event.address)
+            for name, change in changes.items():
+                counters[name] += change
+            if counters['in_use'] > counters['max_in_use']:
+                counters['max_in_use'] = counters['in_use']
+
+    def pool_created(self, event):
+        with self._lock:
+            self._counters(event.address)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._count(event, cleared=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._count(event, open=1, created=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._count(event, open=-1, closed=1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._count(event, checkout_failures=1,
+                    wait_ms=_wait_ms(event))
+
+    def connection_checked_out(self, event):
+        self._count(event, in_use=1, checkouts=1,
+                    wait_ms=_wait_ms(event))
+
+    def connection_checked_in(self, event):
+        self._count(event, in_use=-1)
+
+    def snapshot(self):
+        """
+        The counters summed over all servers, with the counters of each
+        server under 'servers', keyed by 'host:port'.
+        """
+        with self._lock:
+            servers = dict(('%s:%s' % address, dict(counters))
+                           for address, counters in self._servers.items())
+        totals = dict.fromkeys(_POOL_COUNTERS, 0)
+        for counters in servers.values():
+            for name in _POOL_COUNTERS:
+                totals[name] += counters[name]
+        totals['servers'] = servers
+        return totals
+
+
+def _freeze(value):
+    """
+    A hashable stand in for an option value. Values which can not be
+    compared, such as event listeners, stand for themselves.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    try:
+        hash(value)
+    except TypeError:
+        return ('id', id(value))
+    return value
+
+
+def _option(name, value):
+    """
+    An option as the client reads it, ('maxpoolsize', 50) for
+    ('maxPoolSize', '50'). Options which pymongo does not validate are kept
+    as they are.
+    """
+    try:
+        name, value = common.validate(name, value)
+    except (ConfigurationError, TypeError, ValueError):
+        pass
+    return name.lower(), value
+
+
+def client_key(client_cls, host_or_url, options):
+    """
+    The registry key of a client: the client class, the set of seed
+    servers, the credentials and the options, option names being case
+    insensitive. Options given as arguments take precedence over the
+    options of a URI. mongodb+srv URIs are not resolved, they are only
+    equal to the same URI.
+    """
+    hosts = host_or_url
+    if not isinstance(hosts, (list, tuple)):
+        hosts = [hosts]
+    nodes = set()
+    credentials = (None, None, None)
+    merged = dict()
+    for host in hosts:
+        if host.startswith('mongodb+srv://'):
+            nodes.add(host)
+        elif host.startswith('mongodb://'):
+            parsed = uri_parser.parse_uri(host)
+            nodes.update((h.lower(), p) for h, p in parsed['nodelist'])
+            credentials = (parsed['username'], parsed['password'],
+                           parsed['database'])
+            merged.update(_option(k, v) for k, v in parsed['options'].items())
+        else:
+            nodes.update(uri_parser.parse_host(h.strip())
+                         for h in host.split(','))
+    merged.update(_option(k, v) for k, v in options.items())
+    return (client_cls, tuple(sorted(nodes, key=repr)), credentials,
+            _freeze(merged))
+
+
+def _with_listener(options, listener):
+    options = dict(options)
+    options['event_listeners'] = list(
+        options.get('event_listeners') or ()) + [listener]
+    return options
+
+
+class ClientRegistry(object):
+    """
+    Clients shared by connections with the same servers and options,
+    counted by the number of connections using them.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = dict()
+        self.generation = 0
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        """
+        Forget the clients of the parent process. They are not closed, their
+        sockets and threads belong to the parent.
+        """
+        self._lock = threading.Lock()
+        self._clients = dict()
+        self.generation += 1
+
+    def connect(self, client_cls, host_or_url, options):
+        """
+        Create a client with its PoolStats, outside the registry.
+        """
+        stats = PoolStats()
+        return client_cls(host_or_url, **_with_listener(options, stats)), stats
+
+    def acquire(self, client_cls, host_or_url, options):
+        """
+        The (client, PoolStats) shared for host_or_url and options, created
+        on first use.
+        """
+        key = client_key(client_cls, host_or_url, options)
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is None:
+                client, stats = self.connect(client_cls, host_or_url, options)
+                entry = self._clients[key] = [client, stats, 0]
+            entry[2] += 1
+            return entry[0], entry[1]
+
+    def release(self, client):
+        """
+        Give back a client from acquire(). Returns whether it was the last
+        user, in which case the client is closed.
+        """
+        with self._lock:
+            for key, entry in self._clients.items():
+                if entry[0] is client:
+                    entry[2] -= 1
+                    if entry[2] > 0:
+                        return False
+                    del self._clients[key]
+                    break
+            else:
+                return False
+        client.close()
+        return True
+
+    def close_all(self):
+        """
+        Close every shared client.
+        """
+        with self._lock:
+            entries = list(self._clients.values())
+            self._clients.clear()
+        for client, _, _ in entries:
+            client.close()
+
+    def __len__(self):
+        return len(self._clients)
+
+
+registry = ClientRegistry()
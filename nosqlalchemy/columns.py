@@ -0,0 +1,130 @@
+"""
+Columnar export of query results into NumPy arrays.
+
+Mquery.to_columns() and Mquery.to_numpy() read the projected keys of the
+results into one masked array per key, without building Collection
+objects. Keys which are missing or None are masked.
+
+Column types come from the data_type of the Key, or the dtypes argument;
+when neither is given they are inferred from the values of each batch.
+"""
+import datetime
+from collections import OrderedDict
+
+import numpy
+from numpy import ma
+
+
+__all__ = [
+    'column_dtype',
+    'iter_columns',
+    'concatenate_columns'
+]
+
+
+_DTYPES = {
+    bool: numpy.dtype(bool),
+    int: numpy.dtype('int64'),
+    float: numpy.dtype('float64'),
+    datetime.datetime: numpy.dtype('datetime64[ms]'),
+}
+
+_FILL = {
+    'b': False,
+    'i': 0,
+    'u': 0,
+    'f': 0.0,
+    'M': numpy.datetime64('NaT'),
+}
+
+
+def column_dtype(key):
+    """
+    The dtype declared by a Key, None when it is not declared.
+    """
+    try:
+        return _DTYPES.get(getattr(key, 'data_type', None))
+    except TypeError:
+        return None
+
+
+def _infer_dtype(values):
+    types = set(value.__class__ for value in values if value is not None)
+    if not types:
+        return numpy.dtype('float64')
+    if types == set([bool]):
+        return _DTYPES[bool]
+    if types == set([int]):
+        return _DTYPES[int]
+    if types.issubset([int, float]):
+        return _DTYPES[float]
+    if types == set([datetime.datetime]):
+        return _DTYPES[datetime.datetime]
+    return numpy.dtype(object)
+
+
+def _getter(path):
+    parts = path.split('.')
+    if len(parts) == 1:
+        return lambda doc: doc.get(path)
+
+    def get(doc):
+        for part in parts:
+            if not isinstance(doc, dict):
+                return None
+            doc = doc.get(part)
+        return doc
+    return get
+
+
+def _column(values, dtype):
+    mask = [value is None for value in values]
+    dtype = dtype if dtype is not None else _infer_dtype(values)
+    if True in mask:
+        fill = _FILL.get(dtype.kind)
+        data = numpy.array([fill if missing else value
+                            for value, missing in zip(values, mask)],
+                           dtype=dtype)
+        return ma.MaskedArray(data, mask=numpy.array(mask, dtype=bool))
+    return ma.MaskedArray(numpy.array(values, dtype=dtype))
+
+
+def iter_columns(documents, paths, dtypes=None, batch_size=100000):
+    """
+    generator of OrderedDicts mapping paths to masked arrays of up to
+    batch_size rows, read from an iterable of decoded documents. dtypes maps
+    paths to their dtype, paths which are left out are inferred.
+    """
+    dtypes = dict((path, numpy.dtype(dtype))
+                  for path, dtype in (dtypes or dict()).items())
+    getters = [(path, _getter(path), dtypes.get(path)) for path in paths]
+    rows = list()
+    for document in documents:
+        rows.append(document)
+        if len(rows) >= batch_size:
+            yield OrderedDict((path, _column([get(row) for row in rows],
+                                             dtype))
+                              for path, get, dtype in getters)
+            rows = list()
+    if rows:
+        yield OrderedDict((path, _column([get(row) for row in rows], dtype))
+                          for path, get, dtype in getters)
+
+
+def concatenate_columns(batches, paths, dtypes=None):
+    """
+    Join the batches of iter_columns() into one masked array per path.
+    """
+    dtypes = dtypes or dict()
+    columns = OrderedDict((path, list()) for path in paths)
+    for batch in batches:
+        for path, column in batch.items():
+            columns[path].append(column)
+    result = OrderedDict()
+    for path, arrays in columns.items():
+        if arrays:
+            result[path] = ma.concatenate(arrays)
+        else:
+            result[path] = ma.MaskedArray(numpy.array(
+                [], dtype=dtypes.get(path) or numpy.dtype('float64')))
+    return result
@@ -0,0 +1,327 @@
+"""
+Instrumentation of session and query operations.
+
+stats = OperationStats()
+session = MongoSession(client, listeners=[stats, SlowQueryLogger(100)])
+...
+stats.snapshot()['find']['p99_ms']
+
+Listeners are callables taking an OperationEvent, they are called by the
+thread which ran the operation once it is done. Sessions without listeners
+skip the timing altogether.
+
+driver_time is the time spent in pymongo, sending the request, waiting for
+the server and reading the reply, hydration_time the time spent building
+Collection objects from the results, or for writes, in checking the
+documents and encoding them. Query events are sent when iteration ends,
+the time the caller spends between two results is not counted. Bulk writes
+send an event per batch. Collection.collection_update() and remove() send
+one per driver call, named after the pymongo method.
+
+CommandMonitor forwards pymongo's command monitoring to the same
+listeners, to time the commands sent by code which uses pymongo directly.
+"""
+import bisect
+import logging
+import threading
+from collections import namedtuple
+from time import perf_counter
+
+from pymongo import monitoring
+
+
+__all__ = [
+    'OperationEvent',
+    'OperationStats',
+    'Histogram',
+    'SlowQueryLogger',
+    'CommandMonitor'
+]
+
+
+class OperationEvent(namedtuple('OperationEvent',
+                                'operation collection_cls namespace spec '
+                                'driver_time hydration_time count bytes '
+                                'error')):
+    """
+    One operation: the session or query method, the Collection class it
+    ran on and its 'database.collection', the filter, the time in seconds
+    spent in the driver and in hydration, the number of documents and the
+    BSON bytes read or written, and the exception it raised, if any, or
+    for CommandMonitor events the failure reply of the server.
+    """
+    __slots__ = ()
+
+    @property
+    def duration(self):
+        return self.driver_time + self.hydration_time
+
+
+def _namespace(collection_cls):
+    if collection_cls is None:
+        return None
+    return '%s.%s' % (collection_cls.__database__,
+                      collection_cls.__collection_name__)
+
+
+class OperationTimer(object):
+    """
+    Accumulates the driver and hydration time of an operation. Each call
+    to driver() or hydration() adds the time since the previous call to
+    one of them. Used as a context manager, it sends the event to the
+    listeners on exit.
+    """
+    def __init__(self, listeners, operation, collection_cls=None,
+                 spec=None):
+        self.listeners = listeners
+        self.operation = operation
+        self.collection_cls = collection_cls
+        self.spec = spec
+        self.driver_time = 0.0
+        self.hydration_time = 0.0
+        self.count = 0
+        self.bytes = 0
+        self.error = None
+        self._mark = perf_counter()
+
+    def restart(self):
+        """
+        Leave out the time since the last mark.
+        """
+        self._mark = perf_counter()
+
+    def driver(self):
+        now = perf_counter()
+        self.driver_time += now - self._mark
+        self._mark = now
+
+    def hydration(self):
+        now = perf_counter()
+        self.hydration_time += now - self._mark
+        self._mark = now
+
+    def event(self):
+        return OperationEvent(self.operation, self.collection_cls,
+                              _namespace(self.collection_cls), self.spec,
+                              self.driver_time, self.hydration_time,
+                              self.count, self.bytes, self.error)
+
+    def emit(self):
+        """
+        Send the event, and start counting the next one, bulk writes send
+        one per batch.
+        """
+        event = self.event()
+        self.driver_time = 0.0
+        self.hydration_time = 0.0
+        self.count = 0
+        self.bytes = 0
+        self.error = None
+        for listener in self.listeners:
+            listener(event)
+
+    def __enter__(self):
+        self.restart()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if isinstance(exc_value, Exception):
+            self.error = exc_value
+        self.emit()
+        return False
+
+
+# Bucket upper bounds in milliseconds.
+_BOUNDS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000,
+           2500, 5000, 10000, 30000, float('inf'))
+
+
+class Histogram(object):
+    """
+    Counts of durations in buckets growing in steps of about 2.5, from 0.1
+    ms to 30 s. Percentiles are the upper bound of their bucket, capped by
+    the largest value seen.
+    """
+    bounds = _BOUNDS
+
+    def __init__(self):
+        self.buckets = [0] * len(self.bounds)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms):
+        self.buckets[bisect.bisect_left(self.bounds, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def percentile(self, fraction):
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    def snapshot(self):
+        return dict(
+            count=self.count,
+            total_ms=self.total_ms,
+            mean_ms=self.total_ms / self.count if self.count else 0.0,
+            max_ms=self.max_ms,
+            p50_ms=self.percentile(0.5),
+            p90_ms=self.percentile(0.9),
+            p99_ms=self.percentile(0.99),
+            buckets=[(bound, count) for bound, count in
+                     zip(self.bounds, self.buckets) if count])
+
+
+class _Totals(object):
+    __slots__ = ('duration', 'driver', 'hydration', 'documents', 'bytes',
+                 'errors')
+
+    def __init__(self):
+        self.duration = Histogram()
+        self.driver = 0.0
+        self.hydration = 0.0
+        self.documents = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def add(self, event):
+        self.duration.add(event.duration * 1000)
+        self.driver += event.driver_time * 1000
+        self.hydration += event.hydration_time * 1000
+        self.documents += event.count
+        self.bytes += event.bytes
+        if event.error is not None:
+            self.errors += 1
+
+    def snapshot(self):
+        stats = self.duration.snapshot()
+        stats.update(driver_ms=self.driver, hydration_ms=self.hydration,
+                     documents=self.documents, bytes=self.bytes,
+                     errors=self.errors)
+        return stats
+
+
+class OperationStats(object):
+    """
+    A listener keeping a duration histogram and totals per operation, and
+    per operation and Collection class.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._operations = dict()
+            self._models = dict()
+
+    def __call__(self, event):
+        model = event.collection_cls.__name__ \
+            if event.collection_cls is not None else event.namespace
+        with self._lock:
+            for stats, key in ((self._operations, event.operation),
+                               (self._models, (event.operation, model))):
+                totals = stats.get(key)
+                if totals is None:
+                    totals = stats[key] = _Totals()
+                totals.add(event)
+
+    def snapshot(self, by_model=False):
+        """
+        Statistics keyed by operation, or with by_model by (operation,
+        Collection class name): count, total, mean, max and percentiles of
+        the duration in milliseconds, the milliseconds spent in the driver
+        and in hydration, documents, bytes and errors.
+        """
+        with self._lock:
+            stats = self._models if by_model else self._operations
+            return dict((key, totals.snapshot())
+                        for key, totals in stats.items())
+
+
+class SlowQueryLogger(object):
+    """
+    A listener logging the operations which took threshold_ms or longer.
+    """
+    def __init__(self, threshold_ms=100, logger=None, level=logging.WARNING):
+        self.threshold = threshold_ms / 1000.0
+        self.logger = logger or logging.getLogger('nosqlalchemy.slow')
+        self.level = level
+
+    def __call__(self, event):
+        duration = event.duration
+        if duration < self.threshold:
+            return
+        self.logger.log(
+            self.level, 'slow %s on %s: %.1f ms (driver %.1f ms, hydration '
+            '%.1f ms), %d documents, %d bytes, filter %r%s',
+            event.operation, event.namespace, duration * 1000,
+            event.driver_time * 1000, event.hydration_time * 1000,
+            event.count, event.bytes, event.spec,
+            ', failed: %r' % event.error if event.error is not None else '')
+
+
+# The documents of a reply, by command.
+_REPLY_DOCUMENTS = {
+    'find': lambda reply: len(reply.get('cursor', {}).get('firstBatch', ())),
+    'getMore': lambda reply: len(reply.get('cursor', {}).get('nextBatch',
+                                                             ())),
+    'insert': lambda reply: reply.get('n', 0),
+    'update': lambda reply: reply.get('n', 0),
+    'delete': lambda reply: reply.get('n', 0),
+}
+
+
+class CommandMonitor(monitoring.CommandListener):
+    """
+    A pymongo command listener sending an OperationEvent for every command
+    a client runs to listeners, pass it to the client as
+    MongoDBConnection(event_listeners=[CommandMonitor(listeners)]).
+
+    The operation is the command name, the time is all driver time, spec
+    is the filter of find, count, delete and update commands.
+    """
+    def __init__(self, listeners):
+        self.listeners = listeners
+        self._lock = threading.Lock()
+        self._started = dict()
+
+    @staticmethod
+    def _key(event):
+        return event.request_id, event.connection_id, event.operation_id
+
+    def started(self, event):
+        command = event.command
+        name = event.command_name
+        collection = command.get(name)
+        namespace = '%s.%s' % (event.database_name, collection) \
+            if isinstance(collection, str) else event.database_name
+        spec = command.get('filter', command.get('query'))
+        with self._lock:
+            self._started[self._key(event)] = (namespace, spec)
+
+    def _emit(self, event, count, error):
+        with self._lock:
+            namespace, spec = self._started.pop(self._key(event),
+                                                (None, None))
+        operation_event = OperationEvent(
+            event.command_name, None, namespace, spec,
+            event.duration_micros / 1e6, 0.0, count, 0, error)
+        for listener in self.listeners:
+            listener(operation_event)
+
+    def succeeded(self, event):
+        count = _REPLY_DOCUMENTS.get(event.command_name)
+        self._emit(event, count(event.reply) if count else 0, None)
+
+    def failed(self, event):
+        self._emit(event, 0, event.failure)
@@ -0,0 +1,1171 @@
+"""
+In-process MongoDB backend.
+
+MongoSession and Mquery only talk to the pymongo client interface of
+client.connection. MemoryClient implements the subset of the client,
+database, collection and cursor interfaces they use, documents are kept in
+dictionaries indexed by _id. It is meant for tests and for measuring the
+cost of the ORM layer without a network round trip.
+
+aggregate() supports the $match, $sort, $skip, $limit, $project,
+$addFields, $group, $unwind, $lookup, $count and $facet stages, with the
+common accumulators and a few arithmetic and string expressions.
+
+There are no change streams, watch() fails as it does on a standalone
+server.
+
+Indexes are recorded and unique indexes enforced, they are not used to
+answer queries. explain() reports the index the server would pick for the
+simpler cases, a filter or sort on the first key of an index, and COLLSCAN
+otherwise. TTL indexes do not expire documents.
+
+session = MongoSession(MemoryDBConnection())
+"""
+import copy
+import datetime
+import re
+import threading
+from collections import OrderedDict
+
+import bson
+from bson.codec_options import CodecOptions, DEFAULT_CODEC_OPTIONS
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.operations import (
+    DeleteMany,
+    DeleteOne,
+    IndexModel,
+    InsertOne,
+    ReplaceOne,
+    UpdateMany,
+    UpdateOne,
+)
+from pymongo.results import (
+    BulkWriteResult,
+    DeleteResult,
+    InsertManyResult,
+    InsertOneResult,
+    UpdateResult,
+)
+
+from nosqlalchemy.nosql import MongoDBConnection
+
+__all__ = [
+    'MemoryDBConnection',
+    'MemoryClient',
+    'MemoryDatabase',
+    'MemoryCollection',
+    'MemoryCursor',
+    'MemoryCommandCursor',
+]
+
+_missing = object()
+
+
+def _get_path(doc, path):
+    """
+    Values at a dotted path, lists are traversed the way MongoDB does.
+    """
+    values = [doc]
+    for part in path.split('.'):
+        found = list()
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit() and int(part) < len(value):
+                    found.append(value[int(part)])
+                else:
+                    for el in value:
+                        if isinstance(el, dict) and part in el:
+                            found.append(el[part])
+        values = found
+    return values
+
+
+def _expand(values):
+    """
+    Array values also match on their elements.
+    """
+    expanded = list()
+    for value in values:
+        expanded.append(value)
+        if isinstance(value, list):
+            expanded.extend(value)
+    return expanded
+
+
+def _sort_key(value):
+    """
+    A key ordering values roughly like the BSON comparison order.
+    """
+    if value is None:
+        return (1, 0)
+    if isinstance(value, bool):
+        return (8, value)
+    if isinstance(value, (int, float)):
+        return (3, value)
+    if isinstance(value, (str, bytes)):
+        return (4, value)
+    if isinstance(value, dict):
+        return (5, sorted((k, _sort_key(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return (6, [_sort_key(v) for v in value])
+    if isinstance(value, ObjectId):
+        return (7, value.binary)
+    if isinstance(value, datetime.datetime):
+        return (9, value)
+    return (10, repr(value))
+
+
+def _compare(a, b):
+    ka, kb = _sort_key(a), _sort_key(b)
+    if ka[0] != kb[0]:
+        return None
+    return (ka > kb) - (ka < kb)
+
+
+def _match_operator(values, operator, operand):
+    if operator == '$eq':
+        return operand in _expand(values) or (operand is None and not values)
+    if operator == '$ne':
+        return not _match_operator(values, '$eq', operand)
+    if operator in ('$gt', '$gte', '$lt', '$lte'):
+        for value in _expand(values):
+            result = _compare(value, operand)
+            if result is None:
+                continue
+            if operator == '$gt' and result > 0 or \
+                    operator == '$gte' and result >= 0 or \
+                    operator == '$lt' and result < 0 or \
+                    operator == '$lte' and result <= 0:
+                return True
+        return False
+    if operator == '$in':
+        return any(_match_operator(values, '$eq', o) for o in operand)
+    if operator == '$nin':
+        return not _match_operator(values, '$in', operand)
+    if operator == '$exists':
+        return bool(values) == bool(operand)
+    if operator == '$not':
+        return not _match_condition(values, operand)
+    if operator == '$size':
+        return any(isinstance(v, list) and len(v) == operand for v in values)
+    if operator == '$all':
+        return all(_match_operator(values, '$eq', o) for o in operand)
+    if operator == '$elemMatch':
+        return any(isinstance(v, list) and
+                   any(_matches(el, operand) if isinstance(el, dict) else
+                       _match_condition([el], operand) for el in v)
+                   for v in values)
+    if operator == '$regex':
+        pattern = re.compile(operand) if isinstance(operand, str) else operand
+        return any(isinstance(v, str) and pattern.search(v)
+                   for v in _expand(values))
+    if operator == '$options':
+        return True
+    raise NotImplementedError('%s is not supported' % operator)
+
+
+def _match_condition(values, condition):
+    if isinstance(condition, dict) and condition and \
+            all(k.startswith('$') for k in condition):
+        if '$regex' in condition and '$options' in condition:
+            flags = 0
+            for option in condition['$options']:
+                flags |= {'i': re.I, 'm': re.M, 's': re.S, 'x': re.X}[option]
+            condition = dict(condition,
+                             **{'$regex': re.compile(condition['$regex'],
+                                                     flags)})
+        return all(_match_operator(values, k, v)
+                   for k, v in condition.items())
+    if hasattr(condition, 'search') and hasattr(condition, 'pattern'):
+        return _match_operator(values, '$regex', condition)
+    return _match_operator(values, '$eq', condition)
+
+
+def _matches(doc, spec):
+    for key, condition in spec.items():
+        if key == '$and':
+            if not all(_matches(doc, s) for s in condition):
+                return False
+        elif key == '$or':
+            if not any(_matches(doc, s) for s in condition):
+                return False
+        elif key == '$nor':
+            if any(_matches(doc, s) for s in condition):
+                return False
+        elif not _match_condition(_get_path(doc, key), condition):
+            return False
+    return True
+
+
+def _project(doc, projection):
+    if not projection:
+        return doc
+    if isinstance(projection, (list, tuple)):
+        projection = dict.fromkeys(projection, 1)
+    include = [k for k, v in projection.items() if v and k != '_id']
+    exclude = [k for k, v in projection.items() if not v]
+    if include:
+        result = dict()
+        if projection.get('_id', 1) and '_id' in doc:
+            result['_id'] = doc['_id']
+        for path in include:
+            _copy_path(doc, result, path.split('.'))
+        return result
+    result = copy.deepcopy(doc)
+    for path in exclude:
+        _unset(result, path)
+    return result
+
+
+def _copy_path(source, target, parts):
+    head = parts[0]
+    if head not in source:
+        return
+    if len(parts) == 1:
+        target[head] = source[head]
+    elif isinstance(source[head], dict):
+        _copy_path(source[head], target.setdefault(head, dict()), parts[1:])
+    elif isinstance(source[head], list):
+        items = target.setdefault(head, list())
+        for el in source[head]:
+            if isinstance(el, dict):
+                item = dict()
+                _copy_path(el, item, parts[1:])
+                items.append(item)
+
+
+def _parent(doc, path, create=True):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        if isinstance(doc, list):
+            doc = doc[int(part)]
+            continue
+        if part not in doc:
+            if not create:
+                return None, parts[-1]
+            doc[part] = dict()
+        doc = doc[part]
+    return doc, parts[-1]
+
+
+def _set(doc, path, value):
+    parent, key = _parent(doc, path)
+    if isinstance(parent, list):
+        parent[int(key)] = value
+    else:
+        parent[key] = value
+
+
+def _unset(doc, path):
+    parent, key = _parent(doc, path, create=False)
+    if isinstance(parent, dict):
+        parent.pop(key, None)
+
+
+def _get(doc, path, default=None):
+    parent, key = _parent(doc, path, create=False)
+    if isinstance(parent, dict):
+        return parent.get(key, default)
+    if isinstance(parent, list) and key.isdigit() and int(key) < len(parent):
+        return parent[int(key)]
+    return default
+
+
+def _copy_value(value):
+    """
+    A plain copy of a value, the same as it would be stored.
+    """
+    return bson.decode(bson.encode({'v': value}))['v']
+
+
+def _each(value):
+    if isinstance(value, dict) and '$each' in value:
+        return list(value['$each'])
+    return [value]
+
+
+def _apply_update(doc, update, inserting=False):
+    if not any(k.startswith('$') for k in update):
+        replacement = _copy_value(update)
+        replacement['_id'] = doc['_id']
+        doc.clear()
+        doc.update(replacement)
+        return
+    for operator, fields in update.items():
+        for path, value in fields.items():
+            value = _copy_value(value)
+            if operator == '$set':
+                _set(doc, path, value)
+            elif operator == '$setOnInsert':
+                if inserting:
+                    _set(doc, path, value)
+            elif operator == '$unset':
+                _unset(doc, path)
+            elif operator == '$inc':
+                _set(doc, path, _get(doc, path, 0) + value)
+            elif operator == '$mul':
+                _set(doc, path, _get(doc, path, 0) * value)
+            elif operator == '$min':
+                current = _get(doc, path, _missing)
+                if current is _missing or _compare(value, current) < 0:
+                    _set(doc, path, value)
+            elif operator == '$max':
+                current = _get(doc, path, _missing)
+                if current is _missing or _compare(value, current) > 0:
+                    _set(doc, path, value)
+            elif operator == '$currentDate':
+                _set(doc, path, datetime.datetime.utcnow())
+            elif operator == '$push':
+                items = _get(doc, path, None)
+                if items is None:
+                    items = list()
+                    _set(doc, path, items)
+                items.extend(_each(value))
+            elif operator == '$addToSet':
+                items = _get(doc, path, None)
+                if items is None:
+                    items = list()
+                    _set(doc, path, items)
+                for el in _each(value):
+                    if el not in items:
+                        items.append(el)
+            elif operator == '$pull':
+                items = _get(doc, path, None) or list()
+                if isinstance(value, dict) and not any(
+                        k.startswith('$') for k in value):
+                    kept = [el for el in items
+                            if not (isinstance(el, dict) and
+                                    _matches(el, value))]
+                else:
+                    kept = [el for el in items
+                            if not _match_condition([el], value)]
+                _set(doc, path, kept)
+            elif operator == '$pullAll':
+                items = _get(doc, path, None) or list()
+                _set(doc, path, [el for el in items if el not in value])
+            elif operator == '$pop':
+                items = _get(doc, path, None) or list()
+                if items:
+                    items.pop(0 if value < 0 else -1)
+            elif operator == '$rename':
+                current = _get(doc, path, _missing)
+                if current is not _missing:
+                    _unset(doc, path)
+                    _set(doc, value, current)
+            else:
+                raise NotImplementedError('%s is not supported' % operator)
+
+
+def _evaluate(doc, expression):
+    """
+    The value of an aggregation expression for doc: '$path' field paths,
+    documents of expressions and the operators below.
+    """
+    if isinstance(expression, str):
+        if expression.startswith('$'):
+            return _get(doc, expression[1:])
+        return expression
+    if isinstance(expression, list):
+        return [_evaluate(doc, el) for el in expression]
+    if not isinstance(expression, dict):
+        return expression
+    if len(expression) == 1:
+        operator, operand = next(iter(expression.items()))
+        if operator.startswith('$'):
+            return _evaluate_operator(doc, operator, operand)
+    return dict((k, _evaluate(doc, v)) for k, v in expression.items())
+
+
+def _evaluate_operator(doc, operator, operand):
+    if operator == '$literal':
+        return operand
+    args = _evaluate(doc, operand)
+    if not isinstance(operand, list):
+        args = [args]
+    if operator == '$add':
+        return sum(args)
+    if operator == '$subtract':
+        return args[0] - args[1]
+    if operator == '$multiply':
+        product = 1
+        for arg in args:
+            product *= arg
+        return product
+    if operator == '$divide':
+        return args[0] / args[1]
+    if operator == '$concat':
+        return ''.join(args)
+    if operator == '$ifNull':
+        return args[0] if args[0] is not None else args[1]
+    if operator == '$size':
+        return len(args[0])
+    if operator == '$toLower':
+        return args[0].lower()
+    if operator == '$toUpper':
+        return args[0].upper()
+    raise NotImplementedError('%s is not supported' % operator)
+
+
+def _accumulate(operator, values):
+    if operator == '$sum':
+        return sum(v for v in values
+                   if isinstance(v, (int, float)) and not isinstance(v, bool))
+    if operator == '$avg':
+        numbers = [v for v in values if isinstance(v, (int, float)) and
+                   not isinstance(v, bool)]
+        return sum(numbers) / len(numbers) if numbers else None
+    if operator in ('$min', '$max'):
+        present = [v for v in values if v is not None]
+        if not present:
+            return None
+        pick = min if operator == '$min' else max
+        return pick(present, key=_sort_key)
+    if operator == '$first':
+        return values[0] if values else None
+    if operator == '$last':
+        return values[-1] if values else None
+    if operator == '$push':
+        return list(values)
+    if operator == '$addToSet':
+        found = list()
+        for value in values:
+            if value not in found:
+                found.append(value)
+        return found
+    if operator == '$count':
+        return len(values)
+    raise NotImplementedError('%s is not supported' % operator)
+
+
+def _group_key(value):
+    return bson.encode({'k': value})
+
+
+def _group(docs, spec):
+    groups = OrderedDict()
+    for doc in docs:
+        _id = _evaluate(doc, spec['_id'])
+        groups.setdefault(_group_key(_id), (_id, list()))[1].append(doc)
+    results = list()
+    for _id, members in groups.values():
+        result = {'_id': _id}
+        for name, accumulator in spec.items():
+            if name == '_id':
+                continue
+            operator, operand = next(iter(accumulator.items()))
+            result[name] = _accumulate(
+                operator, [_evaluate(doc, operand) for doc in members])
+        results.append(result)
+    return results
+
+
+def _project_stage(doc, spec):
+    exclude = [k for k, v in spec.items()
+               if v in (0, False) and not isinstance(v, dict)]
+    if exclude and len(exclude) == len(spec):
+        return _project(doc, spec)
+    result = dict()
+    if spec.get('_id', 1) not in (0, False) and '_id' in doc:
+        result['_id'] = doc['_id']
+    for path, value in spec.items():
+        if path == '_id' and value in (0, 1, True, False):
+            continue
+        if value is True or value == 1 and not isinstance(value, bool):
+            _copy_path(doc, result, path.split('.'))
+        elif value not in (0, False):
+            _set(result, path, _evaluate(doc, value))
+    return result
+
+
+def _unwind(docs, spec):
+    if isinstance(spec, str):
+        spec = {'path': spec}
+    path = spec['path'][1:]
+    keep = spec.get('preserveNullAndEmptyArrays', False)
+    index_field = spec.get('includeArrayIndex')
+    for doc in docs:
+        values = _get(doc, path, _missing)
+        if not isinstance(values, list):
+            if values is _missing or values is None:
+                if keep:
+                    yield doc
+                continue
+            values = [values]
+        if not values and keep:
+            unwound = copy.deepcopy(doc)
+            _unset(unwound, path)
+            yield unwound
+        for index, value in enumerate(values):
+            unwound = copy.deepcopy(doc)
+            _set(unwound, path, value)
+            if index_field:
+                unwound[index_field] = index
+            yield unwound
+
+
+def _lookup(collection, docs, spec):
+    foreign = collection.database[spec['from']]
+    for doc in docs:
+        local = _get_path(doc, spec['localField'])
+        local = _expand(local) if local else [None]
+        doc[spec['as']] = [
+            bson.decode(foreign._encoded[found['_id']])
+            for found in foreign._match(dict())
+            if any(_match_operator(_get_path(found, spec['foreignField']),
+                                   '$eq', value) for value in local)]
+    return docs
+
+
+def _aggregate(collection, docs, pipeline):
+    """
+    Run an aggregation pipeline over decoded copies of documents.
+    """
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        if name == '$match':
+            docs = [doc for doc in docs if _matches(doc, spec)]
+        elif name == '$sort':
+            for key, direction in reversed(list(spec.items())):
+                docs.sort(key=lambda doc: _sort_key(
+                    (_get_path(doc, key) or [None])[0]), reverse=direction < 0)
+        elif name == '$skip':
+            docs = docs[spec:]
+        elif name == '$limit':
+            docs = docs[:spec]
+        elif name == '$project':
+            docs = [_project_stage(doc, spec) for doc in docs]
+        elif name in ('$addFields', '$set'):
+            for doc in docs:
+                for path, value in spec.items():
+                    _set(doc, path, _evaluate(doc, value))
+        elif name == '$group':
+            docs = _group(docs, spec)
+        elif name == '$unwind':
+            docs = list(_unwind(docs, spec))
+        elif name == '$lookup':
+            docs = _lookup(collection, docs, spec)
+        elif name == '$count':
+            docs = [{spec: len(docs)}] if docs else []
+        elif name == '$facet':
+            docs = [dict((facet, _aggregate(collection, copy.deepcopy(docs),
+                                            stages))
+                         for facet, stages in spec.items())]
+        else:
+            raise NotImplementedError('%s is not supported' % name)
+    return docs
+
+
+class MemoryCommandCursor(object):
+    """
+    The results of an aggregation, computed when it runs.
+    """
+    def __init__(self, documents, batch_size=0):
+        self._results = iter(documents)
+        self.batch_size_count = batch_size
+
+    def batch_size(self, batch_size):
+        self.batch_size_count = batch_size
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._results)
+
+    next = __next__
+
+    def close(self):
+        self._results = iter(())
+
+
+class MemoryCursor(object):
+    """
+    A cursor over a MemoryCollection query, documents are matched when the
+    cursor is first iterated.
+    """
+    def __init__(self, collection, spec=None, projection=None, sort=None,
+                 skip=0, limit=0, batch_size=0, hint=None, **kwargs):
+        self.collection = collection
+        self.spec = spec or dict()
+        self.projection = projection
+        self.sort_keys = list(sort or [])
+        self.skip_count = skip
+        self.limit_count = limit
+        self.batch_size_count = batch_size
+        self.index_hint = hint
+        self._results = None
+
+    def sort(self, key_or_list, direction=ASCENDING):
+        if not isinstance(key_or_list, (list, tuple)):
+            key_or_list = [(key_or_list, direction)]
+        self.sort_keys.extend(key_or_list)
+        return self
+
+    def skip(self, skip):
+        self.skip_count = skip
+        return self
+
+    def limit(self, limit):
+        self.limit_count = limit
+        return self
+
+    def batch_size(self, batch_size):
+        self.batch_size_count = batch_size
+        return self
+
+    def hint(self, index):
+        self.index_hint = index
+        return self
+
+    def _documents(self):
+        docs = self.collection._match(self.spec)
+        for key, direction in reversed(self.sort_keys):
+            docs.sort(key=lambda doc: _sort_key(
+                (_get_path(doc, key) or [None])[0]), reverse=direction < 0)
+        if self.skip_count:
+            docs = docs[self.skip_count:]
+        if self.limit_count:
+            docs = docs[:abs(self.limit_count)]
+        if self.projection:
+            for doc in docs:
+                yield self.collection._output(doc, self.projection)
+            return
+        encoded = self.collection._encoded
+        codec_options = self.collection.codec_options
+        for doc in docs:
+            yield bson.decode(encoded[doc['_id']], codec_options)
+
+    def __iter__(self):
+        if self._results is None:
+            self._results = self._documents()
+        return self._results
+
+    def __next__(self):
+        return next(iter(self))
+
+    next = __next__
+
+    def count(self, with_limit_and_skip=False):
+        return len(self.collection._match(self.spec))
+
+    def close(self):
+        self._results = iter(())
+
+    def explain(self):
+        index = self.collection._plan(self.spec, self.sort_keys,
+                                      self.index_hint)
+        if index is None:
+            plan = {'stage': 'COLLSCAN', 'filter': self.spec}
+        else:
+            name, info = index
+            plan = {'stage': 'FETCH',
+                    'inputStage': {'stage': 'IXSCAN', 'indexName': name,
+                                   'keyPattern': OrderedDict(info['key'])}}
+        return {'queryPlanner': {'namespace': self.collection.full_name,
+                                 'winningPlan': plan}}
+
+
+def _spec_fields(spec):
+    """
+    The keys a filter puts conditions on, through $and.
+    """
+    fields = set()
+    for key, value in spec.items():
+        if key == '$and':
+            for condition in value:
+                fields.update(_spec_fields(condition))
+        elif not key.startswith('$'):
+            fields.add(key)
+    return fields
+
+
+def _index_values(doc, keys):
+    values = list()
+    for path, _ in keys:
+        found = _get_path(doc, path)
+        values.append(found[0] if found else None)
+    return values
+
+
+class MemoryCollection(object):
+    """
+    A collection held in a dictionary indexed by _id.
+    """
+    def __init__(self, database, name, codec_options=None):
+        self.database = database
+        self.name = name
+        self.full_name = '%s.%s' % (database.name, name)
+        self.codec_options = codec_options or DEFAULT_CODEC_OPTIONS
+        self._lock = database.client._lock
+
+    @property
+    def _documents(self):
+        return self.database._collection_data(self.name)
+
+    @property
+    def _encoded(self):
+        return self.database._encoded_data(self.name)
+
+    @property
+    def _indexes(self):
+        return self.database._index_data(self.name)
+
+    def _plan(self, spec, sort_keys, hint=None):
+        """
+        The (name, info) of the index a query would use, None for a
+        collection scan.
+        """
+        indexes = self._indexes
+        if hint is not None:
+            for name, info in indexes.items():
+                if hint == name or list(hint) == info['key']:
+                    return name, info
+            return None
+        fields = _spec_fields(spec or dict())
+        for name, info in indexes.items():
+            partial = info.get('partialFilterExpression')
+            if partial and not set(partial).issubset(fields):
+                continue
+            if info['key'][0][0] in fields:
+                return name, info
+        if sort_keys:
+            for name, info in indexes.items():
+                if info['key'][0][0] == sort_keys[0][0] and \
+                        not info.get('partialFilterExpression'):
+                    return name, info
+        return None
+
+    def _check_unique(self, doc):
+        """
+        Raise DuplicateKeyError when doc has the same values as another
+        document for the keys of a unique index.
+        """
+        for name, info in self._indexes.items():
+            if not info.get('unique') or name == '_id_':
+                continue
+            partial = info.get('partialFilterExpression')
+            if partial and not _matches(doc, partial):
+                continue
+            keys = info['key']
+            values = _index_values(doc, keys)
+            if info.get('sparse') and values == [None] * len(keys):
+                continue
+            for other in self._documents.values():
+                if other['_id'] == doc['_id'] or \
+                        (partial and not _matches(other, partial)):
+                    continue
+                if _index_values(other, keys) == values:
+                    raise DuplicateKeyError(
+                        'E11000 duplicate key error collection: %s index: '
+                        '%s dup key: %r' % (self.full_name, name, values),
+                        11000)
+
+    def with_options(self, codec_options=None, **kwargs):
+        return MemoryCollection(self.database, self.name,
+                                codec_options or self.codec_options)
+
+    def _store(self, doc):
+        """
+        Store a copy of doc, its BSON is kept to answer queries with it the
+        way a server sends stored documents.
+        """
+        encoded = bson.encode(doc)
+        self._documents[doc['_id']] = bson.decode(encoded)
+        self._encoded[doc['_id']] = encoded
+
+    def _output(self, doc, projection=None):
+        if projection:
+            encoded = bson.encode(_project(doc, projection))
+        else:
+            encoded = self._encoded[doc['_id']]
+        return bson.decode(encoded, self.codec_options)
+
+    def _match(self, spec):
+        spec = spec or dict()
+        documents = self._documents
+        oid = spec.get('_id', _missing)
+        if oid is not _missing and not isinstance(oid, dict):
+            doc = documents.get(oid)
+            if doc is None or not _matches(doc, spec):
+                return list()
+            return [doc]
+        return [doc for doc in list(documents.values()) if _matches(doc, spec)]
+
+    # queries
+
+    def find(self, *args, **kwargs):
+        return MemoryCursor(self, *args, **kwargs)
+
+    def find_one(self, spec=None, *args, **kwargs):
+        if spec is not None and not isinstance(spec, dict):
+            spec = {'_id': spec}
+        for doc in self.find(spec, *args, **kwargs).limit(-1):
+            return doc
+        return None
+
+    def count_documents(self, spec, skip=0, limit=0, **kwargs):
+        count = max(0, len(self._match(spec)) - skip)
+        return min(count, limit) if limit else count
+
+    def aggregate(self, pipeline, allowDiskUse=None, batchSize=0, **kwargs):
+        with self._lock:
+            docs = [bson.decode(encoded) for encoded in self._encoded.values()]
+        results = _aggregate(self, docs, list(pipeline))
+        codec_options = self.codec_options
+        return MemoryCommandCursor(
+            (bson.decode(bson.encode(doc), codec_options) for doc in results),
+            batchSize)
+
+    def estimated_document_count(self, **kwargs):
+        return len(self._documents)
+
+    def count(self, spec=None, **kwargs):
+        return self.count_documents(spec)
+
+    # writes
+
+    def insert_one(self, document, **kwargs):
+        with self._lock:
+            if '_id' not in document:
+                document['_id'] = ObjectId()
+            if document['_id'] in self._documents:
+                raise DuplicateKeyError(
+                    'E11000 duplicate key error _id: %s' % document['_id'],
+                    11000)
+            self._check_unique(document)
+            self._store(document)
+        return InsertOneResult(document['_id'], True)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        self.bulk_write([InsertOne(doc) for doc in documents],
+                        ordered=ordered)
+        return InsertManyResult([doc['_id'] for doc in documents], True)
+
+    def replace_one(self, spec, replacement, upsert=False, **kwargs):
+        return self._update(spec, replacement, upsert, multi=False)
+
+    def update_one(self, spec, update, upsert=False, **kwargs):
+        return self._update(spec, update, upsert, multi=False)
+
+    def update_many(self, spec, update, upsert=False, **kwargs):
+        return self._update(spec, update, upsert, multi=True)
+
+    def _update(self, spec, update, upsert, multi):
+        with self._lock:
+            docs = self._match(spec)
+            if not multi:
+                docs = docs[:1]
+            modified = 0
+            for doc in docs:
+                _apply_update(doc, update)
+                self._check_update(doc)
+                encoded = bson.encode(doc)
+                modified += encoded != self._encoded[doc['_id']]
+                self._encoded[doc['_id']] = encoded
+            upserted_id = None
+            if not docs and upsert:
+                doc = dict((k, v) for k, v in spec.items()
+                           if not k.startswith('$') and
+                           not isinstance(v, dict))
+                doc.setdefault('_id', update.get('_id', ObjectId()))
+                _apply_update(doc, update, inserting=True)
+                self._check_unique(doc)
+                self._store(doc)
+                upserted_id = doc['_id']
+        raw = {'n': len(docs) or int(upserted_id is not None),
+               'nModified': modified,
+               'updatedExisting': bool(docs)}
+        if upserted_id is not None:
+            raw['upserted'] = upserted_id
+        return UpdateResult(raw, True)
+
+    def _check_update(self, doc):
+        """
+        _check_unique() for an updated document, which is put back as it
+        was stored when the update is rejected.
+        """
+        stored = self._encoded[doc['_id']]
+        try:
+            self._check_unique(doc)
+        except DuplicateKeyError:
+            doc.clear()
+            doc.update(bson.decode(stored))
+            raise
+
+    def find_one_and_update(self, spec, update, projection=None, sort=None,
+                            upsert=False,
+                            return_document=ReturnDocument.BEFORE, **kwargs):
+        with self._lock:
+            docs = self._match(spec)
+            if sort:
+                docs = list(MemoryCursor(self, spec, sort=sort)._documents())
+                docs = [self._documents[d['_id']] for d in docs]
+            if not docs:
+                if not upsert:
+                    return None
+                result = self._update(spec, update, True, False)
+                doc = self._documents[result.upserted_id]
+                if return_document == ReturnDocument.BEFORE:
+                    return None
+                return self._output(doc, projection)
+            doc = docs[0]
+            before = self._output(doc, projection)
+            _apply_update(doc, update)
+            self._check_update(doc)
+            self._encoded[doc['_id']] = bson.encode(doc)
+            if return_document == ReturnDocument.BEFORE:
+                return before
+            return self._output(doc, projection)
+
+    def delete_one(self, spec, **kwargs):
+        return self._delete(spec, multi=False)
+
+    def delete_many(self, spec, **kwargs):
+        return self._delete(spec, multi=True)
+
+    def _delete(self, spec, multi):
+        with self._lock:
+            docs = self._match(spec)
+            if not multi:
+                docs = docs[:1]
+            for doc in docs:
+                del self._documents[doc['_id']]
+                del self._encoded[doc['_id']]
+        return DeleteResult({'n': len(docs)}, True)
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        counts = dict(nInserted=0, nMatched=0, nModified=0, nRemoved=0,
+                      nUpserted=0, upserted=list(), writeErrors=list(),
+                      writeConcernErrors=list())
+        for index, request in enumerate(requests):
+            try:
+                if isinstance(request, InsertOne):
+                    self.insert_one(request._doc)
+                    counts['nInserted'] += 1
+                elif isinstance(request, (UpdateOne, UpdateMany,
+                                          ReplaceOne)):
+                    result = self._update(
+                        request._filter, request._doc, request._upsert,
+                        multi=isinstance(request, UpdateMany))
+                    if result.upserted_id is not None:
+                        counts['nUpserted'] += 1
+                        counts['upserted'].append(
+                            {'index': index, '_id': result.upserted_id})
+                    else:
+                        counts['nMatched'] += result.matched_count
+                        counts['nModified'] += result.modified_count
+                elif isinstance(request, (DeleteOne, DeleteMany)):
+                    result = self._delete(
+                        request._filter,
+                        multi=isinstance(request, DeleteMany))
+                    counts['nRemoved'] += result.deleted_count
+                else:
+                    raise TypeError('%r is not a valid request' % request)
+            except DuplicateKeyError as e:
+                counts['writeErrors'].append(
+                    {'index': index, 'code': 11000, 'errmsg': str(e),
+                     'op': getattr(request, '_doc', None)})
+                if ordered:
+                    break
+        if counts['writeErrors']:
+            raise BulkWriteError(counts)
+        return BulkWriteResult(counts, True)
+
+    # indexes
+
+    def create_indexes(self, indexes, **kwargs):
+        with self._lock:
+            return [self._create_index(index.document) for index in indexes]
+
+    def create_index(self, keys, **kwargs):
+        return self.create_indexes([IndexModel(keys, **kwargs)])[0]
+
+    def _create_index(self, document):
+        info = dict((k, v) for k, v in document.items() if k != 'name')
+        info['key'] = list(document['key'].items())
+        name = document['name']
+        indexes = self._indexes
+        for other_name, other in indexes.items():
+            if other_name == name and other != info:
+                raise OperationFailure(
+                    'An existing index has the same name as the requested '
+                    'index but different options: %s' % name, 86)
+            if other_name != name and other['key'] == info['key']:
+                raise OperationFailure(
+                    'Index already exists with a different name: %s' %
+                    other_name, 85)
+        if name in indexes:
+            return name
+        indexes[name] = info
+        try:
+            for doc in self._documents.values():
+                self._check_unique(doc)
+        except DuplicateKeyError:
+            del indexes[name]
+            raise
+        return name
+
+    def index_information(self):
+        return dict((name, dict(info))
+                    for name, info in self._indexes.items())
+
+    def list_indexes(self):
+        return iter([dict(info, name=name, key=OrderedDict(info['key']))
+                     for name, info in self._indexes.items()])
+
+    def drop_index(self, index_or_name):
+        name = index_or_name
+        if isinstance(name, (list, tuple)):
+            name = '_'.join('%s_%s' % pair for pair in index_or_name)
+        with self._lock:
+            if name == '_id_' or name not in self._indexes:
+                raise OperationFailure('index not found with name [%s]' %
+                                       name, 27)
+            del self._indexes[name]
+
+    def drop_indexes(self):
+        with self._lock:
+            for name in list(self._indexes):
+                if name != '_id_':
+                    del self._indexes[name]
+
+    # legacy pymongo methods
+
+    def insert(self, doc_or_docs, **kwargs):
+        if isinstance(doc_or_docs, list):
+            return [self.insert_one(doc).inserted_id for doc in doc_or_docs]
+        return self.insert_one(doc_or_docs).inserted_id
+
+    def save(self, document, **kwargs):
+        if '_id' not in document:
+            return self.insert(document)
+        self.replace_one({'_id': document['_id']}, document, upsert=True)
+        return document['_id']
+
+    def update(self, spec, update, upsert=False, multi=False, **kwargs):
+        return self._update(spec, update, upsert, multi).raw_result
+
+    def remove(self, spec_or_id=None, multi=True, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        return self._delete(spec_or_id or {}, multi=multi).raw_result
+
+    def watch(self, pipeline=None, **kwargs):
+        raise OperationFailure('The $changeStream stage is only supported '
+                               'on replica sets', 40573)
+
+    def drop(self):
+        self.database._drop(self.name)
+
+    def __getitem__(self, name):
+        return self.database['%s.%s' % (self.name, name)]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+
+class MemoryDatabase(object):
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self._collections = dict()
+        self._encoded = dict()
+        self._indexes = dict()
+
+    def _collection_data(self, name):
+        try:
+            return self._collections[name]
+        except KeyError:
+            return self._collections.setdefault(name, OrderedDict())
+
+    def _encoded_data(self, name):
+        try:
+            return self._encoded[name]
+        except KeyError:
+            return self._encoded.setdefault(name, dict())
+
+    def _index_data(self, name):
+        try:
+            return self._indexes[name]
+        except KeyError:
+            return self._indexes.setdefault(name, OrderedDict([
+                ('_id_', {'key': [('_id', ASCENDING)]})]))
+
+    def _drop(self, name):
+        self._collections.pop(name, None)
+        self._encoded.pop(name, None)
+        self._indexes.pop(name, None)
+
+    def __getitem__(self, name):
+        return MemoryCollection(self, name)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def get_collection(self, name, codec_options=None, **kwargs):
+        return MemoryCollection(self, name, codec_options)
+
+    def list_collection_names(self):
+        return list(self._collections)
+
+    def drop_collection(self, name):
+        self._drop(name)
+
+
+class MemoryClient(object):
+    """
+    Stands in for pymongo.MongoClient, connection arguments are ignored.
+    Writes are serialized by a lock shared by the client's collections.
+    """
+    def __init__(self, *args, **kwargs):
+        self._databases = dict()
+        self._lock = threading.RLock()
+
+    def __getitem__(self, name):
+        try:
+            return self._databases[name]
+        except KeyError:
+            return self._databases.setdefault(name, MemoryDatabase(self, name))
+
+    def get_database(self, name, **kwargs):
+        return self[name]
+
+    def list_database_names(self):
+        return list(self._databases)
+
+    def drop_database(self, name):
+        self._databases.pop(getattr(name, 'name', name), None)
+
+    def close(self):
+        pass
+
+
+class MemoryDBConnection(MongoDBConnection):
+    """
+    MongoDBConnection over a MemoryClient.
+    """
+    client_cls = MemoryClient
+    # Each connection holds its own data, forked processes keep a copy.
+    shared = False
+    reconnect_after_fork = False
+
+    def clone(self):
+        """
+        The connection itself, a forked process reads its own copy of the
+        data. The data is not shared with processes which are not forked.
+        """
+        return self
+
+    def __getstate__(self):
+        raise TypeError('MemoryDBConnection data can only be shared with '
+                        'forked processes')
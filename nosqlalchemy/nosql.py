@@ -1,124 +1,1365 @@
+import copy
+import datetime
+from abc import ABCMeta
+import decimal
 import time
 import sys
-
+import warnings
+from collections import namedtuple, OrderedDict
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+import bson
+from bson.codec_options import CodecOptions
+from bson.decimal128 import Decimal128
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
-from pymongo import MongoClient
+from bson.raw_bson import RawBSONDocument
+from pymongo import (
+    ASCENDING,
+    DeleteOne,
+    IndexModel,
+    InsertOne,
+    MongoClient,
+    ReadPreference,
+    ReplaceOne,
+    ReturnDocument,
+    UpdateMany,
+    UpdateOne,
+)
+from pymongo.errors import BulkWriteError
+from pymongo.read_concern import ReadConcern
+from pymongo.write_concern import WriteConcern
+
+from nosqlalchemy.cache import IdentityMap
+from nosqlalchemy.clients import registry
+from nosqlalchemy.events import OperationTimer
 
 
 __all__ = [
     'MongoSession',
     'Key',
+    'Integer',
+    'Float',
+    'Unicode',
+    'Boolean',
+    'DateTime',
+    'ObjectIdKey',
+    'Decimal',
+    'Binary',
+    'Index',
     'Collection',
     'SubCollection',
     'ListCollection',
+    'CompactSubCollection',
     'ObjectId',
     'LazyCollection',
-    'MongoDBConnection'
+    'MongoDBConnection',
+    'CollectionInstanceException',
+    'ValidationException',
+    'CollectionScanException',
+    'CollectionScanWarning',
+    'BulkResult',
+    'BulkWriteException'
 ]
 
 if sys.version_info >= (3, 0):
     unicode = str
 
 
+def _with_metaclass(meta, *bases):
+    """
+    Create a base class with a metaclass in a python 2 and 3 compatible way.
+    """
+    class metaclass(meta):
+        def __new__(cls, name, this_bases, namespace):
+            return meta(name, bases, namespace)
+    return type.__new__(metaclass, 'temporary_class', (), {})
+
+
+PendingWrite = namedtuple('PendingWrite',
+                          'collection_cls document method args snapshot')
+
+_BULK_OPERATIONS = {
+    'insert_one': InsertOne,
+    'replace_one': ReplaceOne,
+    'update_one': UpdateOne,
+    'update_many': UpdateMany,
+    'delete_one': DeleteOne,
+}
+
+
+class BulkResult(object):
+    """
+    The totals of a bulk write. errors holds (document, error) pairs for the
+    writes which failed, unprocessed the documents which were not written
+    because an ordered write stopped at an error.
+    """
+    def __init__(self):
+        self.inserted_count = 0
+        self.matched_count = 0
+        self.modified_count = 0
+        self.deleted_count = 0
+        self.upserted_count = 0
+        self.errors = list()
+        self.unprocessed = list()
+
+    def _add_counts(self, inserted, matched, modified, deleted, upserted):
+        self.inserted_count += inserted
+        self.matched_count += matched
+        self.modified_count += modified
+        self.deleted_count += deleted
+        self.upserted_count += upserted
+
+    def _add_bulk_result(self, bulk_result):
+        self._add_counts(bulk_result.inserted_count,
+                         bulk_result.matched_count,
+                         bulk_result.modified_count,
+                         bulk_result.deleted_count,
+                         bulk_result.upserted_count)
+
+
+class BulkWriteException(Exception):
+    def __init__(self, result):
+        super(BulkWriteException, self).__init__(
+            '%d writes failed, %d were not processed' % (
+                len(result.errors), len(result.unprocessed)))
+        self.result = result
+
+
 class MongoSession(object):
-    def __init__(self, client=None):
-        self.connection = client.connection
+    """
+    Writes go to the server as they are made, unless unit_of_work is set. In
+    that case add(), save(), remove() and update() are queued until flush(),
+    which sends them as bulk writes of batch_size operations, grouped by
+    collection class. add_all(), save_all() and remove_all() always use bulk
+    writes.
+
+    With identity_map, queries return the instance already loaded for an
+    _id while it is alive. cache, a DocumentCache, answers find_one({'_id':
+    ...}) without a round trip, the writes made through this session
+    invalidate it.
+
+    plan_check, 'warn' or 'raise', checks the query plan of every query of
+    the session, see Mquery.check_plan().
+
+    listeners are called with an OperationEvent after each operation of
+    the session and its queries, see nosqlalchemy.events.
+    """
+    def __init__(self, client=None, unit_of_work=False, batch_size=1000,
+                 ordered=True, identity_map=False, cache=None,
+                 plan_check=None, listeners=None):
+        self.client = client
+        self.unit_of_work = unit_of_work
+        self.batch_size = batch_size
+        self.ordered = ordered
+        self.pending = list()
+        self.identity_map = IdentityMap() if identity_map else None
+        self.cache = cache
+        self.plan_check = plan_check
+        self._checked_plans = set()
+        self._handles = dict()
+        self._handles_connection = None
+        self.listeners = list(listeners or ())
+
+    @property
+    def connection(self):
+        return self.client.connection
+
+    def pool_stats(self):
+        """
+        The connection pool usage of the session's client, see
+        nosqlalchemy.clients.PoolStats.snapshot(), with the pool settings
+        of the connection. Shared clients count the use of every session.
+        """
+        stats = self.client.pool_stats.snapshot()
+        for name in ('maxPoolSize', 'minPoolSize', 'waitQueueTimeoutMS'):
+            stats[name] = self.client.kwargs.get(name)
+        return stats
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def _timer(self, operation, collection_cls=None, spec=None):
+        return OperationTimer(self.listeners, operation, collection_cls,
+                              spec)
+
+    @staticmethod
+    def _identity_key(collection_cls, _id):
+        try:
+            hash(_id)
+        except TypeError:
+            return None
+        return (collection_cls.__database__,
+                collection_cls.__collection_name__, _id)
+
+    def invalidate(self, collection_obj):
+        """
+        Drop a document from the read cache.
+        """
+        key = self._identity_key(type(collection_obj),
+                                 collection_obj.get('_id'))
+        if self.cache is not None and key is not None:
+            self.cache.invalidate(key)
+
+    def _invalidate_collection(self, collection_cls):
+        if self.cache is not None:
+            self.cache.invalidate_collection(
+                collection_cls.__database__,
+                collection_cls.__collection_name__)
+
+    def _track(self, pending_write):
+        """
+        Keep the identity map and the read cache in line with a write.
+        """
+        collection_obj = pending_write.document
+        if collection_obj is None:
+            self._invalidate_collection(pending_write.collection_cls)
+            return
+        self.invalidate(collection_obj)
+        key = self._identity_key(type(collection_obj),
+                                 collection_obj.get('_id'))
+        if self.identity_map is None or key is None:
+            return
+        if pending_write.method == 'delete_one':
+            self.identity_map.discard(key)
+        elif collection_obj.loaded_fields is None:
+            self.identity_map.add(key, collection_obj)
+
+    def _get_handles(self, collection_cls):
+        """
+        The (database, collection) handles of a Collection class, with the
+        options the class declares. They are resolved once per session, and
+        again when the client changed, after a fork.
+        """
+        connection = self.connection
+        if connection is not self._handles_connection:
+            self._handles = dict()
+            self._handles_connection = connection
+        try:
+            return self._handles[collection_cls]
+        except KeyError:
+            pass
+        database = connection[collection_cls.__database__]
+        options = _collection_options(collection_cls)
+        if options:
+            collection = database.get_collection(
+                collection_cls.__collection_name__, **options)
+        else:
+            collection = database[collection_cls.__collection_name__]
+        handles = self._handles[collection_cls] = (database, collection)
+        return handles
 
     def _get_collection_from_object(self, collection_obj):
-        database = self.connection[collection_obj.__database__]
-        return database[collection_obj.__collection_name__]
+        if not isinstance(collection_obj, type):
+            collection_obj = type(collection_obj)
+        return self._get_handles(collection_obj)[1]
 
     def query(self, collection_cls=None):
     ## TODO, verification of collection_cls. __mro__ ?
-        return Mquery(self.connection, collection_cls)
+        return Mquery(self.connection, collection_cls, self)
 
-    def add(self, collection_obj):
-        database = self.connection[collection_obj.__database__]
-        collection = database[collection_obj.__collection_name__]
+    def _add_write(self, collection_obj):
+        if collection_obj.loaded_fields is not None:
+            raise CollectionInstanceException(
+                'Partial documents can not be added, use save().')
+        collection_obj.materialize()
+        collection_obj.validate()
         now = time.time()
         collection_obj.time_created = now
         if not isinstance(collection_obj.time_updated, (int, float)):
             collection_obj.time_updated = now
-        return collection.insert(collection_obj)
+        if collection_obj.get('_id') is None:
+            collection_obj._id = ObjectId()
+        return PendingWrite(type(collection_obj), collection_obj,
+                            'insert_one', (collection_obj,),
+                            collection_obj._take_snapshot())
 
-    def save(self, collection_obj):
-        database = self.connection[collection_obj.__database__]
-        collection = database[collection_obj.__collection_name__]
+    def _save_write(self, collection_obj):
+        """
+        Documents which were loaded or saved before send the $set, $unset
+        and $push of their changes, or nothing when they are unchanged.
+        Partial documents only ever update the keys they hold.
+        """
+        collection_obj.materialize()
+        collection_obj.validate()
+        update = collection_obj.changes()
+        if update is not None:
+            return self._update_write(collection_obj, update)
         now = time.time()
         # Possible bug, we would never try to save time_created
         if not collection_obj.time_created:
             collection_obj.time_created = now
         collection_obj.time_updated = now
-        return collection.save(collection_obj)
+        if collection_obj.get('_id') is None:
+            collection_obj._id = ObjectId()
+            return PendingWrite(type(collection_obj), collection_obj,
+                                'insert_one', (collection_obj,),
+                                collection_obj._take_snapshot())
+        return PendingWrite(type(collection_obj), collection_obj,
+                            'replace_one',
+                            ({'_id': collection_obj._id}, collection_obj,
+                             True),
+                            collection_obj._take_snapshot())
+
+    def _update_write(self, collection_obj, update):
+        if not update:
+            return None
+        if collection_obj.get('_id') is None:
+            raise CollectionInstanceException(
+                'This instance is not mapped to an _id.')
+        now = time.time()
+        stamps = dict(time_updated=now)
+        if collection_obj.loaded_fields is None and \
+                not collection_obj.time_created:
+            stamps['time_created'] = now
+        for key, value in stamps.items():
+            setattr(collection_obj, key, value)
+            update.get('$unset', dict()).pop(key, None)
+        update.setdefault('$set', dict()).update(stamps)
+        if '$unset' in update and not update['$unset']:
+            del update['$unset']
+        return PendingWrite(type(collection_obj), collection_obj,
+                            'update_one',
+                            ({'_id': collection_obj._id}, update),
+                            collection_obj._take_snapshot())
+
+    def _remove_write(self, collection_obj):
+        snapshot = collection_obj._snapshot
+        object.__setattr__(collection_obj, '_snapshot', None)
+        return PendingWrite(type(collection_obj), collection_obj,
+                            'delete_one', ({'_id': collection_obj._id},),
+                            snapshot)
+
+    @staticmethod
+    def _restore_snapshot(pending_write):
+        """
+        The write failed, the document changes are still unsaved.
+        """
+        if pending_write.document is not None:
+            object.__setattr__(pending_write.document, '_snapshot',
+                               pending_write.snapshot)
+
+    def _write(self, pending_write):
+        if pending_write is None:
+            return None
+        if self.unit_of_work:
+            self.pending.append(pending_write)
+            self._track(pending_write)
+            return None
+        collection = self._get_collection_from_object(
+            pending_write.collection_cls)
+        try:
+            result = getattr(collection, pending_write.method)(
+                *pending_write.args)
+        except Exception:
+            self._restore_snapshot(pending_write)
+            raise
+        self._track(pending_write)
+        return result
+
+    @staticmethod
+    def _write_timer_start(timer, args):
+        target = args[0]
+        timer.collection_cls = target if isinstance(target, type) \
+            else type(target)
+
+    @staticmethod
+    def _write_timer_prepared(timer, pending_write):
+        """
+        Describe a prepared write on its timer, the time so far was spent
+        preparing it.
+        """
+        timer.hydration()
+        if pending_write is None:
+            return
+        if pending_write.method != 'insert_one':
+            timer.spec = pending_write.args[0]
+        document = pending_write.document
+        if document is not None:
+            timer.count = 1
+            timer.bytes = len(document._snapshot or b'')
+
+    def _write_one(self, operation, prepare, *args):
+        """
+        Prepare a write with prepare(*args) and send it, timed when the
+        session has listeners.
+        """
+        if not self.listeners:
+            return self._write(prepare(*args))
+        with self._timer(operation) as timer:
+            self._write_timer_start(timer, args)
+            pending_write = prepare(*args)
+            self._write_timer_prepared(timer, pending_write)
+            result = self._write(pending_write)
+            timer.driver()
+            return result
+
+    def add(self, collection_obj):
+        self._write_one('add', self._add_write, collection_obj)
+        return collection_obj._id
+
+    def save(self, collection_obj):
+        self._write_one('save', self._save_write, collection_obj)
+        return collection_obj._id
 
     def remove(self, collection_obj):
-        collection = self._get_collection_from_object(collection_obj)
-        collection.remove({'_id': collection_obj._id})
+        self._write_one('remove', self._remove_write, collection_obj)
+
+    def add_all(self, collection_objs):
+        return self._write_all(
+            (self._add_write(obj) for obj in collection_objs), 'add_all')
+
+    def save_all(self, collection_objs):
+        return self._write_all(
+            (self._save_write(obj) for obj in collection_objs), 'save_all')
+
+    def remove_all(self, collection_objs):
+        return self._write_all(
+            (self._remove_write(obj) for obj in collection_objs),
+            'remove_all')
+
+    def _write_all(self, pending_writes, operation='bulk_write'):
+        pending_writes = (pw for pw in pending_writes if pw is not None)
+        if self.unit_of_work:
+            self.pending.extend(pending_writes)
+            return None
+        return self._bulk_write(pending_writes, operation=operation)
+
+    def flush(self, ordered=None):
+        """
+        Send the writes queued by unit_of_work mode, returns a BulkResult.
+        """
+        pending, self.pending = self.pending, list()
+        return self._bulk_write(pending, ordered, 'flush')
+
+    @staticmethod
+    def _batch_event(timer, batch, error=None):
+        """
+        Send the event of a batch, the time since the previous batch was
+        spent preparing it.
+        """
+        if timer is None:
+            return
+        timer.driver()
+        timer.collection_cls = batch[0].collection_cls
+        timer.count = len(batch)
+        timer.bytes = sum(len(pw.document._snapshot or b'') for pw in batch
+                          if pw.document is not None)
+        timer.error = error
+        timer.emit()
+
+    def _bulk_write(self, pending_writes, ordered=None,
+                    operation='bulk_write'):
+        """
+        Send writes as bulk_write batches of batch_size operations per
+        collection class, raises BulkWriteException with the per document
+        errors when any write fails. Writes are ordered within their
+        collection class only.
+        """
+        if ordered is None:
+            ordered = self.ordered
+        timer = self._timer(operation) if self.listeners else None
+        result = BulkResult()
+        batches = OrderedDict()
+        pending_writes = iter(pending_writes)
+        for pending_write in pending_writes:
+            batch = batches.setdefault(pending_write.collection_cls, list())
+            batch.append(pending_write)
+            if len(batch) >= self.batch_size:
+                del batches[pending_write.collection_cls]
+                if not self._write_batch(batch, ordered, result, timer):
+                    for pw in pending_writes:
+                        result.unprocessed.append(pw.document)
+                        self._restore_snapshot(pw)
+                    break
+        else:
+            for collection_cls, batch in list(batches.items()):
+                del batches[collection_cls]
+                if not self._write_batch(batch, ordered, result, timer):
+                    break
+        for batch in batches.values():
+            result.unprocessed.extend(pw.document for pw in batch)
+            for pw in batch:
+                self._restore_snapshot(pw)
+        if result.errors:
+            raise BulkWriteException(result)
+        return result
+
+    def _write_batch(self, batch, ordered, result, timer=None):
+        collection = self._get_collection_from_object(batch[0].collection_cls)
+        requests = self._batch_requests(batch)
+        if timer is not None:
+            timer.hydration()
+        try:
+            bulk_result = collection.bulk_write(requests, ordered=ordered)
+        except BulkWriteError as e:
+            self._batch_event(timer, batch, e)
+            return self._batch_errors(batch, ordered, result, e.details)
+        except Exception as e:
+            self._batch_event(timer, batch, e)
+            for pw in batch:
+                self._restore_snapshot(pw)
+            raise
+        self._batch_event(timer, batch)
+        result._add_bulk_result(bulk_result)
+        return True
+
+    def _batch_requests(self, batch):
+        for pw in batch:
+            self._track(pw)
+        return [_BULK_OPERATIONS[pw.method](*pw.args) for pw in batch]
+
+    def _batch_errors(self, batch, ordered, result, details):
+        """
+        Record the write errors of a batch, returns False when an ordered
+        batch stopped at an error.
+        """
+        result._add_counts(details['nInserted'], details['nMatched'],
+                           details['nModified'], details['nRemoved'],
+                           details['nUpserted'])
+        for error in details['writeErrors']:
+            result.errors.append((batch[error['index']].document, error))
+            self._restore_snapshot(batch[error['index']])
+        if ordered and details['writeErrors']:
+            last = details['writeErrors'][-1]['index']
+            for pw in batch[last + 1:]:
+                result.unprocessed.append(pw.document)
+                self._restore_snapshot(pw)
+            return False
+        return True
 
     def drop_all(self, collection_cls):
-        collection = self._get_collection_from_object(collection_cls())
-        collection.delete_many({})
+        collection = self._get_collection_from_object(collection_cls)
+        if self.listeners:
+            with self._timer('drop_all', collection_cls, {}) as timer:
+                collection.delete_many({})
+                timer.driver()
+        else:
+            collection.delete_many({})
+        self._invalidate_collection(collection_cls)
 
-    def update(self, collection_cls, update_spec, update_data, multi=False):
+    def export(self, collection_cls, path, format='bson', compression='infer',
+               spec=None, after=None, batch_size=1000, checkpoint=None):
+        """
+        Stream the documents of collection_cls to a bson or ndjson file,
+        see nosqlalchemy.transfer.export().
+        """
+        from nosqlalchemy.transfer import export
+
+        return export(self, collection_cls, path, format, compression, spec,
+                      after, batch_size, checkpoint)
+
+    def import_(self, collection_cls, path, format=None, compression='infer',
+                batch_size=1000, window=2, validate=False, replace=False,
+                after=None, checkpoint=None):
+        """
+        Bulk insert the documents of an exported file, see
+        nosqlalchemy.transfer.import_().
+        """
+        from nosqlalchemy.transfer import import_
+
+        return import_(self, collection_cls, path, format, compression,
+                       batch_size, window, validate, replace, after,
+                       checkpoint)
+
+    def watch(self, collection_cls, filter=None, operations=None,
+              pipeline=None, full_document=None, resume_after=None,
+              start_after=None, start_at_operation_time=None,
+              batch_size=None, max_await_time_ms=None, apply=None):
+        """
+        A ChangeStream of the changes to the documents of collection_cls,
+        see nosqlalchemy.changestreams.
+        """
+        from nosqlalchemy.changestreams import ChangeStream
+
+        return ChangeStream(self, collection_cls, filter, operations,
+                            pipeline, full_document, resume_after,
+                            start_after, start_at_operation_time, batch_size,
+                            max_await_time_ms, apply)
+
+    @staticmethod
+    def _index_models(collection_cls):
+        return [index.model() for index in collection_cls.indexes()]
+
+    def ensure_indexes(self, collection_cls):
+        """
+        Create the indexes declared by collection_cls, see
+        Collection.indexes(), returns their names. Indexes which exist
+        with the same definition are left as they are, so it is safe to
+        call on every start. An index which exists with other options
+        raises pymongo's OperationFailure.
+        """
+        models = self._index_models(collection_cls)
+        if not models:
+            return list()
         collection = self._get_collection_from_object(collection_cls)
-        update_data.update(dict(time_updated=time.time()))
-        return collection.update(update_spec, {'$set': update_data},
-                                 multi=multi)
+        return collection.create_indexes(models)
+
+    @staticmethod
+    def _mass_update_write(collection_cls, update_spec, update_data, multi):
+        update_data = dict(update_data, time_updated=time.time())
+        return PendingWrite(
+            collection_cls, None, 'update_many' if multi else 'update_one',
+            (update_spec, {'$set': update_data}), None)
+
+    @staticmethod
+    def _operator_update_write(collection_cls, update_spec, update, upsert):
+        return PendingWrite(collection_cls, None, 'update_many',
+                            (update_spec, update, upsert), None)
+
+    def update(self, collection_cls, update_spec, update_data, multi=False):
+        result = self._write_one('update', self._mass_update_write,
+                                 collection_cls, update_spec, update_data,
+                                 multi)
+        if result is not None:
+            return result.raw_result
+
+
+def _find_one_spec(kw):
+    """
+    find_one() takes a spec or, like pymongo, the _id of the document.
+    """
+    if kw is None:
+        return dict()
+    if not isinstance(kw, Mapping):
+        return {'_id': kw}
+    return kw
 
 
 class Mquery(object):
-    def __init__(self, connection, col):
+    """
+    A chainable query over a Collection class.
+
+    filter(), sort(), limit(), skip(), batch_size(), hint(), only() and
+    lazy() return a new Mquery, the pymongo cursor is created when the query
+    is iterated:
+
+    query = session.query(User).filter({User.email: email}).sort(User.name)
+    for user in query.limit(10):
+        ...
+    """
+    def __init__(self, connection, col, session=None):
         self.connection = connection
+        self.session = session
         self.col = col
-        self.col_name = self.col().__collection_name__
-        self.database_name = self.col.__database__
-        self.database = self.connection[self.database_name]
-        self.collection = self.database[self.col_name]
+        self.col_name = col.__collection_name__
+        self.database_name = col.__database__
+        if session is not None:
+            self.database, self.collection = session._get_handles(col)
+        else:
+            self.database = connection[self.database_name]
+            self.collection = self.database[self.col_name]
+        self.lazy_hydration = False
+        self.loaded_fields = None
+        # loaded_fields in the order they were given
+        self.loaded_names = None
+        self.spec = dict()
+        self.sort_keys = list()
+        self.limit_count = 0
+        self.skip_count = 0
+        self.batch_size_count = 0
+        self.index_hint = None
+        self.read_preference_mode = None
+        self.plan_check = getattr(session, 'plan_check', None)
+
+    def _clone(self):
+        query = copy.copy(self)
+        query.spec = dict(self.spec)
+        query.sort_keys = list(self.sort_keys)
+        return query
+
+    def _key_name(self, field):
+        if isinstance(field, Key):
+            if getattr(self.col, field.name, None) is not field:
+                raise ValueError('%s is not a key of %s' % (
+                    field.name, self.col.__name__))
+            return field.name
+        return field
+
+    def lazy(self):
+        """
+        Leave the nested collections of results as decoded data until they
+        are first accessed as attributes.
+        """
+        query = self._clone()
+        query.lazy_hydration = True
+        return query
+
+    def only(self, *fields):
+        """
+        Only load the given keys, as names or Key class attributes.
+
+        Results are partial documents, see Collection.loaded_fields.
+        """
+        names = ['_id']
+        for field in fields:
+            name = self._key_name(field)
+            if name not in self.col.__schema__.keys:
+                raise ValueError('%s is not a key of %s' % (
+                    name, self.col.__name__))
+            if name not in names:
+                names.append(name)
+        query = self._clone()
+        query.loaded_fields = frozenset(names)
+        query.loaded_names = tuple(names)
+        return query
+
+    def filter(self, spec=None, **kwargs):
+        """
+        Add conditions to the query spec. Keys may be given as Key class
+        attributes, conditions on a key which is already filtered are
+        combined with $and.
+        """
+        conditions = dict(spec or {}, **kwargs)
+        conditions = dict((self._key_name(k), v)
+                          for k, v in conditions.items())
+        query = self._clone()
+        if set(conditions).intersection(query.spec):
+            query.spec = {'$and': [query.spec, conditions]}
+        else:
+            query.spec.update(conditions)
+        return query
+
+    def sort(self, key_or_list, direction=ASCENDING):
+        """
+        Add sort keys, as a key and direction or a list of (key, direction)
+        pairs, the same as pymongo.
+        """
+        if not isinstance(key_or_list, list):
+            key_or_list = [(key_or_list, direction)]
+        query = self._clone()
+        for key, key_direction in key_or_list:
+            key = self._key_name(key)
+            query.sort_keys = [(k, d) for k, d in query.sort_keys if k != key]
+            query.sort_keys.append((key, key_direction))
+        return query
+
+    def limit(self, limit):
+        query = self._clone()
+        query.limit_count = limit
+        return query
+
+    def skip(self, skip):
+        query = self._clone()
+        query.skip_count = skip
+        return query
+
+    def batch_size(self, batch_size):
+        query = self._clone()
+        query.batch_size_count = batch_size
+        return query
+
+    def hint(self, index):
+        """
+        Force the index used by the query, an index name or a list of
+        (key, direction) pairs.
+        """
+        if isinstance(index, list):
+            index = [(self._key_name(k), d) for k, d in index]
+        query = self._clone()
+        query.index_hint = index
+        return query
+
+    def read_preference(self, preference):
+        """
+        Read from the servers chosen by preference, a mode name, one of
+        primary, primaryPreferred, secondary, secondaryPreferred or
+        nearest, or a pymongo read preference for tag sets and maximum
+        staleness. Secondaries may lag behind the primary.
+        """
+        if not hasattr(preference, 'mongos_mode'):
+            if preference not in _READ_PREFERENCES:
+                raise ValueError('read preference is one of %s' % ', '.join(
+                    _READ_PREFERENCES))
+            preference = _READ_PREFERENCES[preference]
+        query = self._clone()
+        query.read_preference_mode = preference
+        return query
+
+    def after(self, object_id, direction=ASCENDING):
+        """
+        Range based pagination, the documents after object_id in _id order.
+        """
+        operator = '$gt' if direction == ASCENDING else '$lt'
+        return self.filter({'_id': {operator: object_id}}).sort(
+            '_id', direction)
+
+    def pages(self, page_size, direction=ASCENDING):
+        """
+        generator of lists of up to page_size Collection objects.
+
+        Each page is a range query on _id following the last page, which
+        stays fast where deep skip() calls have to walk every skipped
+        document.
+        """
+        if [k for k, d in self.sort_keys if k != '_id']:
+            raise ValueError('pages() can only order by _id')
+        first = self.sort('_id', direction).limit(page_size)
+        query = first
+        while True:
+            page = list(query)
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            # bound the first query, so the spec does not nest a level per
+            # page
+            query = first.skip(0).after(page[-1]['_id'], direction)
+
+    def _columns(self, fields, dtypes):
+        from nosqlalchemy.columns import column_dtype
+
+        paths = list()
+        column_dtypes = dict()
+        for field in fields:
+            path = self._key_name(field)
+            if path.split('.')[0] not in self.col.__schema__.keys:
+                raise ValueError('%s is not a key of %s' % (
+                    path, self.col.__name__))
+            paths.append(path)
+            dtype = column_dtype(getattr(self.col, path, None))
+            if dtype is not None:
+                column_dtypes[path] = dtype
+        for field, dtype in (dtypes or dict()).items():
+            column_dtypes[self._key_name(field)] = dtype
+        return paths, column_dtypes
+
+    def parallel_scan(self, fn, workers=None, reduce=None, ranges=None,
+                      start_method=None):
+        """
+        Apply fn to every result in worker processes, see
+        nosqlalchemy.parallel.parallel_scan().
+        """
+        from nosqlalchemy.parallel import parallel_scan
+
+        return parallel_scan(self, fn, workers, reduce, ranges, start_method)
+
+    def to_columns(self, fields, batch_size=10000, dtypes=None):
+        """
+        generator of OrderedDicts mapping each of fields to a numpy masked
+        array of the next batch_size results.
+
+        fields are Key class attributes or key names, dotted paths reach
+        into nested collections. Only those fields are read from the server
+        and no Collection objects are built. Arrays take their dtype from
+        dtypes, a dict of fields to numpy dtypes, or from the data_type of
+        the Key, the others are inferred from each batch. Missing and None
+        values are masked. Requires numpy.
+        """
+        from nosqlalchemy.columns import iter_columns
+
+        paths, column_dtypes = self._columns(fields, dtypes)
+        projection = dict.fromkeys(paths, 1)
+        if '_id' not in projection:
+            projection['_id'] = 0
+        return iter_columns(self.cursor(projection=projection), paths,
+                            column_dtypes, batch_size)
+
+    def to_numpy(self, fields, batch_size=10000, dtypes=None):
+        """
+        OrderedDict mapping each of fields to a numpy masked array of all
+        the results, see to_columns().
+        """
+        from nosqlalchemy.columns import concatenate_columns
+
+        paths, column_dtypes = self._columns(fields, dtypes)
+        return concatenate_columns(
+            self.to_columns(paths, batch_size, column_dtypes), paths,
+            column_dtypes)
+
+    @property
+    def projection(self):
+        if self.loaded_fields is None:
+            return None
+        return dict.fromkeys(self.loaded_fields, 1)
+
+    def check_plan(self, action='warn'):
+        """
+        Explain the query before it runs, and warn with
+        CollectionScanWarning, or raise CollectionScanException when action
+        is 'raise', when its plan scans the whole collection instead of
+        using an index. None turns the check off.
+
+        This costs a round trip, it is meant for development and tests.
+        Each query shape, the keys and operators of the filter and the sort,
+        is checked once per session. Queries without a filter or a sort are
+        full scans by design and are not checked.
+        """
+        if action not in (None, 'warn', 'raise'):
+            raise ValueError('action is one of None, warn or raise')
+        query = self._clone()
+        query.plan_check = action
+        return query
+
+    def explain(self):
+        """
+        The explain() output of this query.
+        """
+        return self._cursor().explain()
+
+    def _plan_shape(self):
+        """
+        The shape of this query when its plan should be checked, None when
+        it needs no check.
+        """
+        if not self.plan_check or not (self.spec or self.sort_keys):
+            return None
+        shape = (self.database_name, self.col_name, _query_shape(self.spec),
+                 tuple(self.sort_keys))
+        checked = getattr(self.session, '_checked_plans', None)
+        if checked is not None and shape in checked:
+            return None
+        return shape
+
+    def _report_plan(self, shape, explain):
+        """
+        Raise or warn when explain shows a collection scan. Shapes which
+        raised are checked again the next time they run.
+        """
+        message = None
+        if _has_stage(explain.get('queryPlanner', explain), 'COLLSCAN'):
+            message = 'query on %s.%s scans the collection, ' \
+                'filter %r sort %r' % (self.database_name, self.col_name,
+                                       self.spec, self.sort_keys)
+            if self.plan_check == 'raise':
+                raise CollectionScanException(message)
+        checked = getattr(self.session, '_checked_plans', None)
+        if checked is not None:
+            checked.add(shape)
+        if message is not None:
+            warnings.warn(message, CollectionScanWarning, stacklevel=5)
+
+    def _verify_plan(self):
+        shape = self._plan_shape()
+        if shape is not None:
+            self._report_plan(shape, self.explain())
+
+    def cursor(self, raw=False, projection=None):
+        """
+        The pymongo cursor for this query. With raw, it yields
+        RawBSONDocument objects, the undecoded BSON of the results.
+        projection replaces the projection of only().
+        """
+        if self.plan_check:
+            self._verify_plan()
+        return self._cursor(raw, projection)
+
+    def _read_collection(self, raw=False):
+        """
+        The collection with the read preference of the query, decoding
+        RawBSONDocument objects with raw.
+        """
+        collection = self.collection
+        options = dict()
+        if raw:
+            options['codec_options'] = collection.codec_options.with_options(
+                document_class=RawBSONDocument)
+        if self.read_preference_mode is not None:
+            options['read_preference'] = self.read_preference_mode
+        if options:
+            collection = collection.with_options(**options)
+        return collection
+
+    def _cursor(self, raw=False, projection=None):
+        collection = self._read_collection(raw)
+        if projection is None:
+            projection = self.projection
+        cursor = collection.find(self.spec, projection)
+        if self.sort_keys:
+            cursor = cursor.sort(self.sort_keys)
+        if self.skip_count:
+            cursor = cursor.skip(self.skip_count)
+        if self.limit_count:
+            cursor = cursor.limit(self.limit_count)
+        if self.batch_size_count:
+            cursor = cursor.batch_size(self.batch_size_count)
+        if self.index_hint is not None:
+            cursor = cursor.hint(self.index_hint)
+        return cursor
+
+    def _load(self, data):
+        """
+        Hydrate a result. Results are read as RawBSONDocument, decoded
+        straight into the document, and their BSON is kept as the snapshot
+        of the document without encoding it again.
+        """
+        raw = None
+        if data.__class__ is RawBSONDocument:
+            raw = data.raw
+            data = bson.decode(raw, self.collection.codec_options)
+        identity_map = getattr(self.session, 'identity_map', None)
+        if identity_map is None or self.loaded_fields is not None:
+            return self.col._load(self.session, data, self.lazy_hydration,
+                                  self.loaded_fields, raw)
+        key = self.session._identity_key(self.col, data.get('_id'))
+        inst = identity_map.get(key) if key is not None else None
+        if not isinstance(inst, self.col):
+            inst = self.col._load(self.session, data, self.lazy_hydration,
+                                  raw=raw)
+            if key is not None:
+                identity_map.add(key, inst)
+        return inst
+
+    def _cache_key(self, kw):
+        """
+        The read cache key of a find_one lookup by _id.
+        """
+        cache = getattr(self.session, 'cache', None)
+        if cache is None or self.loaded_fields is not None or self.spec or \
+                self.skip_count or not isinstance(kw, dict) or \
+                list(kw) != ['_id'] or isinstance(kw['_id'], dict):
+            return None
+        return self.session._identity_key(self.col, kw['_id'])
+
+    def _listeners(self):
+        return getattr(self.session, 'listeners', None)
+
+    def __iter__(self):
+        if self._listeners():
+            return self._timed_iter()
+        return self._iter()
+
+    def _iter(self):
+        load = self._load
+        for item in self.cursor(raw=True):
+            yield load(item)
+
+    def _timed_iter(self):
+        load = self._load
+        with self.session._timer('find', self.col, self.spec) as timer:
+            for item in self.cursor(raw=True):
+                timer.driver()
+                instance = load(item)
+                timer.hydration()
+                timer.count += 1
+                timer.bytes += len(item.raw)
+                yield instance
+                timer.restart()
+            timer.driver()
 
     def all(self):
         """
         generator of baked Collection objects.
         """
-        for item in self.collection.find():
-            inst = self.col(self.database, **item)
-            yield inst
+        return iter(self)
 
-    def find_one(self, kw):
-        data = self.collection.find_one(kw)
-        if data:
-            return self.col(self.database, **data)
+    def _find_one_raw(self, kw):
+        """
+        The RawBSONDocument of the first result, from the read cache when it
+        holds it.
+        """
+        cache_key = self._cache_key(kw)
+        if cache_key is not None:
+            raw = self.session.cache.get(cache_key)
+            if raw is not None:
+                return RawBSONDocument(raw)
+        for data in self.filter(kw).limit(1).cursor(raw=True):
+            if cache_key is not None:
+                self.session.cache.put(cache_key, data.raw)
+            return data
         return None
 
+    def find_one(self, kw):
+        kw = _find_one_spec(kw)
+        if not self._listeners():
+            data = self._find_one_raw(kw)
+            return None if data is None else self._load(data)
+        with self.session._timer('find_one', self.col,
+                                 self.filter(kw).spec) as timer:
+            data = self._find_one_raw(kw)
+            timer.driver()
+            if data is None:
+                return None
+            timer.count = 1
+            timer.bytes = len(data.raw)
+            instance = self._load(data)
+            timer.hydration()
+            return instance
+
     def find(self, kw):
-        data = self.collection.find(kw)
-        for item in data:
-            inst = self.col(self.database, **item)
-            yield inst
+        return iter(self.filter(kw))
 
-    def remove(self, kw):
-        return self.collection.remove(kw)
+    def _remove_spec(self, kw):
+        if self.skip_count or self.limit_count:
+            raise ValueError('remove() deletes every match, the query can '
+                             'not have a skip or a limit')
+        return self.filter(kw).spec if kw else self.spec
+
+    def remove(self, kw=None):
+        """
+        Delete every match of the query, and of kw when it is given.
+        """
+        spec = self._remove_spec(kw)
+        if self._listeners():
+            with self.session._timer('delete_many', self.col, spec) as timer:
+                result = self.collection.delete_many(spec)
+                timer.driver()
+                timer.count = result.deleted_count
+            result = result.raw_result
+        else:
+            result = self.collection.delete_many(spec).raw_result
+        if self.session is not None:
+            self.session._invalidate_collection(self.col)
+        return result
 
     def count(self, kw=None):
-        if not kw:
-            return self.collection.count()
-        return self.collection.find(kw).count()
+        spec = self.filter(kw).spec if kw else self.spec
+        if self._listeners():
+            with self.session._timer('count', self.col, spec) as timer:
+                count = self._count(spec)
+                timer.driver()
+            return count
+        return self._count(spec)
+
+    def _count(self, spec):
+        """
+        Without a filter the count is read from the collection metadata,
+        filtered counts run the count_documents aggregation.
+        """
+        collection = self._read_collection()
+        if not spec:
+            return collection.estimated_document_count()
+        return collection.count_documents(spec)
+
+    def _update_args(self, arguments, upsert):
+        if self.skip_count or self.limit_count:
+            raise ValueError('update() changes every match, the query can '
+                             'not have a skip or a limit')
+        return (self.session._operator_update_write, self.col, self.spec,
+                _compile_update(self.col, arguments, upsert), upsert)
+
+    def update(self, set=None, unset=None, inc=None, push=None,
+               add_to_set=None, pull=None, min=None, max=None,
+               current_date=None, upsert=False):
+        """
+        Change every match on the server with a single update_many:
+
+        query.filter({Post.slug: slug}).update(inc={Post.views: 1},
+                                               push={Post.tags: 'new'})
+
+        Each argument maps keys, as Key class attributes or (dotted) names,
+        to the operand of its update operator: $set, $inc, $push,
+        $addToSet, $pull, $min and $max. unset and current_date may also
+        be lists of keys. Paths are checked against the schema, values of
+        typed keys are validated. time_updated is set, and with upsert
+        time_created of an inserted document.
+
+        Returns the pymongo UpdateResult, with matched_count,
+        modified_count and upserted_id, or None when the session queues
+        writes, see MongoSession.
+        """
+        arguments = dict(set=set, unset=unset, inc=inc, push=push,
+                         add_to_set=add_to_set, pull=pull, min=min, max=max,
+                         current_date=current_date)
+        return self.session._write_one(
+            'update', *self._update_args(arguments, upsert))
+
+    def aggregate(self):
+        """
+        An aggregation pipeline starting with the filter, sort, skip, limit
+        and only() of this query, see nosqlalchemy.aggregation.
+        """
+        from nosqlalchemy.aggregation import Aggregation
+
+        return Aggregation(self)
+
+
+def _query_shape(value):
+    """
+    A query spec with its values left out, keeping keys and operators.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, _query_shape(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_query_shape(v) for v in value)
+    return None
+
+
+def _has_stage(plan, stage):
+    """
+    Whether an explain() plan, or any of its nested plans, has stage.
+    """
+    if isinstance(plan, dict):
+        if plan.get('stage') == stage:
+            return True
+        plan = list(plan.values())
+    if isinstance(plan, list):
+        return any(_has_stage(value, stage) for value in plan)
+    return False
 
 
 class MongoDBConnection(object):
     """
     pymongo bindings interface.
-    """
 
-    def __init__(self, host_or_url='127.0.0.1:27017', replica_set='', **kwargs):
-        if replica_set:
-            self.connection = MongoClient(host_or_url,
-                                          replicaSet=replica_set, **kwargs)
+    Connections for the same servers and options share one client, see
+    nosqlalchemy.clients, unless shared is False. The pool settings
+    max_pool_size, min_pool_size, wait_queue_timeout_ms and compressors, a
+    list such as ['zstd', 'snappy'], are passed to the client as
+    maxPoolSize, minPoolSize, waitQueueTimeoutMS and compressors.
+    read_preference, a mode name such as 'secondaryPreferred' or a pymongo
+    read preference, is where queries read from unless they choose
+    otherwise, see Mquery.read_preference().
+
+    The client is opened again in a forked process the first time the
+    connection is used there.
+    """
+    client_cls = MongoClient
+    registry = registry
+    shared = True
+    # Whether a forked process opens its own client.
+    reconnect_after_fork = True
+
+    def __init__(self, host_or_url='127.0.0.1:27017', replica_set='',
+                 max_pool_size=None, min_pool_size=None,
+                 wait_queue_timeout_ms=None, compressors=None,
+                 read_preference=None, shared=None, **kwargs):
+        self.host_or_url = host_or_url
+        self.replica_set = replica_set
+        for name, value in [('maxPoolSize', max_pool_size),
+                            ('minPoolSize', min_pool_size),
+                            ('waitQueueTimeoutMS', wait_queue_timeout_ms),
+                            ('compressors', compressors),
+                            ('readPreference', read_preference)]:
+            if value is not None:
+                kwargs[name] = value
+        if hasattr(kwargs.get('readPreference'), 'mongos_mode'):
+            kwargs.update(_read_preference_options(kwargs['readPreference']))
+        self.kwargs = kwargs
+        self._released = False
+        if shared is not None:
+            self.shared = shared
+        self._connect()
+
+    def _connect(self):
+        options = dict(self.kwargs)
+        if self.replica_set:
+            options['replicaSet'] = self.replica_set
+        if self.shared:
+            self._connection, self.pool_stats = self.registry.acquire(
+                self.client_cls, self.host_or_url, options)
+            self._released = False
         else:
-            self.connection = MongoClient(host_or_url, **kwargs)
+            self._connection, self.pool_stats = self.registry.connect(
+                self.client_cls, self.host_or_url, options)
+        self._generation = self.registry.generation
+
+    @property
+    def connection(self):
+        """
+        The client, opened again when the process forked since it was
+        opened.
+        """
+        if self._generation != self.registry.generation and \
+                self.reconnect_after_fork:
+            self._connect()
+        return self._connection
 
     def get_database(self, database):
         return self.connection[database]
 
+    def close(self):
+        """
+        Close the client, or for shared clients stop using it, the client
+        is closed when the last connection using it is closed. Returns what
+        the client's close() returns, an awaitable for asyncio clients.
+        """
+        if self.shared:
+            # the client is counted once per connection, however often it
+            # is closed
+            if not self._released:
+                self._released = True
+                self.registry.release(self._connection)
+            return None
+        return self._connection.close()
+
+    def clone(self):
+        """
+        A new connection with the same settings. Clients can not be shared
+        with forked processes, worker processes use a clone instead.
+        """
+        return type(self)(self.host_or_url, self.replica_set,
+                          shared=self.shared, **self.kwargs)
+
+    def __getstate__(self):
+        """
+        Connections pickle as their settings and connect again when they
+        are unpickled.
+        """
+        return dict(host_or_url=self.host_or_url,
+                    replica_set=self.replica_set, kwargs=self.kwargs,
+                    shared=self.shared)
+
+    def __setstate__(self, state):
+        self.__init__(state['host_or_url'], state['replica_set'],
+                      shared=state.get('shared'), **state['kwargs'])
+
+
+_READ_PREFERENCES = {
+    'primary': ReadPreference.PRIMARY,
+    'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+    'secondary': ReadPreference.SECONDARY,
+    'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+    'nearest': ReadPreference.NEAREST,
+}
+
+
+def _read_preference_options(preference):
+    """
+    The client options of a pymongo read preference: its mode, its tag sets
+    as readPreferenceTags strings and its maximum staleness.
+    """
+    options = dict(readPreference=preference.mongos_mode)
+    tag_sets = list(preference.tag_sets or ())
+    if tag_sets and tag_sets != [{}]:
+        tags = list()
+        for tag_set in tag_sets:
+            pairs = list()
+            for name, value in sorted(tag_set.items()):
+                if set(',:').intersection(str(name) + str(value)):
+                    raise ValueError('read preference tag %s:%s can not be '
+                                     'given as a client option' % (name,
+                                                                   value))
+                pairs.append('%s:%s' % (name, value))
+            tags.append(','.join(pairs))
+        options['readPreferenceTags'] = tags
+    if preference.max_staleness != -1:
+        options['maxStalenessSeconds'] = preference.max_staleness
+    return options
+
+
+def _collection_options(collection_cls):
+    """
+    The get_collection() options declared by a Collection class, see
+    Collection.
+    """
+    options = dict()
+    write_concern = collection_cls.__write_concern__
+    if isinstance(write_concern, dict):
+        write_concern = WriteConcern(**write_concern)
+    if write_concern is not None:
+        options['write_concern'] = write_concern
+    read_concern = collection_cls.__read_concern__
+    if isinstance(read_concern, (str, unicode)):
+        read_concern = ReadConcern(read_concern)
+    if read_concern is not None:
+        options['read_concern'] = read_concern
+    codec_options = collection_cls.__codec_options__
+    if isinstance(codec_options, dict):
+        codec_options = CodecOptions(**codec_options)
+    if codec_options is not None:
+        options['codec_options'] = codec_options
+    return options
+
+
+_missing = object()
+
 
 class Key(object):
     """
@@ -133,80 +1374,822 @@ class Key(object):
     Col(Collection):
       number = Integer()
 
-    on __setattr__ Collection would perform an isinstance against the user
-    supplied value.
+    on __setattr__ Collection checks and coerces the user supplied value,
+    see TypedKey. Plain keys accept any value.
+
+    Keys are data descriptors, the value lives in the document dictionary
+    only. The attribute name is bound by DocumentType when the class is
+    created.
+
+    index declares a single key index, True or a direction, unique a
+    unique one. See Collection.indexes().
     """
+    name = None
+    validate = None
 
-    def __init__(self, default=None, data_type='no_type'):
+    def __init__(self, default=None, data_type='no_type', index=False,
+                 unique=False):
         self.data_type = data_type
         self.data = None
         self.default = default
+        self.index = index
+        self.unique = unique
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = dict.get(obj, self.name, _missing)
+        if value is _missing:
+            return self.missing(obj)
+        return value
+
+    def missing(self, obj):
+        """
+        The value of a key which is not in the document.
+        """
+        loaded_fields = obj._loaded_fields
+        if loaded_fields is not None and self.name not in loaded_fields:
+            raise CollectionInstanceException(
+                '%s was not loaded, the document is partial.' % self.name)
+        return self.default
+
+    def __set__(self, obj, value):
+        obj[self.name] = value
+
+    def __delete__(self, obj):
+        del obj[self.name]
+
+    def schema_field(self):
+        return SchemaField(self.name, self.default, None, None,
+                           self.name != '_id', None, self.validate)
+
+
+class TypedKey(Key):
+    """
+    A key holding values of one type.
+
+    Values of exactly python_type are stored as they are, anything else is
+    passed to coerce(), which converts it or raises ValidationException.
+    None is always accepted. The checks of a class are compiled into
+    Schema.validate, which runs when documents are created and written.
+    Documents loaded from the database are trusted and not checked.
+    """
+    python_type = object
+
+    def __init__(self, default=None, **kwargs):
+        super(TypedKey, self).__init__(default, self.python_type, **kwargs)
+        self.default = self.validate(default)
+
+    def validate(self, value):
+        if value is None or value.__class__ is self.python_type:
+            return value
+        return self.coerce(value)
+
+    def coerce(self, value):
+        raise self.invalid(value)
+
+    def invalid(self, value):
+        return ValidationException('%s expects %s, got %r' % (
+            self.name or 'key', self.__class__.__name__, value))
+
+    def __set__(self, obj, value):
+        obj[self.name] = self.validate(value)
+
+
+class Integer(TypedKey):
+    python_type = int
+
+    def coerce(self, value):
+        if isinstance(value, bool):
+            raise self.invalid(value)
+        if isinstance(value, int):
+            return int(value)
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        if isinstance(value, (str, unicode)):
+            try:
+                return int(value)
+            except ValueError:
+                pass
+        raise self.invalid(value)
+
+
+class Float(TypedKey):
+    python_type = float
+
+    def coerce(self, value):
+        if isinstance(value, bool):
+            raise self.invalid(value)
+        if isinstance(value, (int, float)):
+            return float(value)
+        if isinstance(value, (str, unicode)):
+            try:
+                return float(value)
+            except ValueError:
+                pass
+        raise self.invalid(value)
+
+
+class Unicode(TypedKey):
+    python_type = unicode
+
+    def coerce(self, value):
+        if isinstance(value, unicode):
+            return unicode(value)
+        if isinstance(value, bytes):
+            try:
+                return value.decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+        raise self.invalid(value)
+
+
+class Boolean(TypedKey):
+    python_type = bool
+
+    def coerce(self, value):
+        if isinstance(value, int) and value in (0, 1):
+            return bool(value)
+        raise self.invalid(value)
+
+
+class DateTime(TypedKey):
+    """
+    datetime values, dates are converted to midnight and strings are parsed
+    as ISO 8601. The database stores millisecond precision.
+    """
+    python_type = datetime.datetime
+
+    def coerce(self, value):
+        if isinstance(value, datetime.datetime):
+            return value
+        if isinstance(value, datetime.date):
+            return datetime.datetime.combine(value, datetime.time())
+        if isinstance(value, (str, unicode)):
+            try:
+                return datetime.datetime.fromisoformat(value)
+            except (AttributeError, ValueError):
+                pass
+        raise self.invalid(value)
+
+
+class ObjectIdKey(TypedKey):
+    python_type = ObjectId
+
+    def coerce(self, value):
+        try:
+            return ObjectId(value)
+        except (InvalidId, TypeError):
+            raise self.invalid(value)
+
+
+class Decimal(TypedKey):
+    """
+    decimal.Decimal values, stored in the document as Decimal128 so they
+    encode to BSON as they are, and read back as decimal.Decimal.
+    """
+    python_type = Decimal128
+
+    def __init__(self, default=None, **kwargs):
+        super(Decimal, self).__init__(default, **kwargs)
+        self.data_type = decimal.Decimal
+
+    def __get__(self, obj, cls):
+        value = super(Decimal, self).__get__(obj, cls)
+        if value.__class__ is Decimal128:
+            return value.to_decimal()
+        return value
+
+    def coerce(self, value):
+        if isinstance(value, bool):
+            raise self.invalid(value)
+        if isinstance(value, float):
+            value = repr(value)
+        try:
+            return Decimal128(decimal.Decimal(value))
+        except (decimal.InvalidOperation, TypeError, ValueError):
+            raise self.invalid(value)
+
+
+class Binary(TypedKey):
+    """
+    Binary data. Subtype 0 values are stored as bytes, other subtypes as
+    bson.Binary.
+    """
+    python_type = bytes
+
+    def __init__(self, default=None, subtype=bson.binary.BINARY_SUBTYPE,
+                 **kwargs):
+        self.subtype = subtype
+        if subtype != bson.binary.BINARY_SUBTYPE:
+            self.python_type = bson.Binary
+        super(Binary, self).__init__(default, **kwargs)
+
+    def coerce(self, value):
+        if isinstance(value, bson.Binary) and \
+                value.subtype != self.subtype:
+            raise self.invalid(value)
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            if self.python_type is bson.Binary:
+                return bson.Binary(bytes(value), self.subtype)
+            return bytes(value)
+        raise self.invalid(value)
+
+
+class NestedKey(Key):
+    """
+    The descriptor generated for a nested SubCollection, ListCollection or
+    LazyCollection declaration.
+
+    Documents loaded lazily keep nested values as decoded dict and list
+    objects, they are converted to the declared type on first access.
+    """
+    def __init__(self, prototype):
+        super(NestedKey, self).__init__()
+        self.collection_cls = prototype.__class__
+        self.is_document = issubclass(self.collection_cls, SubCollection)
+        self.is_lazy = issubclass(self.collection_cls, LazyCollection)
+        self.element_cls = None
+        self.compact_cls = None
+        if issubclass(self.collection_cls, ListCollection):
+            element_type = self.collection_cls.__list_element_type__
+            if element_type.__base__ is SubCollection:
+                self.element_cls = element_type
+            elif issubclass(element_type, CompactSubCollection):
+                self.compact_cls = element_type
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = dict.get(obj, self.name, _missing)
+        if value is _missing:
+            return self.missing(obj)
+        if value.__class__ in (dict, list) and obj._lazy:
+            value = self.hydrate(value)
+            dict.__setitem__(obj, self.name, value)
+        return value
+
+    @staticmethod
+    def is_nested(obj):
+        return isinstance(obj, (SubCollection, ListCollection, LazyCollection))
+
+    def build(self, value):
+        """
+        Convert decoded data to the declared collection type.
+        """
+        collection_cls = self.collection_cls
+        if issubclass(collection_cls, SubCollection):
+            if isinstance(value, dict):
+                return collection_cls(**value)
+            return collection_cls()
+        if issubclass(collection_cls, LazyCollection):
+            return collection_cls(**value)
+        if not isinstance(value, (ListCollection, list)):
+            raise ValueError(
+                'attempting to populate list %s with '
+                'non-list value, %s' % (self.name, str(value)))
+        element_type = collection_cls.__list_element_type__
+        if element_type.__base__ in [SubCollection, LazyCollection, dict] or \
+                self.compact_cls is not None:
+            built = collection_cls()
+            list.extend(built, [element_type(**el) for el in value])
+            return built
+        return collection_cls(value)
+
+    def hydrate(self, value):
+        """
+        build() for decoded query results, nested documents are populated
+        without calling their __init__.
+        """
+        collection_cls = self.collection_cls
+        if value.__class__ is dict:
+            if self.is_document:
+                obj = collection_cls.__new__(collection_cls)
+                collection_cls.__schema__.hydrate(obj, value)
+                return obj
+            if self.is_lazy:
+                return collection_cls(value)
+        element_cls = self.element_cls
+        if element_cls is not None and value.__class__ is list:
+            new = element_cls.__new__
+            hydrate = element_cls.__schema__.hydrate
+            elements = list()
+            for el in value:
+                obj = new(element_cls)
+                hydrate(obj, el)
+                elements.append(obj)
+            built = collection_cls()
+            list.extend(built, elements)
+            return built
+        compact_cls = self.compact_cls
+        if compact_cls is not None and value.__class__ is list:
+            make = compact_cls._make
+            built = collection_cls()
+            list.extend(built, [make(el) for el in value])
+            return built
+        return self.build(value)
+
+    def validate(self, value):
+        """
+        Check the typed keys of nested documents in place.
+        """
+        if self.is_document:
+            if isinstance(value, self.collection_cls):
+                self.collection_cls.__schema__.validate(value)
+        elif self.element_cls is not None and isinstance(value, list):
+            validate = self.element_cls.__schema__.validate
+            for el in value:
+                if isinstance(el, self.element_cls):
+                    validate(el)
+        return value
+
+    def schema_field(self):
+        validate = None
+        nested_cls = self.element_cls or (
+            self.collection_cls if self.is_document else None)
+        if nested_cls is not None and \
+                nested_cls.__schema__.validate is not None:
+            validate = self.validate
+        return SchemaField(self.name, None, self.collection_cls, self.build,
+                           True, self.hydrate, validate)
+
+
+def _key_path(key):
+    if isinstance(key, Key):
+        return key.name
+    return key
+
+
+def _declared_key(document_cls, name):
+    """
+    The Key declared as name, compact classes keep theirs aside as their
+    attributes are slots.
+    """
+    keys = getattr(document_cls, '__compact_keys__', None)
+    if keys is not None:
+        return keys[name]
+    return getattr(document_cls, name)
+
+
+def _resolve_path(document_cls, path):
+    """
+    The key a (dotted) path ends on, None when it ends inside an untyped
+    value or on a list element. Raises ValueError when the path is not in
+    the schema. List positions, numbers or the $, $[] and $[name]
+    operators, may follow the keys of ListCollections.
+    """
+    parts = path.split('.')
+    key = None
+    while parts:
+        if document_cls is None:
+            return None
+        part = parts.pop(0)
+        if part not in document_cls.__schema__.keys:
+            raise ValueError('%s is not a key of %s' % (
+                part, document_cls.__name__))
+        key = _declared_key(document_cls, part)
+        document_cls = None
+        if isinstance(key, TypedKey) and parts:
+            raise ValueError('%s is a %s, not a document' % (
+                part, key.__class__.__name__))
+        if not isinstance(key, NestedKey) or key.is_lazy:
+            continue
+        if key.is_document:
+            document_cls = key.collection_cls
+        elif parts and (parts[0].isdigit() or parts[0].startswith('$')):
+            parts.pop(0)
+            document_cls = key.element_cls or key.compact_cls
+            key = None
+        elif parts:
+            raise ValueError('%s is a list, its elements are reached with a '
+                             'position or $' % part)
+    return key
+
+
+# Update DSL arguments and their operators, the keys of unset and
+# current_date may be given as a list.
+_UPDATE_OPERATORS = OrderedDict([
+    ('set', '$set'),
+    ('unset', '$unset'),
+    ('inc', '$inc'),
+    ('push', '$push'),
+    ('add_to_set', '$addToSet'),
+    ('pull', '$pull'),
+    ('min', '$min'),
+    ('max', '$max'),
+    ('current_date', '$currentDate'),
+])
+
+_NUMBER_KEYS = (int, float, Decimal128)
+
+
+def _update_operand(operator, key, path, value):
+    """
+    Check value against the key a path ends on.
+    """
+    if operator in ('$push', '$addToSet', '$pull'):
+        if isinstance(key, TypedKey) or (isinstance(key, NestedKey) and
+                                         key.is_document):
+            raise ValueError('%s needs a list, %s is not one' % (
+                operator, path))
+        return value
+    if not isinstance(key, TypedKey):
+        return value
+    if operator == '$inc' and key.python_type not in _NUMBER_KEYS:
+        raise ValueError('$inc needs a number, %s is a %s' % (
+            path, key.__class__.__name__))
+    if operator == '$currentDate':
+        if not isinstance(key, DateTime):
+            raise ValueError('$currentDate needs a DateTime, %s is a %s' % (
+                path, key.__class__.__name__))
+        return value
+    if operator == '$unset':
+        return value
+    return key.validate(value)
+
+
+def _compile_update(collection_cls, arguments, upsert=False):
+    """
+    The update document of Mquery.update() arguments, see there.
+    """
+    update = dict()
+    paths = set()
+    for argument, operator in _UPDATE_OPERATORS.items():
+        operands = arguments.get(argument)
+        if not operands:
+            continue
+        if not isinstance(operands, dict):
+            operands = dict.fromkeys(
+                operands, True if operator == '$currentDate' else '')
+        compiled = update[operator] = dict()
+        for field, value in operands.items():
+            path = _key_path(field)
+            if path in paths:
+                raise ValueError('%s is changed twice' % path)
+            paths.add(path)
+            key = _resolve_path(collection_cls, path)
+            compiled[path] = _update_operand(operator, key, path, value)
+    if not update:
+        raise ValueError('update() needs at least one change')
+    now = time.time()
+    if 'time_updated' not in paths and \
+            'time_updated' in collection_cls.__schema__.keys:
+        update.setdefault('$set', dict())['time_updated'] = now
+    if upsert and 'time_created' not in paths and \
+            'time_created' in collection_cls.__schema__.keys:
+        update['$setOnInsert'] = {'time_created': now}
+    return update
+
+
+class Index(object):
+    """
+    An index declared in the __indexes__ of a Collection class:
+
+    class Session(Collection):
+        __indexes__ = [
+            Index([(user, ASCENDING), (started, DESCENDING)]),
+            Index('expires', expire_after=0),
+            Index('token', unique=True, partial={'token': {'$gt': ''}}),
+        ]
+
+    keys is a key or a list of (key, direction) pairs, keys are given as
+    Key class attributes or (dotted) names. expire_after makes a TTL index,
+    partial is its partialFilterExpression. Documents hold every declared
+    key, None when it is not set, so partial filters on $exists match them
+    all. Other keyword arguments are passed on to pymongo.IndexModel.
+    """
+    def __init__(self, keys, unique=False, sparse=False, expire_after=None,
+                 partial=None, name=None, **options):
+        self.keys = keys
+        self.unique = unique
+        self.sparse = sparse
+        self.expire_after = expire_after
+        self.partial = partial
+        self.name = name
+        self.options = options
+
+    def key_names(self):
+        """
+        The keys as a list of (name, direction) pairs.
+        """
+        keys = self.keys
+        if not isinstance(keys, (list, tuple)):
+            keys = [(keys, ASCENDING)]
+        return [(_key_path(key), direction) for key, direction in keys]
+
+    def model(self):
+        options = dict(self.options)
+        if self.unique:
+            options['unique'] = True
+        if self.sparse:
+            options['sparse'] = True
+        if self.expire_after is not None:
+            options['expireAfterSeconds'] = self.expire_after
+        if self.partial is not None:
+            options['partialFilterExpression'] = dict(
+                (_key_path(k), v) for k, v in self.partial.items())
+        if self.name is not None:
+            options['name'] = self.name
+        return IndexModel(self.key_names(), **options)
+
+    def __repr__(self):
+        return 'Index(%r)' % self.key_names()
+
+
+def _indexed_keys(document_cls, prefix=''):
+    """
+    (path, key) pairs of the keys declared with index or unique, including
+    those of nested documents.
+    """
+    for field in document_cls.__schema__.fields:
+        key = _declared_key(document_cls, field.name)
+        if isinstance(key, NestedKey):
+            nested_cls = key.element_cls or key.compact_cls or (
+                key.collection_cls if key.is_document else None)
+            if nested_cls is not None:
+                for pair in _indexed_keys(nested_cls,
+                                          prefix + field.name + '.'):
+                    yield pair
+        elif key.index or key.unique:
+            yield prefix + field.name, key
 
 
 class LazyCollection(dict):
     """
     A dictionary type implementing attribute style value access.
     """
-    def __init__(self, **kwargs):
-        super(LazyCollection, self).__init__(kwargs)
-        for k, v in self.items():
-            object.__setattr__(self, k, v)
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
 
     def __setattr__(self, key, value):
         self[key] = value
-        object.__setattr__(self, key, value)
 
-    def __setitem__(self, key, value):
-        dict.__setitem__(self, key, value)
-        object.__setattr__(self, key, value)
+    def __delattr__(self, key):
+        try:
+            del self[key]
+        except KeyError:
+            raise AttributeError(key)
 
 
-class SubCollectionMeta(dict):
-    __keys__ = list()
+SchemaField = namedtuple('SchemaField',
+                         'name default factory build seed hydrate validate')
+
+
+class Schema(object):
+    """
+    The compiled field table of a Collection or SubCollection class.
+
+    fields is an ordered tuple of SchemaField entries, following the MRO so
+    that inherited keys come first. For nested collections, factory creates
+    the empty value and build converts raw (decoded) data into the declared
+    type, hydrate does the same for trusted query results. seed is False for
+    keys which are not written to the document until they are assigned, such
+    as _id.
+
+    by_name maps names to fields, nested lists the (name, hydrate) pairs of
+    the nested collections. hydrate(obj, data, lazy=False) populates a
+    document from trusted query results. validators maps the names of typed
+    keys to their checks, validate(obj) runs all of them, including those of
+    nested documents, and is None when the class has no typed keys.
+    """
+    __slots__ = ('fields', 'names', 'keys', 'by_name', 'nested', 'hydrate',
+                 'validators', 'validate')
+
+    def __init__(self, fields):
+        object.__setattr__(self, 'fields', tuple(fields))
+        object.__setattr__(self, 'names',
+                           tuple(field.name for field in self.fields))
+        object.__setattr__(self, 'keys', frozenset(self.names))
+        object.__setattr__(self, 'by_name',
+                           dict((field.name, field) for field in self.fields))
+        object.__setattr__(self, 'nested',
+                           tuple((field.name, field.hydrate)
+                                 for field in self.fields
+                                 if field.hydrate is not None))
+        object.__setattr__(self, 'hydrate', _compile_hydrator(self))
+        object.__setattr__(self, 'validators',
+                           dict((field.name, field.validate)
+                                for field in self.fields
+                                if field.validate is not None))
+        object.__setattr__(self, 'validate', _compile_validator(self))
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('Schema objects are read only.')
+
+    @classmethod
+    def from_class(cls, klass):
+        fields = dict()
+        order = list()
+        for base in reversed(klass.__mro__):
+            for name, obj in base.__dict__.items():
+                if not isinstance(obj, Key):
+                    continue
+                if name not in fields:
+                    order.append(name)
+                fields[name] = obj.schema_field()
+        return cls([fields[name] for name in order])
+
+
+class DocumentType(type):
+    """
+    Compiles the Schema of Collection and SubCollection classes.
+
+    The class is scanned once, when it is created, rather than every time a
+    document is instantiated. Nested collection declarations are replaced by
+    NestedKey descriptors.
+    """
+    def __init__(cls, name, bases, namespace):
+        super(DocumentType, cls).__init__(name, bases, namespace)
+        for attr, obj in list(namespace.items()):
+            if isinstance(obj, Key):
+                if obj.name not in (None, attr):
+                    obj = copy.copy(obj)
+                    setattr(cls, attr, obj)
+                obj.name = attr
+            elif isinstance(obj, (dict, list)) and NestedKey.is_nested(obj):
+                key = NestedKey(obj)
+                key.name = attr
+                setattr(cls, attr, key)
+        cls.__schema__ = Schema.from_class(cls)
+        cls.__keys__ = cls.__schema__.names
+
+
+def _build_document(obj, kwargs, lazy=False, loaded_fields=None):
+    """
+    Populate a document from its class Schema, defaults are used for keys
+    missing from kwargs. When lazy, nested values are stored as they are.
+    Keys outside of loaded_fields are left out of partial documents.
+    """
+    data = dict()
+    for name, default, factory, build, seed, _, _ in obj.__schema__.fields:
+        if loaded_fields is not None and name not in loaded_fields:
+            continue
+        if name in kwargs:
+            value = kwargs[name]
+            if build is not None and not lazy:
+                value = build(value)
+        elif factory is not None:
+            value = factory()
+        elif seed:
+            value = default
+        else:
+            continue
+        data[name] = value
+    dict.update(obj, data)
+
+
+def _compile_hydrator(schema):
+    """
+    _build_document for decoded query results, compiled for one Schema.
+    The data is trusted, keys which are present and plain are copied in one
+    dict.update() instead of one at a time.
+    """
+    keys = schema.keys
+    size = len(keys)
+    issuperset = keys.issuperset
+    by_name = schema.by_name
+    nested = schema.nested
+    update = dict.update
+    setitem = dict.__setitem__
+    get = dict.get
+
+    def hydrate(obj, data, lazy=False):
+        if issuperset(data):
+            update(obj, data)
+        else:
+            update(obj, [(k, v) for k, v in data.items() if k in keys])
+        if len(obj) < size:
+            for name in keys.difference(obj):
+                field = by_name[name]
+                if field.factory is not None:
+                    setitem(obj, name, field.factory())
+                elif field.seed:
+                    setitem(obj, name, field.default)
+        if nested and not lazy:
+            for name, hydrate_value in nested:
+                value = get(obj, name, _missing)
+                if value is not _missing:
+                    setitem(obj, name, hydrate_value(value))
+    return hydrate
+
+
+def _compile_validator(schema):
+    """
+    The checks of the typed keys of one Schema, as a single function
+    coercing the values of a document in place. Values which already have
+    the declared type only cost a class comparison. None when there is
+    nothing to check.
+    """
+    checks = tuple((field.name, field.validate) for field in schema.fields
+                   if field.validate is not None)
+    if not checks:
+        return None
+    get = dict.get
+    setitem = dict.__setitem__
+
+    def validate(obj):
+        for name, check in checks:
+            value = get(obj, name)
+            if value is not None:
+                checked = check(value)
+                if checked is not value:
+                    setitem(obj, name, checked)
+    return validate
+
+
+def _set_path(target, path, value):
+    """
+    The $set of a dotted path on nested dicts and lists.
+    """
+    parts = path.split('.')
+    for part in parts[:-1]:
+        if isinstance(target, list):
+            target = _list_item(target, int(part), dict)
+        else:
+            target = target.setdefault(part, dict())
+    if isinstance(target, list):
+        _list_item(target, int(parts[-1]), lambda: value)
+        target[int(parts[-1])] = value
+    else:
+        target[parts[-1]] = value
+
+
+def _list_item(target, index, default):
+    """
+    The item at index of a list, past its end the list is padded with None
+    up to it, as the server does, and the item is made by default.
+    """
+    if index >= len(target):
+        list.extend(target, [None] * (index - len(target)))
+        list.append(target, default())
+    elif target[index] is None:
+        target[index] = default()
+    return target[index]
+
+
+def _diff_dict(stored, current, prefix, update):
+    """
+    Add the operations turning the stored dict into the current one.
+    """
+    if [key for key in list(stored) + list(current)
+            if '.' in key or key.startswith('$')]:
+        update.setdefault('$set', dict())[prefix.rstrip('.')] = current
+        return
+    for key, value in current.items():
+        if key in stored:
+            _diff_value(stored[key], value, prefix + key, update)
+        else:
+            update.setdefault('$set', dict())[prefix + key] = value
+    for key in stored:
+        if key not in current:
+            update.setdefault('$unset', dict())[prefix + key] = ''
 
-    def __new__(cls, *args, **kwargs):
-        obj = super(SubCollectionMeta, cls).__new__(cls)
-        obj.__keys__ = list()
-        return obj
+
+def _diff_value(stored, current, path, update):
+    if type(stored) is not type(current):
+        update.setdefault('$set', dict())[path] = current
+    elif type(current) is dict:
+        _diff_dict(stored, current, path + '.', update)
+    elif type(current) is list:
+        _diff_list(stored, current, path, update)
+    elif stored != current:
+        update.setdefault('$set', dict())[path] = current
+
+
+def _diff_list(stored, current, path, update):
+    """
+    Appended items are pushed, items changed in place are set by index and
+    anything else sets the whole list.
+    """
+    element_update = dict()
+    for index, (stored_el, current_el) in enumerate(zip(stored, current)):
+        _diff_value(stored_el, current_el, '%s.%d' % (path, index),
+                    element_update)
+    if len(current) == len(stored):
+        for operator, paths in element_update.items():
+            update.setdefault(operator, dict()).update(paths)
+    elif len(current) > len(stored) and not element_update:
+        update.setdefault('$push', dict())[path] = {
+            '$each': current[len(stored):]}
+    else:
+        update.setdefault('$set', dict())[path] = current
+
+
+class SubCollectionMeta(_with_metaclass(DocumentType, dict)):
+    _lazy = False
+    _loaded_fields = None
 
 
 class SubCollection(SubCollectionMeta):
     def __init__(self, **kwargs):
         super(SubCollection, self).__init__()
-
-        for name, obj in self.__class__.__dict__.items():
-            if isinstance(obj, Key):
-                self.__keys__.append(name)
-                self[name] = obj.default
-                object.__setattr__(self, name, obj.default)
-            if isinstance(obj, (ListCollection, LazyCollection)):
-                self.__keys__.append(name)
-                self[name] = obj.__class__()
-
-        for key in kwargs.keys():
-            if key in self.__keys__:
-                if isinstance(self[key], LazyCollection):
-                    self[key] = self[key].__class__(**kwargs[key])
-                elif isinstance(self.get(key), ListCollection):
-                    if not isinstance(kwargs[key], (ListCollection, list)):
-                        raise ValueError(
-                            'attempting to populate list %s with '
-                            'non-list value, %s' % (key, str(kwargs[key])))
-                    if self[key].__list_element_type__.__base__ in \
-                            [SubCollection, LazyCollection, dict]:
-                        for el in kwargs[key]:
-                            self[key].append(
-                                self[key].__list_element_type__(**el))
-                    else:
-                        self[key] = self[key].__class__(kwargs[key])
-                else:
-                    self[key] = kwargs[key]
-                object.__setattr__(self, key, self[key])
-
-    def __setattr__(self, item, value):
-        if item in self.__keys__:
-            self[item] = value
-        object.__setattr__(self, item, value)
+        _build_document(self, kwargs)
+        validate = self.__schema__.validate
+        if validate is not None:
+            validate(self)
 
 
 class ListCollection(list):
@@ -218,24 +2201,143 @@ class ListCollection(list):
         list.append(self, obj)
 
 
+class CompactDocumentType(ABCMeta):
+    """
+    Compiles CompactSubCollection classes. Their keys become __slots__, the
+    Key objects are kept in __compact_keys__ and compiled into the
+    __schema__ like those of other documents.
+    """
+    def __new__(mcs, name, bases, namespace):
+        keys = OrderedDict()
+        for base in reversed(bases):
+            keys.update(getattr(base, '__compact_keys__', dict()))
+        slots = list()
+        for attr, obj in list(namespace.items()):
+            if isinstance(obj, Key):
+                if obj.name not in (None, attr):
+                    obj = copy.copy(obj)
+                obj.name = attr
+                keys[attr] = obj
+                slots.append(attr)
+                del namespace[attr]
+            elif isinstance(obj, (dict, list)) and NestedKey.is_nested(obj):
+                raise TypeError('%s.%s: compact elements can not hold nested '
+                                'collections' % (name, attr))
+        namespace['__slots__'] = tuple(slots)
+        cls = super(CompactDocumentType, mcs).__new__(mcs, name, bases,
+                                                      namespace)
+        cls.__compact_keys__ = keys
+        cls.__schema__ = Schema([key.schema_field()
+                                 for key in keys.values()])
+        cls.__keys__ = cls.__schema__.names
+        cls._defaults = tuple((key.name, key.default)
+                              for key in keys.values())
+        cls._slot_setters = tuple((name, default, getattr(cls, name).__set__)
+                                  for name, default in cls._defaults)
+        return cls
+
+
+class CompactSubCollection(_with_metaclass(CompactDocumentType, Mapping)):
+    """
+    A ListCollection element stored in slots instead of a dict, for lists
+    of thousands of small documents:
+
+    class Point(CompactSubCollection):
+        x = Float()
+        y = Float()
+
+    class Points(ListCollection):
+        __list_element_type__ = Point
+
+    Elements only hold plain and typed keys, typed keys are checked when
+    they are set. They are read-only mappings for the driver, which writes
+    them as documents, and support item assignment of their keys.
+    """
+    __slots__ = ()
+
+    def __init__(self, **kwargs):
+        validators = self.__schema__.validators
+        for name, default in self._defaults:
+            value = kwargs.get(name, default)
+            check = validators.get(name)
+            if check is not None and value is not None:
+                value = check(value)
+            object.__setattr__(self, name, value)
+
+    @classmethod
+    def _make(cls, data):
+        """
+        An element from trusted query results.
+        """
+        obj = object.__new__(cls)
+        get = data.get
+        for name, default, set_slot in cls._slot_setters:
+            set_slot(obj, get(name, default))
+        return obj
+
+    def __setattr__(self, attr, value):
+        check = self.__schema__.validators.get(attr)
+        if check is not None and value is not None:
+            value = check(value)
+        object.__setattr__(self, attr, value)
+
+    def __getitem__(self, key):
+        if key not in self.__schema__.keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__schema__.keys:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__schema__.keys
+
+    def __iter__(self):
+        return iter(self.__keys__)
+
+    def __len__(self):
+        return len(self.__keys__)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            '%s=%r' % (name, getattr(self, name)) for name in self.__keys__))
+
+
 class CollectionInstanceException(Exception):
     pass
 
 
-class CollectionMeta(dict):
-    __keys__ = list()
+class ValidationException(ValueError):
+    """
+    A value does not fit the type of its key.
+    """
+
+
+class CollectionScanException(Exception):
+    """
+    A query checked by Mquery.check_plan('raise') scans the collection.
+    """
+
+
+class CollectionScanWarning(UserWarning):
+    pass
+
+
+class CollectionMeta(_with_metaclass(DocumentType, dict)):
+    _lazy = False
+    _loaded_fields = None
+    _snapshot = None
+    __indexes__ = ()
+    __primary_key__ = None
+    __write_concern__ = None
+    __read_concern__ = None
+    __codec_options__ = None
     _id = Key()
     time_created = Key()
     time_updated = Key()
 
-    def __new__(cls, *args, **kwargs):
-        obj = super(CollectionMeta, cls).__new__(cls)
-        obj.__keys__ = ['_id', 'time_created', 'time_updated']
-        for key in obj.__keys__:
-            if not key == '_id':
-                obj[key] = None
-        return obj
-
 
 class Collection(CollectionMeta):
     """
@@ -253,90 +2355,209 @@ class Collection(CollectionMeta):
         user = Key('no_type')
         email = Key('no_type')
 
-    The class variables are extracted during __init__ and added to the
-    __keys__ class variable. Subsequent __setattr__ calls with attribute
-    keys matching definition keys, set the dictionary values.
+    The class variables are compiled into the __schema__ class variable when
+    the class is created, see DocumentType. Keys are descriptors, so
+    attribute access reads and writes the dictionary values directly.
 
     As the object can easily be coerced to dict() it can be passed directly
     to pymongo methods. This allows for declarative model definitions,
     attribute style interfaces, logical accessors to the collection through
     the class interface, and provides a drop in replacement for older code
     using dictionary base classes.
+
+    __write_concern__, a WriteConcern or its arguments as a dict,
+    __read_concern__, a ReadConcern or its level, and __codec_options__, a
+    CodecOptions or its arguments, set the options of the collection handle
+    sessions use for the class.
     """
     __collection_name__ = None
     __database__ = None
 
+    session = None
+
     def __init__(self, session=None, **kwargs):
         super(Collection, self).__init__()
-        self.session = session
-        self.database = None
-        self.collection = None
+        self._bind(session)
+        self._build(kwargs)
 
-        if self.session:
-            self.connection = self.session.connection
-            self.database = self.connection[self.__database__]
-            self.collection = self.database[self.__collection_name__]
+    def _bind(self, session):
+        if session is not None:
+            object.__setattr__(self, 'session', session)
 
-        self._build(kwargs)
-        self.__setitem__ = self.__setitem_after_init__
+    @property
+    def connection(self):
+        if self.session is None:
+            return None
+        return self.session.connection
+
+    @property
+    def database(self):
+        """
+        The database handle of the session.
+        """
+        if self.session is None:
+            return None
+        return self.session._get_handles(type(self))[0]
+
+    @property
+    def collection(self):
+        if self.session is None:
+            return None
+        return self.session._get_handles(type(self))[1]
+
+    @classmethod
+    def _load(cls, session, data, lazy=False, loaded_fields=None, raw=None):
+        """
+        Instantiate a document from query results. When lazy, nested
+        collections are converted on first access, loaded_fields makes a
+        partial document. raw is the BSON data was decoded from, it becomes
+        the snapshot as it is.
+
+        The results are trusted, documents are populated without calling
+        __init__.
+        """
+        obj = cls.__new__(cls)
+        if lazy:
+            object.__setattr__(obj, '_lazy', True)
+        if loaded_fields is not None:
+            object.__setattr__(obj, '_loaded_fields', loaded_fields)
+        object.__setattr__(obj, '_snapshot',
+                           bson.encode(data) if raw is None else raw)
+        obj._bind(session)
+        if loaded_fields is None:
+            cls.__schema__.hydrate(obj, data, lazy)
+        else:
+            _build_document(obj, data, lazy, loaded_fields)
+        return obj
 
     def _build(self, kwargs):
-        # load keys from class variables
-        for name, obj in self.__class__.__dict__.items():
-            if isinstance(obj, Key):
-                self.__keys__.append(name)
-                self[name] = obj.default
-                object.__setattr__(self, name, obj.default)
-            if isinstance(obj, (SubCollection, ListCollection, LazyCollection)):
-                self.__keys__.append(name)
-                self[name] = obj.__class__()
-                object.__setattr__(self, name, obj.__class__())
-
-        for key in kwargs.keys():
-            if key in self.__keys__:
-                if isinstance(self.get(key), SubCollection):
-                    if isinstance(kwargs[key], (SubCollection, dict)):
-                        self[key] = self[key].__class__(**kwargs[key])
-                    else:
-                        self[key] = self[key].__class__()
-                elif isinstance(self.get(key), LazyCollection):
-                    self[key] = self[key].__class__(**kwargs[key])
-                elif isinstance(self.get(key), ListCollection):
-                    if not isinstance(kwargs[key], (ListCollection, list)):
-                        raise ValueError(
-                            'attempting to populate list %s with '
-                            'non-list value, %s' % (key, str(kwargs[key])))
-                    if self[key].__list_element_type__.__base__ in \
-                            [SubCollection, LazyCollection, dict]:
-                        for el in kwargs[key]:
-                            self[key].append(
-                                self[key].__list_element_type__(**el))
-                    else:
-                        self[key] = self[key].__class__(kwargs[key])
-                else:
-                    self[key] = kwargs[key]
-                object.__setattr__(self, key, self[key])
+        _build_document(self, kwargs, self._lazy, self._loaded_fields)
+        self.validate()
 
-    def __setattr__(self, attr, value):
-        if attr in self.__keys__:
-            if isinstance(self[attr], SubCollection):
-                for subitem in self[attr].__keys__:
-                    setattr(self[attr], subitem, value[subitem])
-            if isinstance(self[attr], (ListCollection, list)):
-                if not isinstance(value, (ListCollection, list)):
-                    self[attr].append(value)
-                else:
-                    self[attr] += value
-                value = self[attr]
-            self[attr] = value
-        object.__setattr__(self, attr, value)
+    def validate(self):
+        """
+        Check and coerce the typed keys of the document and its nested
+        documents, raises ValidationException. Sessions call it before
+        documents are written.
+        """
+        validate = self.__schema__.validate
+        if validate is not None:
+            validate(self)
+
+    @classmethod
+    def indexes(cls):
+        """
+        The Index declarations of the class: those in __indexes__, then one
+        per key declared with index or unique, nested keys included, then a
+        unique index on __primary_key__. Keys with more than one
+        declaration are only indexed once.
+        """
+        indexes = list(cls.__indexes__)
+        declared = set(tuple(index.key_names()) for index in indexes)
+        for path, key in _indexed_keys(cls):
+            direction = ASCENDING if key.index in (True, False) else key.index
+            keys = ((path, direction),)
+            if keys not in declared:
+                declared.add(keys)
+                indexes.append(Index(list(keys), unique=key.unique))
+        primary_key = cls.__primary_key__
+        if primary_key and ((primary_key, ASCENDING),) not in declared:
+            indexes.append(Index(primary_key, unique=True))
+        return indexes
+
+    @property
+    def loaded_fields(self):
+        """
+        The keys loaded into a partial document, None when it is complete.
+        """
+        return self._loaded_fields
+
+    def changes(self):
+        """
+        The update document ($set, $unset and $push) which brings the stored
+        document up to date with this instance, empty when nothing changed.
+
+        Loaded documents keep a BSON snapshot of their data, changes are
+        found by comparing the snapshot with the current values, so nested
+        paths and in place changes to lists and dicts are included. Returns
+        None for documents which were not loaded or saved by a session.
+        """
+        if self._snapshot is None:
+            if self._loaded_fields is None:
+                return None
+            stored = dict()
+        else:
+            stored = bson.decode(self._snapshot)
+        current = bson.decode(bson.encode(self))
+        stored.pop('_id', None)
+        current.pop('_id', None)
+        update = dict()
+        _diff_dict(stored, current, '', update)
+        return update
+
+    def changed_paths(self):
+        """
+        The dotted paths changed since the document was loaded or saved.
+        """
+        update = self.changes() or dict()
+        return sorted(path for paths in update.values() for path in paths)
+
+    def _take_snapshot(self):
+        snapshot = self._snapshot
+        object.__setattr__(self, '_snapshot', bson.encode(self))
+        return snapshot
+
+    def materialize(self):
+        """
+        Convert any nested data left over from a lazy load.
+        """
+        if self._lazy:
+            for field in self.__schema__.fields:
+                if field.build is not None and field.name in self:
+                    getattr(self, field.name)
+
+    def __eq__(self, other):
+        self.materialize()
+        if isinstance(other, Collection):
+            other.materialize()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
 
-    def __setitem_after_init__(self, key, value):
-        object.__setattr__(self, key, value)
-        dict.__setitem__(self, key, value)
+    __hash__ = None
+
+    def __setattr__(self, attr, value):
+        if attr not in self.__schema__.keys:
+            object.__setattr__(self, attr, value)
+            return
+        current = getattr(self, attr) if attr in self else None
+        if isinstance(current, SubCollection):
+            for subitem in current.__keys__:
+                setattr(current, subitem, value[subitem])
+        if isinstance(current, (ListCollection, list)):
+            if not isinstance(value, (ListCollection, list)):
+                current.append(value)
+            else:
+                current += value
+            value = current
+        check = self.__schema__.validators.get(attr)
+        if check is not None and value is not None:
+            value = check(value)
+        self[attr] = value
 
     def remove(self):
-        self.collection.remove(self['_id'])
+        """
+        Delete the stored document, it leaves the read cache and the
+        identity map of the session as with MongoSession.remove().
+        """
+        self._blocking('remove')
+        self._driver_call('delete_one', {'_id': self['_id']})
+        if hasattr(self.session, '_track'):
+            self.session._track(self.session._remove_write(self))
 
     def present(self):
         return self.collection.find_one(self) > 0
@@ -359,12 +2580,105 @@ class Collection(CollectionMeta):
             return None
         return self._id
 
-    def collection_update(self, update_data):
+    def collection_update(self, update_data, fetch=True):
+        """
+        $set update_data, a dict of (dotted) paths, on the stored document
+        and patch this instance in place.
+
+        With fetch, the updated keys are read back from the server in the
+        same round trip, using find_one_and_update. Otherwise the $set is
+        applied to the instance locally.
+        """
+        self._blocking('collection_update')
+        spec, update_data = self._prepare_update(update_data)
+        if not fetch:
+            self._driver_call('update_one', spec, {'$set': update_data})
+            self._patch_update(update_data)
+            return
+        self._patch_fetched(self._driver_call(
+            'find_one_and_update', spec, {'$set': update_data},
+            self._fetched_fields(update_data),
+            return_document=ReturnDocument.AFTER))
+
+    def _driver_call(self, method, spec, *args, **kwargs):
+        """
+        Call a method of the collection handle, timed for the listeners of
+        the session as an operation named after the method.
+        """
+        call = getattr(self.collection, method)
+        if not getattr(self.session, 'listeners', None):
+            return call(spec, *args, **kwargs)
+        with self.session._timer(method, type(self), spec) as timer:
+            result = call(spec, *args, **kwargs)
+            timer.driver()
+            timer.count = 1
+            return result
+
+    def _blocking(self, name):
+        """
+        Writes through the instance block, an asyncio session would be
+        handed coroutines which are never awaited.
+        """
+        if getattr(self.session, 'asynchronous', False):
+            raise TypeError('%s() of a document of an AsyncMongoSession '
+                            'is awaited from the session, await '
+                            'session.%s(document)' % (name, name))
+
+    def _prepare_update(self, update_data):
         if not self.object_id:
             raise CollectionInstanceException(
                 'This instance is not mapped to an object_id.')
-        spec = dict(_id=self.object_id)
-        update_data.update(dict(time_updated=time.time()))
-        self.collection.update(spec, {'$set': update_data})
-        data = self.collection.find_one(spec)
-        self.__init__(self.session, **data)
+        if hasattr(self.session, 'invalidate'):
+            self.session.invalidate(self)
+        return (dict(_id=self.object_id),
+                dict(update_data, time_updated=time.time()))
+
+    def _patch_update(self, update_data):
+        stored = self._stored()
+        for path, value in update_data.items():
+            self._set_path(path, value)
+            if stored is not None:
+                _set_path(stored, path, value)
+        self._store(stored)
+
+    @staticmethod
+    def _fetched_fields(update_data):
+        return dict.fromkeys(set(path.split('.')[0]
+                                 for path in update_data), 1)
+
+    def _patch_fetched(self, data):
+        if data is None:
+            raise CollectionInstanceException(
+                'The document %s no longer exists.' % self.object_id)
+        data.pop('_id', None)
+        stored = self._stored()
+        for name, value in data.items():
+            self._set_path(name, value)
+            if stored is not None:
+                stored[name] = value
+        self._store(stored)
+
+    def _set_path(self, path, value):
+        """
+        Set the value at a dotted path, top level keys are converted to
+        their declared type.
+        """
+        name, _, rest = path.partition('.')
+        if not rest:
+            key = getattr(type(self), name, None)
+            if isinstance(key, NestedKey):
+                value = key.build(value)
+            dict.__setitem__(self, name, value)
+        elif name in self.__schema__.keys:
+            _set_path(getattr(self, name), rest, value)
+        else:
+            _set_path(self, path, value)
+
+    def _stored(self):
+        if self._snapshot is None:
+            return None
+        return bson.decode(self._snapshot)
+
+    def _store(self, stored):
+        if stored is not None:
+            object.__setattr__(self, '_snapshot', bson.encode(stored))
@@ -0,0 +1,192 @@
+"""
+Parallel scans of large queries.
+
+total = session.query(Order).filter({Order.state: 'open'}).parallel_scan(
+    order_total, workers=8, reduce=operator.add)
+
+Hydrating documents is bound by the CPU, a scan in one process keeps one
+core busy however fast the server is. parallel_scan() splits the results
+into _id ranges of about the same size and hands them to a pool of worker
+processes. Each worker opens its own client, reads and hydrates its ranges
+and applies fn to every document, so only the results of fn travel back to
+the calling process.
+
+fn and reduce run in the workers, with the default fork start method they
+may be any callable. Other start methods pickle them, as well as the
+collection class and the connection settings. The results of fn, or of
+reduce, are always pickled.
+"""
+import multiprocessing
+
+from pymongo import ASCENDING
+
+from nosqlalchemy.nosql import MongoSession
+
+
+__all__ = [
+    'parallel_scan',
+    'split_ranges'
+]
+
+
+# The scan of a worker process, set when the worker starts.
+_job = None
+
+
+def split_ranges(query, parts):
+    """
+    (lower, upper) _id bounds splitting the results of query into up to
+    parts ranges of about the same size, None for an open end. Lower
+    bounds are inclusive, upper bounds exclusive.
+
+    The bounds are found by skipping through the _id index from one bound
+    to the next, which reads it once.
+    """
+    collection = query.collection
+    total = collection.count_documents(query.spec)
+    bounds = list()
+    step = total // parts
+    if step:
+        lower = None
+        for _ in range(parts - 1):
+            spec = query.spec
+            if lower is not None:
+                spec = {'$and': [spec, {'_id': {'$gte': lower}}]}
+            cursor = collection.find(spec, {'_id': 1}).sort(
+                '_id', ASCENDING).skip(step).limit(1)
+            found = [doc['_id'] for doc in cursor]
+            if not found:
+                break
+            lower = found[0]
+            bounds.append(lower)
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+class _ScanJob(object):
+    """
+    What the workers need to rebuild the query, without the client of the
+    calling process.
+    """
+    def __init__(self, query, fn, reduce):
+        self.client = query.session.client
+        self.collection_cls = query.col
+        self.spec = query.spec
+        self.loaded_fields = query.loaded_fields
+        self.loaded_names = query.loaded_names
+        self.lazy = query.lazy_hydration
+        self.batch_size = query.batch_size_count
+        self.fn = fn
+        self.reduce = reduce
+        self.session = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['session'] = None
+        return state
+
+    def connect(self, clone):
+        if clone:
+            self.client = self.client.clone()
+        self.session = MongoSession(self.client)
+
+    def query(self, lower, upper):
+        query = self.session.query(self.collection_cls)
+        query.spec = dict(self.spec)
+        query.loaded_fields = self.loaded_fields
+        query.loaded_names = self.loaded_names
+        query.lazy_hydration = self.lazy
+        query.batch_size_count = self.batch_size
+        condition = dict()
+        if lower is not None:
+            condition['$gte'] = lower
+        if upper is not None:
+            condition['$lt'] = upper
+        if condition:
+            query = query.filter({'_id': condition})
+        return query
+
+    def scan(self, bounds):
+        """
+        The results of fn for one range, a list, or with reduce, a
+        (found, value) pair.
+        """
+        fn = self.fn
+        results = (fn(doc) for doc in self.query(*bounds))
+        if self.reduce is None:
+            return list(results)
+        found = False
+        value = None
+        for result in results:
+            value = self.reduce(value, result) if found else result
+            found = True
+        return found, value
+
+
+def _init_worker(job, clone):
+    global _job
+    job.connect(clone)
+    _job = job
+
+
+def _scan_range(bounds):
+    return _job.scan(bounds)
+
+
+def _stream(results, pool):
+    try:
+        for chunk in results:
+            for result in chunk:
+                yield result
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def parallel_scan(query, fn, workers=None, reduce=None, ranges=None,
+                  start_method=None):
+    """
+    Apply fn to each result of query in workers processes, the number of
+    CPUs by default.
+
+    Returns a generator of the results of fn, in _id order, or with
+    reduce, the results combined by reduce(a, b), None when there are no
+    results. Each worker reduces its own ranges first, so reduce must be
+    associative. The query is split in ranges parts, four per worker by
+    default, so workers which finish early pick up more work. With one
+    worker the scan runs in the calling process.
+
+    start_method is the multiprocessing start method, fork keeps the data
+    of the in-process backend available to the workers.
+    """
+    if query.session is None:
+        raise ValueError('parallel_scan() needs a query made by a session')
+    if query.limit_count or query.skip_count or query.sort_keys:
+        raise ValueError(
+            'parallel_scan() does not support sort(), skip() or limit()')
+    workers = workers or multiprocessing.cpu_count()
+    bounds = split_ranges(query, ranges or workers * 4)
+    job = _ScanJob(query, fn, reduce)
+    pool = None
+    if workers == 1 or len(bounds) == 1:
+        job.connect(clone=False)
+        results = map(job.scan, bounds)
+    else:
+        context = multiprocessing.get_context(start_method)
+        pool = context.Pool(min(workers, len(bounds)), _init_worker,
+                            (job, context.get_start_method() == 'fork'))
+        results = pool.imap(_scan_range, bounds)
+    if reduce is None:
+        return _stream(results, pool)
+    try:
+        found = False
+        value = None
+        for chunk_found, chunk_value in results:
+            if chunk_found:
+                value = reduce(value, chunk_value) if found else chunk_value
+                found = True
+        return value
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,172 @@
+import asyncio
+import pickle
+import unittest
+
+from pymongo import DESCENDING
+
+from nosqlalchemy import MemoryDBConnection, MongoDBConnection, MongoSession
+from nosqlalchemy.aggregation import Record, record_type
+from nosqlalchemy.aio import AsyncMemoryDBConnection, AsyncMongoSession
+from nosqlalchemy.tests.nosqlalchemy_test import (
+    BACKEND,
+    TempCollection,
+    TypedCollection
+)
+
+
+class TestAggregation(unittest.TestCase):
+    def setUp(self):
+        if BACKEND == 'mongodb':
+            client = MongoDBConnection()
+        else:
+            client = MemoryDBConnection()
+        self.session = MongoSession(client)
+        for cls in (TempCollection, TypedCollection):
+            self.session.drop_all(cls)
+            self.addCleanup(self.session.drop_all, cls)
+        self.session.add_all(
+            TypedCollection(number=i, title=['a', 'b', 'c'][i % 3],
+                            ratio=float(i), untyped=['x', 'y'][:i % 3])
+            for i in range(9))
+        self.session.add_all([TempCollection(test_key_1='a', test_key_2=1),
+                              TempCollection(test_key_1='b', test_key_2=2)])
+
+    def query(self):
+        return self.session.query(TypedCollection)
+
+    def test_group(self):
+        totals = self.query().filter({TypedCollection.number: {'$gt': 0}}) \
+            .aggregate().group(TypedCollection.title,
+                               total={'$sum': TypedCollection.number},
+                               n={'$sum': 1},
+                               numbers={'$push': TypedCollection.number}) \
+            .sort('total', DESCENDING)
+        self.assertEqual(totals.pipeline()[0],
+                         {'$match': {'number': {'$gt': 0}}})
+        self.assertEqual(totals.pipeline()[1]['$group']['total'],
+                         {'$sum': '$number'})
+        results = totals.all()
+        self.assertEqual([tuple(r) for r in results],
+                         [('c', 15, 3, [2, 5, 8]), ('b', 12, 3, [1, 4, 7]),
+                          ('a', 9, 2, [3, 6])])
+        first = results[0]
+        self.assertIsInstance(first, Record)
+        self.assertEqual((first._id, first.total, first['n']), ('c', 15, 3))
+        self.assertEqual(list(first._asdict()), ['_id', 'total', 'n',
+                                                 'numbers'])
+        self.assertRaises(AttributeError, setattr, first, 'other', 1)
+        self.assertEqual(pickle.loads(pickle.dumps(first)), first)
+
+        compound = self.query().aggregate().group(
+            [TypedCollection.title, TypedCollection.flag],
+            top={'$max': TypedCollection.ratio}).sort('_id').first()
+        self.assertEqual(compound._id, {'title': 'a', 'flag': False})
+        self.assertEqual(compound.top, 6.0)
+        everything = self.query().aggregate().group(
+            avg={'$avg': TypedCollection.number}).first()
+        self.assertEqual(everything.avg, 4)
+
+    def test_query_stages(self):
+        aggregation = self.query().sort(TypedCollection.number, DESCENDING) \
+            .skip(1).limit(3).only(TypedCollection.number).aggregate()
+        records = aggregation.all()
+        self.assertEqual([r.number for r in records], [7, 6, 5])
+        self.assertEqual(records[0]._fields, ('_id', 'number'))
+        ordered = self.query().only(TypedCollection.title, 'number', 'ratio',
+                                    'title').aggregate().sort('number')
+        self.assertEqual(ordered.record_cls._fields,
+                         ('_id', 'title', 'number', 'ratio'))
+        self.assertEqual(tuple(ordered.first())[1:], ('a', 0, 0.0))
+        self.assertEqual(self.query().aggregate().record_cls._fields,
+                         TypedCollection.__schema__.names)
+        self.assertRaises(ValueError, self.query().aggregate().match,
+                          {TempCollection.test_key_1: 'a'})
+
+        projected = self.query().aggregate().match(
+            {TypedCollection.title: 'a'}).project(
+            TypedCollection.number, _id=False,
+            double={'$multiply': [TypedCollection.number, 2]}).sort('number')
+        self.assertEqual([tuple(r) for r in projected],
+                         [(0, 0), (3, 6), (6, 12)])
+        self.assertEqual(projected.record_cls._fields, ('number', 'double'))
+
+    def test_unwind_lookup(self):
+        unwound = self.query().aggregate().unwind(
+            TypedCollection.untyped, index_field='position') \
+            .project(TypedCollection.untyped, 'position', _id=False)
+        self.assertEqual(sorted(tuple(r) for r in unwound),
+                         [('x', 0)] * 6 + [('y', 1)] * 3)
+        preserved = self.query().aggregate().unwind(
+            TypedCollection.untyped, preserve_empty=True)
+        self.assertEqual(len(preserved.all()), 12)
+
+        joined = self.query().filter({TypedCollection.number: {'$lt': 2}}) \
+            .aggregate().lookup(TempCollection, TypedCollection.title,
+                                TempCollection.test_key_1, 'temps') \
+            .sort('number')
+        first, second = joined.all()
+        self.assertEqual([t['test_key_2'] for t in first.temps], [1])
+        self.assertEqual([t['test_key_2'] for t in second.temps], [2])
+        self.assertEqual(first.number, 0)
+
+    def test_facet_count(self):
+        by_title = self.session.query(TypedCollection).aggregate() \
+            .group(TypedCollection.title, n={'$sum': 1}).sort('_id')
+        facets = self.query().aggregate().facet(
+            titles=by_title, total=[{'$count': 'n'}]).first()
+        self.assertEqual([tuple(r) for r in facets.titles],
+                         [('a', 3), ('b', 3), ('c', 3)])
+        self.assertEqual(facets.titles[0]._id, 'a')
+        self.assertEqual(facets.total, [{'n': 9}])
+        self.assertRaises(ValueError, self.query().aggregate().facet,
+                          some=self.query().limit(1).aggregate())
+
+        self.assertEqual(self.query().filter(title='b').aggregate().count()
+                         .first().count, 3)
+        self.assertIsNone(self.query().filter(title='z').aggregate().count()
+                          .first())
+        raw = self.query().aggregate().stage({'$count': 'n'}).first()
+        self.assertEqual(raw, {'n': 9})
+
+    def test_options(self):
+        aggregation = self.query().batch_size(2).aggregate()
+        self.assertEqual(aggregation._options(), {'batchSize': 2})
+        aggregation = aggregation.allow_disk_use().batch_size(5)
+        self.assertEqual(aggregation._options(),
+                         {'allowDiskUse': True, 'batchSize': 5})
+        self.assertEqual(len(aggregation.all()), 9)
+
+        events = list()
+        self.session.add_listener(events.append)
+        self.query().aggregate().group(None, n={'$sum': 1}).all()
+        self.assertEqual((events[0].operation, events[0].count),
+                         ('aggregate', 1))
+
+    def test_count(self):
+        self.assertEqual(self.query().count(), 9)
+        self.assertEqual(self.query().count({'title': 'a'}), 3)
+        self.assertEqual(self.query().filter(title='b').count(), 3)
+
+    def test_record_type(self):
+        point = record_type('Point', ['_id', 'x'])
+        self.assertIs(point, record_type('Point', ('_id', 'x')))
+        self.assertEqual(point(1, x=2), (1, 2))
+        self.assertEqual(repr(point(1, 2)), 'Point(_id=1, x=2)')
+        self.assertIsNone(point._make({'x': 3})._id)
+
+    def test_async_aggregate(self):
+        session = AsyncMongoSession(AsyncMemoryDBConnection())
+
+        async def run():
+            await session.add_all([TempCollection(test_key_1=str(i % 2))
+                                   for i in range(5)])
+            query = session.query(TempCollection)
+            groups = await query.aggregate().group(
+                TempCollection.test_key_1, n={'$sum': 1}).sort('_id') \
+                .to_list()
+            return groups, await query.count(), \
+                await query.count({'test_key_1': '1'})
+
+        groups, total, ones = asyncio.run(run())
+        self.assertEqual([tuple(g) for g in groups], [('0', 3), ('1', 2)])
+        self.assertEqual((total, ones), (5, 2))
@@ -0,0 +1,170 @@
+import asyncio
+import inspect
+import unittest
+
+from nosqlalchemy import (
+    BulkWriteException,
+    CollectionScanException,
+    DocumentCache,
+    ObjectId
+)
+from nosqlalchemy.aio import (
+    AsyncMemoryDBConnection,
+    AsyncMongoDBConnection,
+    AsyncMongoSession
+)
+from nosqlalchemy.tests.nosqlalchemy_test import (
+    BACKEND,
+    IndexedCollection,
+    TempCollection
+)
+
+
+def connect():
+    if BACKEND == 'mongodb':
+        return AsyncMongoDBConnection()
+    return AsyncMemoryDBConnection()
+
+
+class TestAsyncNoSQL(unittest.IsolatedAsyncioTestCase):
+    key1_value = 'TestKey1'
+
+    async def asyncSetUp(self):
+        self.client = connect()
+        self.session = AsyncMongoSession(self.client)
+        await self.session.drop_all(TempCollection)
+        tc = TempCollection(test_key_1=self.key1_value, update_key1=0)
+        self.oid = await self.session.add(tc)
+
+    async def asyncTearDown(self):
+        await self.session.drop_all(TempCollection)
+        closed = self.client.connection.close()
+        if inspect.isawaitable(closed):
+            await closed
+
+    async def test_add_and_get(self):
+        self.assertTrue(isinstance(self.oid, ObjectId))
+        query = self.session.query(TempCollection)
+        tc = await query.find_one({'_id': self.oid})
+        self.assertEqual(tc.test_key_1, self.key1_value)
+        self.assertIsNone(await query.find_one({'_id': ObjectId()}))
+        self.assertEqual((await query.find_one(self.oid))._id, self.oid)
+        self.assertEqual(await query.count(), 1)
+
+    async def test_save_and_remove(self):
+        query = self.session.query(TempCollection)
+        tc = await query.find_one({'_id': self.oid})
+        tc.update_key1 += 5
+        tc.list_collection.append(1)
+        await self.session.save(tc)
+        self.assertEqual(tc.changes(), {})
+        stored = await query.find_one({'_id': self.oid})
+        self.assertEqual(stored.update_key1, 5)
+        self.assertEqual(stored.list_collection, [1])
+
+        await self.session.update(TempCollection, {'_id': self.oid},
+                                  {'test_key_2': 'updated'})
+        stored = await query.find_one({'_id': self.oid})
+        self.assertEqual(stored.test_key_2, 'updated')
+
+        result = await query.filter(test_key_1=self.key1_value).update(
+            inc={TempCollection.update_key1: 2},
+            add_to_set={TempCollection.list_collection: 1})
+        self.assertEqual(result.modified_count, 1)
+        stored = await query.find_one({'_id': self.oid})
+        self.assertEqual((stored.update_key1, stored.list_collection),
+                         (7, [1]))
+
+        self.assertRaises(TypeError, stored.remove)
+        self.assertRaises(TypeError, stored.collection_update,
+                          {'test_key_2': 'x'})
+        self.assertEqual(await query.count(), 1)
+        await self.session.collection_update(stored, {'test_key_2': 'set'})
+        await self.session.collection_update(
+            stored, {'sub_collection.subkey1': 'local'}, fetch=False)
+        self.assertEqual((stored.test_key_2, stored.sub_collection.subkey1),
+                         ('set', 'local'))
+        self.assertEqual(stored.changes(), {})
+        fetched = await query.find_one(self.oid)
+        self.assertEqual(
+            (fetched.test_key_2, fetched.sub_collection.subkey1),
+            ('set', 'local'))
+
+        await self.session.remove(stored)
+        self.assertEqual(await query.count(), 0)
+
+    async def test_query_builder(self):
+        await self.session.add_all(
+            TempCollection(test_key_1=str(i), update_key1=i)
+            for i in range(10))
+        query = self.session.query(TempCollection).filter(
+            {TempCollection.update_key1: {'$gte': 5}}).batch_size(2)
+        self.assertEqual(
+            [tc.update_key1 async for tc in
+             query.sort(TempCollection.update_key1, -1).limit(3)],
+            [9, 8, 7])
+        self.assertEqual(len(await query.to_list()), 5)
+        self.assertEqual(await query.count({TempCollection.test_key_1: '6'}),
+                         1)
+        self.assertRaises(TypeError, list, query)
+        self.assertRaises(TypeError, query.to_numpy, ['update_key1'])
+        self.assertRaises(TypeError, query.to_columns, ['update_key1'])
+        self.assertRaises(TypeError, query.parallel_scan, len)
+
+        pages = [page async for page in
+                 self.session.query(TempCollection).pages(4)]
+        self.assertEqual([len(page) for page in pages], [4, 4, 3])
+        result = await self.session.query(TempCollection).remove(
+            {'update_key1': {'$lt': 5}})
+        self.assertEqual(result['n'], 6)
+
+    async def test_concurrent_bulk_writes(self):
+        session = AsyncMongoSession(self.client, batch_size=10,
+                                    ordered=False)
+        results = await asyncio.gather(*[
+            session.add_all(TempCollection(test_key_1=str(n), update_key1=i)
+                            for i in range(25))
+            for n in range(4)])
+        self.assertEqual([r.inserted_count for r in results], [25] * 4)
+        self.assertEqual(await session.query(TempCollection).count(), 101)
+
+        tc = TempCollection(_id=self.oid)
+        with self.assertRaises(BulkWriteException) as error:
+            await session.add_all([TempCollection(), tc, TempCollection()])
+        self.assertEqual(error.exception.result.inserted_count, 2)
+        self.assertIs(error.exception.result.errors[0][0], tc)
+
+    async def test_unit_of_work(self):
+        session = AsyncMongoSession(self.client, unit_of_work=True,
+                                    identity_map=True, cache=DocumentCache())
+        query = session.query(TempCollection)
+        tc = await query.find_one({'_id': self.oid})
+        self.assertIs(await query.find_one({'_id': self.oid}), tc)
+        tc.test_key_2 = 'queued'
+        await session.save(tc)
+        await session.add(TempCollection())
+        self.assertEqual(await query.count(), 1)
+        result = await session.flush()
+        self.assertEqual((result.inserted_count, result.modified_count),
+                         (1, 1))
+        self.assertEqual(session.cache.hits, 1)
+        self.assertEqual(
+            (await query.find_one({'_id': self.oid})).test_key_2, 'queued')
+
+    async def test_indexes_and_plan_check(self):
+        session = AsyncMongoSession(self.client, plan_check='raise')
+        database = self.client.connection['charlie']
+        await database.drop_collection('indexed')
+        try:
+            names = await session.ensure_indexes(IndexedCollection)
+            self.assertTrue('email_1' in names)
+            await session.add(IndexedCollection(code='a', owner='o'))
+            query = session.query(IndexedCollection)
+            self.assertEqual(len(await query.filter({'owner': 'o'}).to_list()),
+                             1)
+            with self.assertRaises(CollectionScanException):
+                await query.find_one({'started': 1})
+            with self.assertRaises(CollectionScanException):
+                await query.filter({'started': 1}).to_list()
+        finally:
+            await database.drop_collection('indexed')
@@ -0,0 +1,34 @@
+import io
+import json
+import unittest
+
+from nosqlalchemy.benchmarks import (
+    SCENARIOS,
+    BenchmarkContext,
+    compare,
+    dump,
+    run,
+)
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_run_all_scenarios(self):
+        context = BenchmarkContext(size=20, calls=10, batch_size=5)
+        results = run(context)
+        self.assertEqual(list(results['results']), list(SCENARIOS))
+        for result in results['results'].values():
+            self.assertTrue(result['ops_per_sec'] > 0)
+            self.assertTrue(result['p50_us'] <= result['p99_us'])
+        self.assertEqual(results['environment']['backend'], 'memory')
+        for name in ('collection_update', 'collection_update_local'):
+            result = results['results'][name]
+            self.assertEqual(result['driver_calls_per_call'], 1)
+            self.assertTrue(0 < result['driver_us_per_call'] <=
+                            result['mean_us'])
+        self.assertNotIn('driver_calls_per_call',
+                         results['results']['save_single'])
+
+        fp = io.StringIO()
+        dump(results, fp)
+        loaded = json.loads(fp.getvalue())
+        self.assertEqual(len(compare(loaded, results)), len(SCENARIOS))
@@ -0,0 +1,289 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from bson.objectid import ObjectId
+from pymongo.errors import OperationFailure
+
+from nosqlalchemy import DocumentCache, MemoryDBConnection, MongoSession
+from nosqlalchemy.aio import AsyncMemoryDBConnection, AsyncMongoSession
+from nosqlalchemy.changestreams import ChangeEvent
+from nosqlalchemy.memory import MemoryCollection
+from nosqlalchemy.tests.nosqlalchemy_test import TempCollection
+
+
+class FakeStream(object):
+    """
+    The pymongo ChangeStream interface over a list of change documents.
+    """
+    def __init__(self, changes):
+        self.changes = list(changes)
+        self.resume_token = None
+        self.closed = False
+
+    def try_next(self):
+        if not self.changes:
+            return None
+        change = self.changes.pop(0)
+        self.resume_token = change['_id']
+        return change
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        change = self.try_next()
+        if change is None:
+            raise StopIteration
+        return change
+
+    def close(self):
+        self.closed = True
+
+
+class AsyncFakeStream(FakeStream):
+    async def try_next(self):
+        return FakeStream.try_next(self)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        change = FakeStream.try_next(self)
+        if change is None:
+            raise StopAsyncIteration
+        return change
+
+    async def close(self):
+        self.closed = True
+
+
+def change(n, operation, _id, document=None, updated=None, removed=None,
+           truncated=None):
+    change = {'_id': {'_data': str(n)}, 'operationType': operation,
+              'documentKey': {'_id': _id}, 'clusterTime': n}
+    if document is not None:
+        change['fullDocument'] = dict(TempCollection(**document), _id=_id)
+    if updated is not None or removed is not None or truncated is not None:
+        change['updateDescription'] = {
+            'updatedFields': updated or {}, 'removedFields': removed or [],
+            'truncatedArrays': [{'field': field, 'newSize': size}
+                                for field, size in truncated or ()]}
+    return change
+
+
+class TestChangeStreams(unittest.TestCase):
+    def setUp(self):
+        self.session = MongoSession(MemoryDBConnection(), identity_map=True,
+                                    cache=DocumentCache())
+        self.session.drop_all(TempCollection)
+        self.watched = list()
+        self.streams = list()
+
+    def fake(self, changes, stream_cls=FakeStream):
+        changes = list(changes)
+
+        def watch(collection, pipeline=None, **options):
+            self.watched.append((pipeline, options))
+            stream = stream_cls(changes)
+            del changes[:]
+            self.streams.append(stream)
+            return stream
+        return watch
+
+    def test_events(self):
+        oid = ObjectId()
+        changes = [
+            change(1, 'insert', oid, {'test_key_1': 'a', 'update_key1': 1}),
+            change(2, 'update', oid, updated={'update_key1': 2},
+                   removed=['test_key_2']),
+            change(3, 'delete', oid),
+        ]
+        filtered = self.session.watch(
+            TempCollection, filter={TempCollection.test_key_1: 'a'},
+            operations=['insert', 'update'])
+        self.assertEqual(filtered.pipeline(), [{'$match': {
+            'operationType': {'$in': ['insert', 'update']},
+            'fullDocument.test_key_1': 'a'}}])
+        self.assertEqual(filtered._watch_options(),
+                         {'full_document': 'updateLookup'})
+        stream = self.session.watch(TempCollection)
+        with mock.patch.object(MemoryCollection, 'watch',
+                               self.fake(changes), create=True):
+            events = list(stream)
+        self.assertEqual(self.watched[0], ([], {}))
+        insert, update, delete = events
+        self.assertIsInstance(insert, ChangeEvent)
+        self.assertEqual((insert.operation, insert.document_key),
+                         ('insert', oid))
+        self.assertIsInstance(insert.document, TempCollection)
+        self.assertEqual(insert.document.update_key1, 1)
+        self.assertEqual(insert.document.changes(), {})
+        self.assertIsNone(update.document)
+        self.assertEqual(update.updated_fields, {'update_key1': 2})
+        self.assertEqual(update.removed_fields, ['test_key_2'])
+        self.assertEqual((delete.operation, delete.cluster_time), ('delete',
+                                                                  3))
+        self.assertEqual(delete.resume_token, {'_data': '3'})
+        self.assertEqual(stream.resume_token, {'_data': '3'})
+        self.assertRaises(ValueError, self.session.watch, TempCollection,
+                          filter={'missing': 1})
+        self.assertRaises(ValueError, self.session.watch, TempCollection,
+                          apply='cache')
+        self.assertRaises(ValueError, self.session.watch, TempCollection,
+                          filter={'test_key_1': 'a'},
+                          operations=['insert', 'delete'])
+        for apply in ('session', dict()):
+            self.assertRaises(ValueError, self.session.watch, TempCollection,
+                              filter={'test_key_1': 'a'}, apply=apply)
+
+    def test_resume(self):
+        oid = ObjectId()
+        with mock.patch.object(MemoryCollection, 'watch',
+                               self.fake([change(1, 'insert', oid, {}),
+                                          change(2, 'delete', oid)]),
+                               create=True):
+            stream = self.session.watch(TempCollection, start_after={'x': 0})
+            self.assertEqual(stream.try_next().operation, 'insert')
+            stream.close()
+            self.assertTrue(self.streams[0].closed)
+            self.assertEqual(list(stream), [])
+            with self.session.watch(
+                    TempCollection,
+                    resume_after=stream.resume_token) as resumed:
+                self.assertIsNone(resumed.try_next())
+        self.assertEqual([options for _, options in self.watched],
+                         [{'start_after': {'x': 0}},
+                          {'resume_after': {'_data': '1'}},
+                          {'resume_after': {'_data': '1'}}])
+        self.assertTrue(self.streams[-1].closed)
+
+        self.assertRaises(OperationFailure, next,
+                          iter(self.session.watch(TempCollection)))
+
+    def test_apply_session(self):
+        session = self.session
+        doc = TempCollection(test_key_1='live', test_key_2='b',
+                             update_key1=1)
+        oid = session.add(doc)
+        query = session.query(TempCollection)
+        live = query.find_one({'_id': oid})
+        live.test_key_3 = 'unsaved'
+        key = session._identity_key(TempCollection, oid)
+        self.assertIsNotNone(session.cache.get(key))
+
+        changes = [
+            change(1, 'update', oid, updated={'update_key1': 5,
+                                              'sub_collection.subkey1': 's'},
+                   removed=['test_key_2']),
+        ]
+        with mock.patch.object(MemoryCollection, 'watch', self.fake(changes),
+                               create=True):
+            for _ in session.watch(TempCollection, apply='session'):
+                pass
+        self.assertEqual(live.update_key1, 5)
+        self.assertEqual(live.sub_collection.subkey1, 's')
+        self.assertIsNone(live.test_key_2)
+        self.assertEqual(live.changes(), {'$set': {'test_key_3': 'unsaved'}})
+        self.assertIsNone(session.cache.get(key))
+
+        stored = {'test_key_1': 'live', 'update_key1': 9,
+                  'test_key_3': 'replaced'}
+        changes = [change(2, 'replace', oid, stored),
+                   change(3, 'delete', oid)]
+        with mock.patch.object(MemoryCollection, 'watch', self.fake(changes),
+                               create=True):
+            stream = session.watch(TempCollection, apply='session')
+            replace = stream.try_next()
+            self.assertIs(replace.document, live)
+            self.assertEqual((live.update_key1, live.test_key_3),
+                             (9, 'replaced'))
+            self.assertEqual(live.changes(), {})
+            self.assertIsNotNone(session.cache.get(key))
+            stream.try_next()
+        self.assertIsNone(session.identity_map.peek(key))
+        self.assertIsNone(session.cache.get(key))
+
+    def test_apply_view(self):
+        a, b = ObjectId(), ObjectId()
+        view = dict()
+        changes = [
+            change(1, 'insert', a, {'test_key_1': 'a'}),
+            change(2, 'insert', b, {'test_key_1': 'b'}),
+            change(3, 'update', a, updated={'test_key_1': 'A'}),
+            change(4, 'delete', b),
+        ]
+        with mock.patch.object(MemoryCollection, 'watch', self.fake(changes),
+                               create=True):
+            list(self.session.watch(TempCollection, apply=view))
+        self.assertEqual(list(view), [a])
+        self.assertEqual(view[a].test_key_1, 'A')
+        self.assertEqual(view[a].changes(), {})
+
+        with mock.patch.object(MemoryCollection, 'watch',
+                               self.fake([change(5, 'drop', None)]),
+                               create=True):
+            list(self.session.watch(TempCollection, apply=view))
+        self.assertEqual(view, {})
+
+    def test_array_updates(self):
+        session = self.session
+        oid = session.add(TempCollection(list_collection=['a', 'b']))
+        live = session.query(TempCollection).find_one(oid)
+        view = {oid: session.query(TempCollection).find_one(oid)}
+        changes = [
+            # $push, then $push of two items
+            change(1, 'update', oid, updated={'list_collection.2': 'c'}),
+            change(2, 'update', oid, updated={'list_collection.3': 'd',
+                                              'list_collection.4': 'e'}),
+            # $pop, then $pop with a $set of the new last item
+            change(3, 'update', oid, truncated=[('list_collection', 4)]),
+            change(4, 'update', oid, updated={'list_collection.2': 'C'},
+                   truncated=[('list_collection', 3)]),
+        ]
+        for apply in ('session', view):
+            with mock.patch.object(MemoryCollection, 'watch',
+                                   self.fake(changes), create=True):
+                list(session.watch(TempCollection, apply=apply))
+        for document in (live, view[oid]):
+            self.assertEqual(document.list_collection, ['a', 'b', 'C'])
+            self.assertEqual(document.changes(), {})
+        self.assertIs(session.identity_map.peek(
+            session._identity_key(TempCollection, oid)), live)
+
+        # an update which does not fit the loaded document reads it again
+        unfit = [change(5, 'update', oid, updated={'test_key_1.x': 1})]
+        key = session._identity_key(TempCollection, oid)
+        with mock.patch.object(MemoryCollection, 'watch', self.fake(unfit),
+                               create=True):
+            list(session.watch(TempCollection, apply='session'))
+        self.assertIsNone(session.identity_map.peek(key))
+        with mock.patch.object(MemoryCollection, 'watch', self.fake(unfit),
+                               create=True):
+            list(session.watch(TempCollection, apply=view))
+        self.assertEqual(view[oid].list_collection, ['a', 'b'])
+        self.assertIsNot(view[oid], live)
+        self.assertIs(session.identity_map.peek(key), view[oid])
+
+    def test_async_watch(self):
+        session = AsyncMongoSession(AsyncMemoryDBConnection())
+        oid = ObjectId()
+        changes = [change(1, 'insert', oid, {'test_key_1': 'a'}),
+                   change(2, 'delete', oid)]
+        fake = self.fake(changes, AsyncFakeStream)
+
+        async def watch(collection, pipeline=None, **options):
+            return fake(collection, pipeline, **options)
+
+        async def run():
+            stream = session.watch(TempCollection)
+            events = [event async for event in stream]
+            await stream.close()
+            return events
+
+        with mock.patch('nosqlalchemy.aio.AsyncMemoryCollection.watch',
+                        watch):
+            events = asyncio.run(run())
+        self.assertEqual([e.operation for e in events], ['insert', 'delete'])
+        self.assertEqual(events[0].document.test_key_1, 'a')
+        self.assertTrue(self.streams[0].closed)
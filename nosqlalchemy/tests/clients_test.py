@@ -0,0 +1,130 @@
+import os
+import unittest
+from collections import namedtuple
+
+from pymongo import ReadPreference
+from pymongo.read_preferences import Secondary
+
+from nosqlalchemy import MemoryDBConnection, MongoDBConnection, MongoSession
+from nosqlalchemy.clients import ClientRegistry, PoolStats
+from nosqlalchemy.tests.nosqlalchemy_test import TempCollection
+
+
+Event = namedtuple('Event', 'address duration')
+
+
+class RegistryConnection(MongoDBConnection):
+    registry = ClientRegistry()
+
+
+class TestClients(unittest.TestCase):
+    def connection(self, *args, **kwargs):
+        connection = RegistryConnection(*args, connect=False, **kwargs)
+        self.addCleanup(connection.close)
+        return connection
+
+    def test_shared_clients(self):
+        a = self.connection('mongodb://DB1,db2:27017/?replicaSet=rs',
+                            max_pool_size=50)
+        b = self.connection('db2,db1:27017', replica_set='rs',
+                            maxpoolsize='50')
+        c = self.connection('db1,db2', replica_set='rs', max_pool_size=10)
+        d = self.connection('db1,db2', replica_set='rs', max_pool_size=10,
+                            shared=False)
+        self.assertIs(a.connection, b.connection)
+        self.assertIs(a.pool_stats, b.pool_stats)
+        self.assertIsNot(a.connection, c.connection)
+        self.assertIsNot(c.connection, d.connection)
+        self.assertEqual(len(RegistryConnection.registry), 2)
+        self.assertEqual(a.connection.options.pool_options.max_pool_size, 50)
+        clone = c.clone()
+        self.addCleanup(clone.close)
+        self.assertIs(clone.connection, c.connection)
+
+        a.close()
+        a.close()
+        self.assertEqual(len(RegistryConnection.registry), 2)
+        b.close()
+        self.assertEqual(len(RegistryConnection.registry), 1)
+
+    def test_double_close(self):
+        a = self.connection('db1', max_pool_size=5)
+        b = self.connection('db1', max_pool_size=5)
+        self.assertIs(a.connection, b.connection)
+        a.close()
+        a.close()
+        self.assertEqual(len(RegistryConnection.registry), 1)
+        self.assertIs(b.connection, a.connection)
+        b.close()
+        self.assertEqual(len(RegistryConnection.registry), 0)
+
+    def test_pool_settings(self):
+        connection = self.connection(
+            max_pool_size=20, min_pool_size=2, wait_queue_timeout_ms=500,
+            compressors=['zlib'], read_preference=ReadPreference.NEAREST)
+        options = connection.connection.options
+        self.assertEqual(options.pool_options.max_pool_size, 20)
+        self.assertEqual(options.pool_options.min_pool_size, 2)
+        self.assertEqual(options.pool_options.wait_queue_timeout, 0.5)
+        self.assertEqual(
+            options.pool_options._compression_settings.compressors, ['zlib'])
+        self.assertEqual(connection.connection.read_preference,
+                         ReadPreference.NEAREST)
+
+        query = MongoSession(connection).query(TempCollection)
+        self.assertEqual(query._read_collection().read_preference,
+                         ReadPreference.NEAREST)
+        secondary = query.read_preference('secondary')
+        self.assertEqual(secondary._read_collection(raw=True).read_preference,
+                         ReadPreference.SECONDARY)
+        tagged = Secondary(tag_sets=[{'dc': 'east'}])
+        self.assertIs(query.read_preference(tagged)._read_collection()
+                      .read_preference, tagged)
+        self.assertRaises(ValueError, query.read_preference, 'secondaries')
+
+        preference = Secondary(tag_sets=[{'dc': 'east'}, {}],
+                               max_staleness=120)
+        tagged = self.connection(read_preference=preference)
+        self.assertEqual(tagged.connection.read_preference, preference)
+        self.assertIsNot(tagged.connection, self.connection(
+            read_preference=Secondary(max_staleness=120)).connection)
+        self.assertRaises(ValueError, self.connection,
+                          read_preference=Secondary([{'dc': 'a,b'}]))
+
+    def test_pool_stats(self):
+        stats = PoolStats()
+        address = ('db1', 27017)
+        stats.pool_created(Event(address, None))
+        for _ in range(3):
+            stats.connection_created(Event(address, None))
+            stats.connection_checked_out(Event(address, 0.002))
+        stats.connection_checked_in(Event(address, None))
+        stats.connection_closed(Event(address, None))
+        stats.connection_check_out_failed(Event(('db2', 27017), 0.5))
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['open'], 2)
+        self.assertEqual(snapshot['in_use'], 2)
+        self.assertEqual(snapshot['max_in_use'], 3)
+        self.assertEqual(snapshot['checkouts'], 3)
+        self.assertEqual(snapshot['checkout_failures'], 1)
+        self.assertAlmostEqual(snapshot['wait_ms'], 506)
+        self.assertEqual(snapshot['servers']['db1:27017']['created'], 3)
+
+        session = MongoSession(MemoryDBConnection(max_pool_size=5))
+        session.add(TempCollection(test_key_1='pool'))
+        stats = session.pool_stats()
+        self.assertEqual(stats['maxPoolSize'], 5)
+        self.assertEqual(stats['servers'], {})
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs os.fork()')
+    def test_fork(self):
+        connection = self.connection('db1')
+        client = connection.connection
+        pid = os.fork()
+        if pid == 0:
+            rebuilt = connection.connection
+            ok = rebuilt is not client and connection.connection is rebuilt
+            os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertIs(connection.connection, client)
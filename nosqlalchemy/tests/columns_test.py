@@ -0,0 +1,110 @@
+import datetime
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from nosqlalchemy import (
+    Collection,
+    Key,
+    MemoryDBConnection,
+    MongoDBConnection,
+    MongoSession,
+    SubCollection
+)
+from nosqlalchemy.tests.nosqlalchemy_test import BACKEND
+
+
+class ReadingSubCollection(SubCollection):
+    unit = Key()
+    value = Key(data_type=float)
+
+
+class ReadingCollection(Collection):
+    __collection_name__ = 'readings'
+    __database__ = 'nosql_test'
+
+    sensor = Key(data_type=int)
+    taken = Key(data_type=datetime.datetime)
+    ok = Key(data_type=bool)
+    label = Key()
+    reading = ReadingSubCollection()
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestColumns(unittest.TestCase):
+    # several batches, the last one short, see the iter_columns benchmark
+    # for millions of rows
+    rows = 5003
+
+    def test_iter_columns_synthetic(self):
+        from nosqlalchemy.columns import concatenate_columns, iter_columns
+
+        def documents():
+            for i in range(self.rows):
+                if i % 7:
+                    yield {'n': i, 'x': i * 0.5, 'sub': {'flag': i % 2 == 0}}
+                else:
+                    yield {'x': None, 'sub': {}}
+
+        paths = ['n', 'x', 'sub.flag']
+        batches = list(iter_columns(documents(), paths, {'n': 'int64'},
+                                    batch_size=1000))
+        self.assertEqual([len(b['n']) for b in batches], [1000] * 5 + [3])
+        columns = concatenate_columns(iter(batches), paths)
+        missing = (self.rows + 6) // 7
+
+        n = columns['n']
+        self.assertEqual(len(n), self.rows)
+        self.assertEqual(n.dtype, numpy.dtype('int64'))
+        self.assertEqual(n.count(), self.rows - missing)
+        self.assertTrue(n.mask[0] and not n.mask[1])
+        self.assertEqual(n[self.rows - 1], self.rows - 1)
+        self.assertEqual(columns['x'].dtype, numpy.dtype('float64'))
+        self.assertEqual(columns['x'].sum(), n.sum() * 0.5)
+        self.assertEqual(columns['sub.flag'].dtype, numpy.dtype(bool))
+        self.assertEqual(columns['sub.flag'].count(), self.rows - missing)
+
+    def test_query_to_numpy(self):
+        if BACKEND == 'mongodb':
+            client = MongoDBConnection()
+        else:
+            client = MemoryDBConnection()
+        session = MongoSession(client)
+        session.drop_all(ReadingCollection)
+        self.addCleanup(session.drop_all, ReadingCollection)
+        taken = datetime.datetime(2020, 1, 1)
+        session.add_all(
+            ReadingCollection(sensor=i, taken=taken, ok=bool(i % 2),
+                              label='s%d' % i,
+                              reading={'unit': 'C', 'value': i / 2.0})
+            for i in range(10))
+        session.add(ReadingCollection(label='empty'))
+
+        query = session.query(ReadingCollection).sort('_id')
+        columns = query.to_numpy([ReadingCollection.sensor, 'taken', 'ok',
+                                  'label', 'reading.value'], batch_size=4)
+        self.assertEqual(list(columns), ['sensor', 'taken', 'ok', 'label',
+                                         'reading.value'])
+        self.assertEqual(columns['sensor'].dtype, numpy.dtype('int64'))
+        self.assertEqual(columns['sensor'].tolist(), list(range(10)) + [None])
+        self.assertEqual(columns['taken'].dtype,
+                         numpy.dtype('datetime64[ms]'))
+        self.assertEqual(columns['taken'][0],
+                         numpy.datetime64('2020-01-01T00:00:00.000'))
+        self.assertTrue(columns['ok'].mask[10])
+        self.assertEqual(columns['label'].dtype, numpy.dtype(object))
+        self.assertEqual(columns['label'][10], 'empty')
+        self.assertEqual(columns['reading.value'].sum(), 22.5)
+
+        batches = list(query.filter({'sensor': {'$lt': 5}}).to_columns(
+            ['sensor'], batch_size=2))
+        self.assertEqual([len(b['sensor']) for b in batches], [2, 2, 1])
+
+        empty = query.filter({'sensor': -1}).to_numpy(['sensor', 'label'])
+        self.assertEqual(len(empty['sensor']), 0)
+        self.assertEqual(empty['sensor'].dtype, numpy.dtype('int64'))
+
+        self.assertRaises(ValueError, query.to_numpy, ['nope'])
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import unittest
+from collections import namedtuple
+
+from pymongo.errors import DuplicateKeyError
+
+from nosqlalchemy import MemoryDBConnection, MongoDBConnection, MongoSession
+from nosqlalchemy.aio import AsyncMemoryDBConnection, AsyncMongoSession
+from nosqlalchemy.events import (
+    CommandMonitor,
+    Histogram,
+    OperationStats,
+    SlowQueryLogger
+)
+from nosqlalchemy.tests.nosqlalchemy_test import BACKEND, TempCollection
+
+
+Started = namedtuple('Started', 'command command_name database_name '
+                                'request_id connection_id operation_id')
+Succeeded = namedtuple('Succeeded', 'command_name reply duration_micros '
+                                    'request_id connection_id operation_id')
+
+
+class TestEvents(unittest.TestCase):
+    def setUp(self):
+        if BACKEND == 'mongodb':
+            client = MongoDBConnection()
+        else:
+            client = MemoryDBConnection()
+        self.events = list()
+        self.stats = OperationStats()
+        self.session = MongoSession(client, batch_size=4,
+                                    listeners=[self.events.append])
+        self.session.add_listener(self.stats)
+        self.session.drop_all(TempCollection)
+        self.addCleanup(self.session.drop_all, TempCollection)
+        del self.events[:]
+
+    def operations(self):
+        operations = [event.operation for event in self.events]
+        del self.events[:]
+        return operations
+
+    def test_session_events(self):
+        doc = TempCollection(test_key_1='a')
+        self.session.add(doc)
+        add = self.events[0]
+        self.assertEqual(add.operation, 'add')
+        self.assertIs(add.collection_cls, TempCollection)
+        self.assertEqual(add.namespace, 'charlie.tempdb')
+        self.assertEqual((add.count, add.bytes), (1, len(doc._snapshot)))
+        self.assertTrue(add.driver_time > 0 and add.hydration_time > 0)
+        self.assertEqual(add.duration, add.driver_time + add.hydration_time)
+        doc.test_key_2 = 'b'
+        self.session.save(doc)
+        self.assertEqual(self.events[-1].spec, {'_id': doc._id})
+
+        self.session.add_all(TempCollection(test_key_1='many', update_key1=i)
+                             for i in range(10))
+        self.assertEqual(self.operations(),
+                         ['add', 'save', 'add_all', 'add_all', 'add_all'])
+
+        query = self.session.query(TempCollection)
+        self.assertEqual(len(list(query.filter({'test_key_1': 'many'}))), 10)
+        find = self.events[0]
+        self.assertEqual((find.operation, find.count), ('find', 10))
+        self.assertEqual(find.spec, {'test_key_1': 'many'})
+        self.assertTrue(find.bytes > 0 and find.hydration_time > 0)
+        for _ in query.limit(5):
+            break
+        self.assertEqual(self.events[-1].count, 1)
+        self.assertEqual(query.find_one({'_id': doc._id}).test_key_2, 'b')
+        self.assertIsNone(query.find_one({'test_key_1': 'none'}))
+        query.remove({'test_key_1': 'many', 'update_key1': 0})
+        self.assertEqual(self.events[-1].count, 1)
+        self.session.update(TempCollection, {'test_key_1': 'a'},
+                            {'test_key_3': 'c'})
+        self.assertEqual(self.operations(),
+                         ['find', 'find', 'find_one', 'find_one',
+                          'delete_many', 'update'])
+
+        self.assertRaises(DuplicateKeyError, self.session.add,
+                          TempCollection(_id=doc._id))
+        self.assertIsInstance(self.events[-1].error, DuplicateKeyError)
+
+        stats = self.stats.snapshot()
+        self.assertEqual(stats['add_all']['count'], 3)
+        self.assertEqual(stats['add_all']['documents'], 10)
+        self.assertEqual(stats['add']['errors'], 1)
+        self.assertTrue(stats['find']['p50_ms'] <= stats['find']['max_ms'])
+        self.assertEqual(self.stats.snapshot(by_model=True)[
+            ('find_one', 'TempCollection')]['count'], 2)
+
+        loaded = query.find_one({'test_key_1': 'many', 'update_key1': 1})
+        del self.events[:]
+        loaded.collection_update({'test_key_3': 'd'})
+        loaded.collection_update({'test_key_3': 'e'}, fetch=False)
+        loaded.remove()
+        self.assertEqual(self.events[-1].spec, {'_id': loaded._id})
+        self.assertEqual(self.operations(),
+                         ['find_one_and_update', 'update_one', 'delete_one'])
+
+    def test_no_listeners(self):
+        session = MongoSession(self.session.client)
+
+        def timer(*args):
+            raise AssertionError('timed without listeners')
+        session._timer = timer
+        session.add(TempCollection(test_key_1='quiet'))
+        session.add_all([TempCollection(test_key_1='quiet')])
+        self.assertEqual(len(list(session.query(TempCollection))), 2)
+        self.assertIsNotNone(
+            session.query(TempCollection).find_one({'test_key_1': 'quiet'}))
+
+    def test_slow_query_logger(self):
+        self.session.listeners = [SlowQueryLogger(0)]
+        with self.assertLogs('nosqlalchemy.slow', logging.WARNING) as logs:
+            list(self.session.query(TempCollection).filter(
+                {'test_key_1': 'x'}))
+        self.assertIn('slow find on charlie.tempdb', logs.output[0])
+        self.session.listeners = [SlowQueryLogger(60000)]
+        with self.assertRaises(AssertionError):
+            with self.assertLogs('nosqlalchemy.slow'):
+                self.session.add(TempCollection())
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for ms in [0.05] * 90 + [7] * 9 + [400]:
+            histogram.add(ms)
+        self.assertEqual(histogram.percentile(0.5), 0.1)
+        self.assertEqual(histogram.percentile(0.95), 10)
+        self.assertEqual(histogram.percentile(1), 400)
+        self.assertEqual(histogram.snapshot()['buckets'],
+                         [(0.1, 90), (10, 9), (500, 1)])
+
+    def test_command_monitor(self):
+        monitor = CommandMonitor([self.events.append])
+        monitor.started(Started({'find': 'tempdb', 'filter': {'a': 1}},
+                                'find', 'charlie', 1, 2, 1))
+        monitor.succeeded(Succeeded(
+            'find', {'cursor': {'firstBatch': [{}, {}]}}, 1500, 1, 2, 1))
+        event = self.events[0]
+        self.assertEqual((event.operation, event.namespace, event.spec),
+                         ('find', 'charlie.tempdb', {'a': 1}))
+        self.assertEqual((event.count, event.driver_time), (2, 0.0015))
+
+    def test_async_events(self):
+        events = list()
+        session = AsyncMongoSession(AsyncMemoryDBConnection(), batch_size=2,
+                                    listeners=[events.append])
+
+        async def run():
+            await session.add_all([TempCollection(test_key_1=str(i))
+                                   for i in range(3)])
+            await session.add(TempCollection(test_key_1='one'))
+            found = await session.query(TempCollection).to_list()
+            await session.query(TempCollection).find_one({'test_key_1': '1'})
+            await session.query(TempCollection).count()
+            return found
+
+        self.assertEqual(len(asyncio.run(run())), 4)
+        self.assertEqual([e.operation for e in events],
+                         ['add_all', 'add_all', 'add', 'find', 'find_one',
+                          'count'])
+        self.assertEqual(events[3].count, 4)
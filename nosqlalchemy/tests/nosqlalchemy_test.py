@@ -1,22 +1,55 @@
+import datetime
+import decimal
+import gc
+import os
 import unittest
 import time
 import sys
+import tracemalloc
+
+from pymongo import ASCENDING, DESCENDING, WriteConcern
+from pymongo.errors import DuplicateKeyError, OperationFailure
 
 from nosqlalchemy import (
     Collection,
     Key,
     ListCollection,
     SubCollection,
+    CompactSubCollection,
     MongoDBConnection,
     MongoSession,
     ObjectId,
-    LazyCollection
+    LazyCollection,
+    CollectionInstanceException,
+    BulkWriteException,
+    DocumentCache,
+    MemoryDBConnection,
+    Integer,
+    Float,
+    Unicode,
+    Boolean,
+    DateTime,
+    ObjectIdKey,
+    Decimal,
+    Binary,
+    ValidationException,
+    Index,
+    CollectionScanException,
+    CollectionScanWarning
 )
+from nosqlalchemy.nosql import _compile_update
 
 if sys.version_info >= (3, 0):
     unicode = str
 
-client = MongoDBConnection()
+# The tests run against the in-process backend, set
+# NOSQLALCHEMY_TEST_BACKEND=mongodb to run them against 127.0.0.1:27017.
+BACKEND = os.environ.get('NOSQLALCHEMY_TEST_BACKEND', 'memory')
+
+if BACKEND == 'mongodb':
+    client = MongoDBConnection()
+else:
+    client = MemoryDBConnection()
 MSession = MongoSession(client)
 
 
@@ -69,6 +102,393 @@ class TempCollection(Collection):
         return MSession.query(cls).find_one({'_id': oid})
 
 
+class InheritedCollection(TempCollection):
+    inherited_key = Key(default='inherited')
+
+
+class TypedSubCollection(SubCollection):
+    count = Integer(default=0)
+
+
+class TypedSubCollectionList(ListCollection):
+    __list_element_type__ = TypedSubCollection
+
+
+class TypedCollection(Collection):
+    __collection_name__ = 'typed'
+    __database__ = 'charlie'
+
+    number = Integer()
+    ratio = Float()
+    title = Unicode()
+    flag = Boolean(default=False)
+    stamp = DateTime()
+    ref = ObjectIdKey()
+    price = Decimal()
+    blob = Binary()
+    uuid = Binary(subtype=4)
+    untyped = Key()
+    sub = TypedSubCollection()
+    subs = TypedSubCollectionList()
+
+
+class CompactPoint(CompactSubCollection):
+    label = Key()
+    x = Float(index=True)
+    y = Float(default=0.0)
+
+
+class CompactPointList(ListCollection):
+    __list_element_type__ = CompactPoint
+
+
+class CompactCollection(Collection):
+    __collection_name__ = 'compact'
+    __database__ = 'charlie'
+
+    name = Key()
+    points = CompactPointList()
+    subs = SubCollectionList()
+
+
+class IndexedSubCollection(SubCollection):
+    city = Key(index=True)
+
+
+class IndexedCollection(Collection):
+    __collection_name__ = 'indexed'
+    __database__ = 'charlie'
+    __primary_key__ = 'code'
+
+    code = Key()
+    email = Unicode(unique=True)
+    score = Key(index=DESCENDING)
+    owner = Key()
+    started = Key()
+    expires = Key()
+    token = Key()
+    address = IndexedSubCollection()
+
+    __indexes__ = [
+        Index([(owner, ASCENDING), (started, DESCENDING)]),
+        Index('expires', expire_after=3600),
+        Index(token, unique=True, partial={token: {'$gt': ''}},
+              name='token_partial'),
+    ]
+
+
+class TestSchema(unittest.TestCase):
+    def test_inherited_keys(self):
+        names = InheritedCollection.__schema__.names
+        self.assertEqual(names[:3], ('_id', 'time_created', 'time_updated'))
+        self.assertEqual(names[-1], 'inherited_key')
+        self.assertTrue('sub_collection_list' in
+                        InheritedCollection.__schema__.keys)
+
+        ic = InheritedCollection(test_key_1='one',
+                                 sub_collection={'subkey1': 'sub'},
+                                 sub_collection_list=[{'x_item1': 1}],
+                                 unknown_key='dropped')
+        self.assertEqual(ic.inherited_key, 'inherited')
+        self.assertEqual(ic['test_key_1'], 'one')
+        self.assertTrue(isinstance(ic.sub_collection, TempSubCollection))
+        self.assertEqual(ic.sub_collection.subkey1, 'sub')
+        self.assertTrue(isinstance(ic.sub_collection_list[0], XSubCollection))
+        self.assertTrue(ic.lazy_collection is ic['lazy_collection'])
+        self.assertFalse('_id' in ic)
+        self.assertFalse('unknown_key' in ic)
+
+    def test_single_storage(self):
+        tc = TempCollection(test_key_1='one', lazy_collection={'a': 1})
+        self.assertEqual(vars(tc), {})
+        tc['test_key_1'] = 'item'
+        self.assertEqual(tc.test_key_1, 'item')
+        tc.test_key_2 = 'attribute'
+        self.assertEqual(tc['test_key_2'], 'attribute')
+        tc.lazy_collection.b = 2
+        self.assertEqual(tc['lazy_collection'], {'a': 1, 'b': 2})
+        self.assertEqual(vars(tc.lazy_collection), {})
+        self.assertTrue(TempCollection.test_key_1 is
+                        TempCollection.__dict__['test_key_1'])
+
+    def test_lazy_load(self):
+        data = dict(test_key_1='one',
+                    sub_collection={'subkey1': 'sub'},
+                    sub_collection_list=[{'x_item1': 1, 'x_item2': 2}],
+                    lazy_sub_collection={'lazy_1': {'a': 1}})
+        lazy = TempCollection._load(None, data, lazy=True)
+        self.assertEqual(type(lazy['sub_collection_list']), list)
+        self.assertTrue(isinstance(lazy.sub_collection_list[0],
+                                   XSubCollection))
+        self.assertTrue(isinstance(lazy['sub_collection_list'],
+                                   SubCollectionList))
+        self.assertEqual(type(lazy['sub_collection']), dict)
+        self.assertEqual(lazy, TempCollection(**data))
+        self.assertTrue(isinstance(lazy['sub_collection'], TempSubCollection))
+        self.assertEqual(lazy['sub_collection']['subkey2'], None)
+
+    def test_partial_load(self):
+        data = dict(_id=ObjectId(), test_key_1='one', sub_collection_list=[])
+        query = MSession.query(TempCollection).only(
+            'test_key_1', TempCollection.test_key_2,
+            TempCollection.sub_collection_list)
+        self.assertEqual(query.projection, {'_id': 1, 'test_key_1': 1,
+                                            'test_key_2': 1,
+                                            'sub_collection_list': 1})
+        partial = query._load(data)
+        self.assertEqual(partial.loaded_fields,
+                         frozenset(['_id', 'test_key_1', 'test_key_2',
+                                    'sub_collection_list']))
+        self.assertEqual(set(partial), set(['_id', 'test_key_1', 'test_key_2',
+                                            'sub_collection_list']))
+        self.assertEqual(partial.test_key_2, None)
+        self.assertTrue(isinstance(partial.sub_collection_list,
+                                   SubCollectionList))
+        self.assertRaises(CollectionInstanceException,
+                          getattr, partial, 'test_key_3')
+        self.assertRaises(ValueError,
+                          MSession.query(TempCollection).only, 'missing')
+        self.assertRaises(ValueError,
+                          MSession.query(TempCollection).only,
+                          XSubCollection.x_item1)
+
+
+    def test_changes(self):
+        data = dict(_id=ObjectId(), time_created=1.0, time_updated=2.0,
+                    test_key_1='one', test_key_2=2, test_key_3=None,
+                    update_key1=0,
+                    sub_collection={'subkey1': 'a', 'subkey2': 'b'},
+                    list_collection=[1, 2],
+                    sub_collection_list=[{'x_item1': 1, 'x_item2': 2}],
+                    lazy_collection={'dict_1': {'a': 1}},
+                    lazy_sub_collection={'module_name': None, 'lazy_1': {},
+                                         'lazy_2': {}})
+        tc = TempCollection._load(None, data)
+        self.assertEqual(tc.changes(), {})
+        self.assertIsNone(TempCollection(**data).changes())
+
+        tc.test_key_1 = 'two'
+        tc.sub_collection.subkey1 = 'c'
+        tc.list_collection.append(3)
+        tc.sub_collection_list[0].x_item2 = 5
+        tc.lazy_collection.dict_1['b'] = 2
+        del tc['test_key_3']
+        self.assertEqual(tc.changes(), {
+            '$set': {'test_key_1': 'two',
+                     'sub_collection.subkey1': 'c',
+                     'sub_collection_list.0.x_item2': 5,
+                     'lazy_collection.dict_1.b': 2},
+            '$unset': {'test_key_3': ''},
+            '$push': {'list_collection': {'$each': [3]}}})
+        self.assertEqual(tc.changed_paths(), [
+            'lazy_collection.dict_1.b', 'list_collection',
+            'sub_collection.subkey1', 'sub_collection_list.0.x_item2',
+            'test_key_1', 'test_key_3'])
+
+        tc = TempCollection._load(None, data)
+        tc.list_collection.pop()
+        tc.sub_collection_list = XSubCollection(x_item1=3)
+        tc.lazy_sub_collection.lazy_1['a.b'] = 1
+        self.assertEqual(tc.changes(), {'$set': {
+            'list_collection': [1],
+            'lazy_sub_collection.lazy_1': {'a.b': 1}},
+            '$push': {'sub_collection_list': {
+                '$each': [{'x_item1': 3, 'x_item2': None}]}}})
+
+    def test_typed_keys(self):
+        oid = ObjectId()
+        tc = TypedCollection(number='7', ratio=1, title=b'caf\xc3\xa9',
+                             flag=1, stamp=datetime.date(2020, 1, 2),
+                             ref=str(oid), price='1.10', blob=bytearray(b'x'),
+                             uuid=b'0123456789abcdef', untyped='any',
+                             sub={'count': 2.0}, subs=[{'count': '3'}])
+        self.assertEqual(tc['number'], 7)
+        self.assertTrue(type(tc['ratio']) is float)
+        self.assertEqual(tc.title, u'caf\xe9')
+        self.assertTrue(tc.flag is True)
+        self.assertEqual(tc.stamp, datetime.datetime(2020, 1, 2))
+        self.assertEqual(tc.ref, oid)
+        self.assertEqual(tc.price, decimal.Decimal('1.10'))
+        self.assertEqual(tc.blob, b'x')
+        self.assertEqual(tc.uuid.subtype, 4)
+        self.assertEqual(tc.sub['count'], 2)
+        self.assertEqual(tc.subs[0]['count'], 3)
+        self.assertTrue(TypedCollection.number.data_type is int)
+        self.assertTrue(TypedCollection.price.data_type is decimal.Decimal)
+
+        for key, value in [('number', 1.5), ('number', True),
+                           ('ratio', 'x'), ('title', 3), ('flag', 2),
+                           ('stamp', 'yesterday'), ('ref', 'nope'),
+                           ('price', 'x'), ('blob', u'text'),
+                           ('uuid', object())]:
+            self.assertRaises(ValidationException, setattr, tc, key, value)
+        self.assertRaises(ValidationException, TypedCollection, number='x')
+        self.assertRaises(ValueError, TypedSubCollection, count=[])
+        tc.number = None
+        tc.untyped = object()
+        self.assertRaises(ValidationException, setattr, tc.sub, 'count',
+                          'x')
+
+        tc['number'] = '8'
+        tc.subs[0]['count'] = '9'
+        tc.validate()
+        self.assertEqual(tc['number'], 8)
+        self.assertEqual(tc.subs[0]['count'], 9)
+        tc['number'] = 'x'
+        self.assertRaises(ValidationException, MSession.add, tc)
+
+        data = dict(_id=oid, number='trusted', sub={'count': 'x'})
+        loaded = TypedCollection._load(None, data)
+        self.assertEqual(loaded.number, 'trusted')
+        self.assertEqual(loaded.sub.count, 'x')
+        self.assertIsNone(TempCollection.__schema__.validate)
+
+    def test_compact_elements(self):
+        doc = CompactCollection(name='c', points=[{'label': 'a', 'x': 1},
+                                                  CompactPoint(x=2.5)])
+        first, second = doc.points
+        self.assertIsInstance(first, CompactPoint)
+        self.assertEqual((first.label, first.x, first.y), ('a', 1.0, 0.0))
+        self.assertEqual(second, {'label': None, 'x': 2.5, 'y': 0.0})
+        self.assertEqual(CompactPoint.__slots__, ('label', 'x', 'y'))
+        self.assertRaises(AttributeError, setattr, first, 'z', 1)
+        self.assertRaises(ValidationException, setattr, first, 'x', 'x')
+        self.assertRaises(ValidationException, CompactPoint, y='y')
+        self.assertRaises(ValueError, doc.points.append, {'x': 1})
+        self.assertEqual(CompactCollection.indexes()[0].key_names(),
+                         [('points.x', ASCENDING)])
+        with self.assertRaises(TypeError):
+            class Nested(CompactSubCollection):
+                sub = TempSubCollection()
+
+        MSession.drop_all(CompactCollection)
+        self.addCleanup(MSession.drop_all, CompactCollection)
+        oid = MSession.add(doc)
+        query = MSession.query(CompactCollection)
+        loaded = query.find_one({'_id': oid})
+        self.assertEqual(list(loaded.points), list(doc.points))
+        self.assertIsInstance(loaded.points[1], CompactPoint)
+        loaded.points[0].y = 4
+        loaded.points[1]['label'] = 'b'
+        self.assertEqual(loaded.changed_paths(),
+                         ['points.0.y', 'points.1.label'])
+        MSession.save(loaded)
+        loaded.points.append(CompactPoint(x=3))
+        self.assertEqual(loaded.changes(), {'$push': {'points': {
+            '$each': [{'label': None, 'x': 3.0, 'y': 0.0}]}}})
+        MSession.save(loaded)
+        stored = query.lazy().find_one({'_id': oid})
+        self.assertEqual([(p.label, p.x, p.y) for p in stored.points],
+                         [('a', 1.0, 4.0), ('b', 2.5, 0.0), (None, 3.0, 0.0)])
+        self.assertRaises(ValueError, query.update,
+                          set={'points.0.missing': 1})
+        self.assertRaises(ValidationException, query.update,
+                          set={'points.0.x': 'x'})
+
+    def test_compact_memory(self):
+        items = [dict(label='p%d' % i, x=float(i), y=0.0)
+                 for i in range(10000)]
+        data = dict(_id=ObjectId(), name='large', points=items, subs=[
+            dict(x_item1=item['label'], x_item2=item['x'])
+            for item in items])
+        sizes = dict()
+        for name in ('points', 'subs'):
+            key = getattr(CompactCollection, name)
+            gc.collect()
+            tracemalloc.start()
+            try:
+                value = key.hydrate(list(data[name]))
+                sizes[name] = tracemalloc.get_traced_memory()[0]
+            finally:
+                tracemalloc.stop()
+            self.assertEqual(len(value), 10000)
+        self.assertLess(sizes['points'] * 2, sizes['subs'])
+
+    def test_index_declarations(self):
+        indexes = IndexedCollection.indexes()
+        self.assertEqual([index.key_names() for index in indexes], [
+            [('owner', ASCENDING), ('started', DESCENDING)],
+            [('expires', ASCENDING)],
+            [('token', ASCENDING)],
+            [('email', ASCENDING)],
+            [('score', DESCENDING)],
+            [('address.city', ASCENDING)],
+            [('code', ASCENDING)]])
+        documents = [index.model().document for index in indexes]
+        self.assertEqual(documents[1]['expireAfterSeconds'], 3600)
+        self.assertEqual(documents[2]['name'], 'token_partial')
+        self.assertEqual(documents[2]['partialFilterExpression'],
+                         {'token': {'$gt': ''}})
+        self.assertTrue(documents[3]['unique'])
+        self.assertFalse('unique' in documents[4])
+        self.assertTrue(documents[6]['unique'])
+        self.assertEqual(TypedCollection.indexes(), [])
+
+    def test_document_cache(self):
+        cache = DocumentCache(max_size=2, ttl=10)
+        now = [0]
+        cache.clock = lambda: now[0]
+        cache.put(('db', 'c', 1), b'1')
+        cache.put(('db', 'c', 2), b'2')
+        self.assertEqual(cache.get(('db', 'c', 1)), b'1')
+        cache.put(('db', 'c', 3), b'3')
+        self.assertIsNone(cache.get(('db', 'c', 2)))
+        now[0] = 11
+        self.assertIsNone(cache.get(('db', 'c', 1)))
+        cache.put(('db', 'd', 4), b'4')
+        cache.invalidate_collection('db', 'c')
+        self.assertEqual(cache.stats(), dict(hits=1, misses=2, evictions=1,
+                                             expirations=1, size=1))
+
+
+class TestMemoryClient(unittest.TestCase):
+    def test_queries_and_updates(self):
+        collection = MemoryDBConnection().get_database('db')['c']
+        collection.insert_many([
+            {'_id': i, 'n': i, 'tags': ['even' if i % 2 else 'odd'],
+             'sub': {'x': i * 10}} for i in range(6)])
+
+        def find(spec, **kwargs):
+            return [d['_id'] for d in collection.find(spec, **kwargs)]
+
+        self.assertEqual(find({'n': {'$gte': 2, '$lt': 4}}), [2, 3])
+        self.assertEqual(find({'$or': [{'n': 0}, {'sub.x': 50}]}), [0, 5])
+        self.assertEqual(find({'tags': 'even', 'n': {'$nin': [1, 5]}}), [3])
+        self.assertEqual(find({}, sort=[('n', -1)], limit=2), [5, 4])
+        self.assertEqual(collection.find_one(4, {'n': 1}), {'_id': 4, 'n': 4})
+
+        result = collection.update_many({'n': {'$lt': 2}}, {
+            '$inc': {'n': 10}, '$push': {'tags': 'low'},
+            '$set': {'sub.y': 1}, '$unset': {'sub.x': ''}})
+        self.assertEqual((result.matched_count, result.modified_count),
+                         (2, 2))
+        self.assertEqual(collection.find_one(1), {
+            '_id': 1, 'n': 11, 'tags': ['even', 'low'], 'sub': {'y': 1}})
+        result = collection.update_one({'_id': 1}, {'$set': {'n': 11}})
+        self.assertEqual(result.modified_count, 0)
+        result = collection.update_one({'_id': 9}, {'$set': {'n': 9}},
+                                       upsert=True)
+        self.assertEqual(result.upserted_id, 9)
+        self.assertEqual(collection.delete_many({'n': {'$gt': 8}})
+                         .deleted_count, 3)
+        self.assertEqual(collection.count_documents({}), 4)
+
+
+class ConcernCollection(Collection):
+    __collection_name__ = 'concern'
+    __database__ = 'charlie'
+    __write_concern__ = {'w': 1, 'j': True}
+    __read_concern__ = 'local'
+    __codec_options__ = {'tz_aware': True}
+
+    built = 0
+    stamp = Key()
+
+    def _build(self, kwargs):
+        type(self).built += 1
+        super(ConcernCollection, self)._build(kwargs)
+
+
 class TestNoSQL(unittest.TestCase):
     oid = None
     key1_value = 'TestKey1'
@@ -117,6 +537,37 @@ class TestNoSQL(unittest.TestCase):
         self.assertEqual(tc.update_key1, 777,
                          'Update failed, value is %d' % tc.update_key1)
 
+    def test_dirty_save(self):
+        tc = TempCollection.get_by_oid(self.oid)
+        self.assertIsNone(MSession._save_write(tc))
+        time_updated = tc.time_updated
+        MSession.save(tc)
+        self.assertEqual(TempCollection.get_by_oid(self.oid).time_updated,
+                         time_updated)
+
+        tc.sub_collection.subkey2 = 'Subkey_2'
+        tc.list_collection.append(1)
+        tc.test_key_3 = None
+        pending_write = MSession._save_write(tc)
+        self.assertEqual(pending_write.method, 'update_one')
+        self.assertEqual(pending_write.args, (
+            {'_id': self.oid},
+            {'$set': {'sub_collection.subkey2': 'Subkey_2',
+                      'test_key_3': None,
+                      'time_updated': tc.time_updated},
+             '$push': {'list_collection': {'$each': [1]}}}))
+        self.assertEqual(tc.changes(), {})
+        MSession._write(pending_write)
+
+        tc.sub_collection_list.append(XSubCollection(x_item1='One'))
+        MSession.save(tc)
+        tc.sub_collection_list.append(XSubCollection(x_item1='Two'))
+        MSession.save(tc)
+        saved = TempCollection.get_by_oid(self.oid)
+        self.assertEqual(saved, tc)
+        self.assertEqual([x.x_item1 for x in saved.sub_collection_list],
+                         ['One', 'Two'])
+
     def test_sub_collection(self):
         tc = TempCollection.get_by_oid(self.oid)
         tsc = TempSubCollection()
@@ -184,6 +635,211 @@ class TestNoSQL(unittest.TestCase):
         self.assertEqual(tc.lazy_sub_collection.lazy_1.key1, {'1': 2})
         self.assertEqual(tc.lazy_sub_collection.lazy_2.key2, 'Lazy2')
 
+    def test_lazy_query(self):
+        tc = TempCollection.get_by_oid(self.oid)
+        tc.sub_collection.subkey1 = 'Subkey_1'
+        tc.sub_collection_list.append(XSubCollection(x_item1='One'))
+        tc.lazy_sub_collection.lazy_1.key1 = 'Lazy1'
+        MSession.save(tc)
+
+        eager = MSession.query(TempCollection).find_one({'_id': self.oid})
+        lazy = MSession.query(TempCollection).lazy().find_one(
+            {'_id': self.oid})
+        self.assertEqual(lazy.test_key_1, self.key1_value)
+        self.assertEqual(type(lazy['sub_collection_list']), list)
+        self.assertEqual(lazy, eager)
+        self.assertEqual(
+            list(MSession.query(TempCollection).lazy().find(
+                {'_id': self.oid})), [eager])
+
+        lazy = MSession.query(TempCollection).lazy().find_one(
+            {'_id': self.oid})
+        lazy.test_key_2 = 'lazy save'
+        eager.test_key_2 = 'lazy save'
+        MSession.save(lazy)
+        saved = TempCollection.get_by_oid(self.oid)
+        eager.time_updated = saved.time_updated
+        self.assertEqual(saved, eager)
+        self.assertTrue(isinstance(saved.sub_collection_list[0],
+                                   XSubCollection))
+
+    def test_partial_save(self):
+        tc = TempCollection.get_by_oid(self.oid)
+        tc.sub_collection_list.append(XSubCollection(x_item1='One'))
+        MSession.save(tc)
+
+        partial = MSession.query(TempCollection).only(
+            TempCollection.update_key1).find_one({'_id': self.oid})
+        self.assertEqual(partial.update_key1, 0b1010011010)
+        self.assertFalse('sub_collection_list' in partial)
+        partial.update_key1 = 1
+        self.assertEqual(MSession.save(partial), self.oid)
+        self.assertRaises(CollectionInstanceException, MSession.add, partial)
+
+        tc = TempCollection.get_by_oid(self.oid)
+        self.assertEqual(tc.update_key1, 1)
+        self.assertEqual(tc.test_key_1, self.key1_value)
+        self.assertEqual(tc.sub_collection_list[0].x_item1, 'One')
+
+    def test_query_builder(self):
+        for x in range(10):
+            MSession.add(TempCollection(test_key_1=str(x), test_key_2='page',
+                                        update_key1=x % 3))
+        query = MSession.query(TempCollection).filter(
+            {TempCollection.test_key_2: 'page'})
+        self.assertEqual(query.count(), 10)
+
+        ordered = query.sort([(TempCollection.update_key1, -1),
+                              ('test_key_1', 1)])
+        self.assertEqual([tc.test_key_1 for tc in ordered.limit(4)],
+                         ['2', '5', '8', '1'])
+        self.assertEqual([tc.test_key_1 for tc in
+                          ordered.skip(8).batch_size(2)], ['6', '9'])
+        self.assertEqual(len(list(query.filter(update_key1=0))), 4)
+        self.assertEqual(len(list(query.filter(
+            {'test_key_2': {'$ne': 'other'}}))), 10)
+        self.assertEqual(len(list(query)), 10)
+        self.assertEqual(query.find_one({'test_key_1': '7'}).update_key1, 1)
+        self.assertTrue(isinstance(query.cursor().next(), dict))
+
+    def test_keyset_pages(self):
+        oids = [self.oid]
+        for x in range(6):
+            oids.append(MSession.add(TempCollection(test_key_1=str(x))))
+        pages = list(MSession.query(TempCollection).pages(3))
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual([tc._id for page in pages for tc in page],
+                         sorted(oids))
+        pages = list(MSession.query(TempCollection).pages(7))
+        self.assertEqual(len(pages), 1)
+        after = MSession.query(TempCollection).after(sorted(oids)[4])
+        self.assertEqual([tc._id for tc in after], sorted(oids)[5:])
+        self.assertRaises(ValueError, list, MSession.query(
+            TempCollection).sort('test_key_1').pages(3))
+
+    def test_many_pages(self):
+        def depth(spec):
+            if '$and' not in spec:
+                return 0
+            return 1 + max(depth(s) for s in spec['$and'])
+
+        session = MongoSession(client)
+        session.add_all(TempCollection(test_key_1='paged') for _ in range(120))
+        events = list()
+        session.add_listener(events.append)
+        query = session.query(TempCollection).filter(
+            {'_id': {'$ne': None}, 'test_key_1': 'paged'})
+        pages = list(query.pages(1, DESCENDING))
+        self.assertEqual(len(pages), 120)
+        self.assertEqual(len(events), 121)
+        self.assertEqual(set(depth(e.spec) for e in events[1:]), set([1]))
+        self.assertEqual([page[0]._id for page in pages],
+                         sorted((page[0]._id for page in pages),
+                                reverse=True))
+
+    def test_find_one_by_id(self):
+        query = MSession.query(TempCollection)
+        self.assertEqual(query.find_one(self.oid)._id, self.oid)
+        self.assertIsNone(query.find_one(ObjectId()))
+        self.assertEqual(query.find_one(None)._id, self.oid)
+
+    def test_bulk_writes(self):
+        session = MongoSession(client, batch_size=3)
+        tcs = [TempCollection(test_key_1=str(x), test_key_2='bulk')
+               for x in range(10)]
+        result = session.add_all(tcs)
+        self.assertEqual(result.inserted_count, 10)
+        self.assertTrue(all(tc.time_created and tc.time_updated
+                            for tc in tcs))
+        query = MSession.query(TempCollection).filter(test_key_2='bulk')
+        self.assertEqual(query.count(), 10)
+
+        for tc in tcs:
+            tc.test_key_3 = 'saved'
+        result = session.save_all(tcs + [TempCollection(test_key_2='bulk')])
+        self.assertEqual(result.matched_count, 10)
+        self.assertEqual(result.inserted_count, 1)
+        self.assertEqual(query.filter(test_key_3='saved').count(), 10)
+
+        result = session.remove_all(tcs[:4])
+        self.assertEqual(result.deleted_count, 4)
+        self.assertEqual(query.count(), 7)
+
+    def test_bulk_write_errors(self):
+        duplicate = TempCollection(_id=self.oid)
+        tcs = [TempCollection(), duplicate, TempCollection()]
+        for ordered in (True, False):
+            session = MongoSession(client, ordered=ordered)
+            try:
+                session.add_all([TempCollection(_id=tc.get('_id'))
+                                 for tc in tcs])
+            except BulkWriteException as e:
+                result = e.result
+            else:
+                self.fail('BulkWriteException was not raised')
+            self.assertEqual(len(result.errors), 1)
+            self.assertEqual(result.errors[0][0]._id, self.oid)
+            self.assertEqual(len(result.unprocessed), int(ordered))
+            self.assertEqual(result.inserted_count, 2 - int(ordered))
+        self.assertEqual(MSession.query(TempCollection).count(), 4)
+
+    def test_unit_of_work(self):
+        session = MongoSession(client, unit_of_work=True, batch_size=2)
+        tc = TempCollection.get_by_oid(self.oid)
+        tc.test_key_3 = 'flushed'
+        session.save(tc)
+        oids = [session.add(TempCollection(test_key_1=str(x)))
+                for x in range(3)]
+        session.remove(TempCollection.get_by_oid(self.oid))
+        session.update(TempCollection, {'test_key_1': '0'},
+                       {'test_key_2': 'updated'})
+        self.assertTrue(all(isinstance(oid, ObjectId) for oid in oids))
+        self.assertEqual(len(session.pending), 6)
+        self.assertEqual(MSession.query(TempCollection).count(), 1)
+        self.assertEqual(TempCollection.get_by_oid(self.oid).test_key_3,
+                         self.key3_value)
+
+        result = session.flush()
+        self.assertEqual(session.pending, [])
+        self.assertEqual((result.inserted_count, result.deleted_count,
+                          result.modified_count), (3, 1, 2))
+        self.assertIsNone(TempCollection.get_by_oid(self.oid))
+        self.assertEqual(TempCollection.get_by_oid(oids[0]).test_key_2,
+                         'updated')
+        self.oid = oids[0]
+
+    def test_identity_map_and_cache(self):
+        session = MongoSession(client, identity_map=True,
+                               cache=DocumentCache())
+        query = session.query(TempCollection)
+        tc = query.find_one({'_id': self.oid})
+        self.assertIs(query.find_one({'_id': self.oid}), tc)
+        self.assertIs(list(query.filter({'test_key_1': self.key1_value}))[0],
+                      tc)
+        self.assertEqual(session.cache.hits, 1)
+        self.assertEqual(session.identity_map.hits, 2)
+
+        tc.test_key_2 = 'cached'
+        session.save(tc)
+        self.assertEqual(len(session.cache), 0)
+        del tc
+        self.assertEqual(query.find_one({'_id': self.oid}).test_key_2,
+                         'cached')
+        self.assertEqual(session.cache.misses, 2)
+
+        tc = query.find_one({'_id': self.oid})
+        session.remove(tc)
+        self.assertIsNone(query.find_one({'_id': self.oid}))
+        self.assertEqual(len(session.identity_map), 0)
+        self.oid = MSession.add(TempCollection())
+
+        tc = query.find_one({'_id': self.oid})
+        self.assertIs(query.find_one({'_id': self.oid}), tc)
+        tc.remove()
+        self.assertEqual(len(session.identity_map), 0)
+        self.assertIsNone(query.find_one({'_id': self.oid}))
+        self.oid = MSession.add(TempCollection())
+
     def test_mongo_remove(self):
         tc = TempCollection()
         tc.test_key_1 = 'Tell Tale Heart'
@@ -231,6 +887,21 @@ class TestNoSQL(unittest.TestCase):
         tcs = list(MSession.query(TempCollection).find(dict(test_key_2='nerf')))
         self.assertEqual(len(tcs), 0)
 
+    def test_filtered_remove(self):
+        MSession.add_all(TempCollection(test_key_1=str(x % 2),
+                                        test_key_2='filtered')
+                         for x in range(6))
+        query = MSession.query(TempCollection).filter(test_key_2='filtered')
+        self.assertRaises(ValueError, query.limit(1).remove)
+        self.assertRaises(ValueError, query.skip(1).remove, {})
+        self.assertEqual(query.filter(test_key_1='0').remove({})['n'], 3)
+        self.assertEqual(query.remove({'test_key_1': 'x'})['n'], 0)
+        self.assertEqual(query.count(), 3)
+        self.assertEqual(MSession.query(TempCollection).count(
+            {'_id': self.oid}), 1)
+        self.assertEqual(query.remove()['n'], 3)
+        self.assertEqual(MSession.query(TempCollection).count(), 1)
+
     def test_object_id_property(self):
         tc = TempCollection.get_by_oid(self.oid)
         self.assertIsInstance(tc.object_id, ObjectId)
@@ -246,6 +917,193 @@ class TestNoSQL(unittest.TestCase):
         self.assertEqual(tc.lazy_sub_collection.module_name,
                          'test_collection_update')
 
+    def test_collection_update_local(self):
+        tc = TempCollection.get_by_oid(self.oid)
+        tc.test_key_3 = 'unsaved'
+        update_data = {'lazy_sub_collection.lazy_1.key1': 'local',
+                       'sub_collection': {'subkey1': 'local', 'subkey2': 2}}
+        tc.collection_update(update_data, fetch=False)
+        self.assertEqual(len(update_data), 2)
+        self.assertEqual(tc.lazy_sub_collection.lazy_1.key1, 'local')
+        self.assertTrue(isinstance(tc.sub_collection, TempSubCollection))
+        self.assertEqual(tc.changes(), {'$set': {'test_key_3': 'unsaved'}})
+        stored = TempCollection.get_by_oid(self.oid)
+        self.assertEqual(stored.lazy_sub_collection.lazy_1.key1, 'local')
+        self.assertEqual(stored.time_updated, tc.time_updated)
+        self.assertEqual(stored.test_key_3, self.key3_value)
+
+        tc.collection_update({'update_key1': 1})
+        self.assertEqual(tc.update_key1, 1)
+        self.assertEqual(tc.test_key_3, 'unsaved')
+        MSession.remove(tc)
+        self.assertRaises(CollectionInstanceException,
+                          tc.collection_update, {'update_key1': 2})
+        self.oid = MSession.add(TempCollection())
+
+    def test_query_update(self):
+        MSession.add_all(TempCollection(test_key_1='many', test_key_2='gone',
+                                        update_key1=i, list_collection=[i])
+                         for i in range(3))
+        query = MSession.query(TempCollection).filter(test_key_1='many')
+        result = query.update(
+            inc={TempCollection.update_key1: 10},
+            push={TempCollection.list_collection: 5},
+            set={'sub_collection.subkey1': 'mass'},
+            unset=[TempCollection.test_key_2])
+        self.assertEqual((result.matched_count, result.modified_count),
+                         (3, 3))
+        docs = list(query.sort(TempCollection.update_key1))
+        self.assertEqual([tc.update_key1 for tc in docs], [10, 11, 12])
+        self.assertEqual(list(docs[2].list_collection), [2, 5])
+        self.assertEqual(docs[0].sub_collection.subkey1, 'mass')
+        self.assertIsNone(docs[0].test_key_2)
+        self.assertTrue(docs[0].time_updated > docs[0].time_created)
+
+        query.update(max={TempCollection.update_key1: 11},
+                     pull={TempCollection.list_collection: 5})
+        self.assertEqual(sorted(tc.update_key1 for tc in query), [11, 11, 12])
+        self.assertEqual(list(query.find_one({}).list_collection), [0])
+
+        missing = MSession.query(TempCollection).filter(test_key_1='upsert')
+        result = missing.update(inc={TempCollection.update_key1: 1},
+                                upsert=True)
+        self.assertEqual(result.matched_count, 0)
+        created = TempCollection.get_by_oid(result.upserted_id)
+        self.assertEqual((created.test_key_1, created.update_key1),
+                         ('upsert', 1))
+        self.assertTrue(created.time_created)
+
+        for bad in ({'set': {'no_such_key': 1}},
+                    {'set': {'sub_collection.no_such_key': 1}},
+                    {'set': {'sub_collection_list.x_item1': 1}},
+                    {'push': {TempCollection.sub_collection: 1}},
+                    {'set': {'update_key1': 1}, 'inc': {'update_key1': 1}},
+                    {}):
+            self.assertRaises(ValueError, query.update, **bad)
+        self.assertRaises(ValueError, query.limit(1).update,
+                          set={'test_key_3': 'limited'})
+        compiled = _compile_update(TempCollection, {'set': {
+            'sub_collection_list.$[].x_item1': 1,
+            'list_collection.0': 1, 'lazy_collection.any.path': 1}})
+        self.assertEqual(len(compiled['$set']), 4)
+
+        update_data = {'test_key_3': 'mass'}
+        MSession.update(TempCollection, {'test_key_1': 'many'}, update_data,
+                        multi=True)
+        self.assertEqual(update_data, {'test_key_3': 'mass'})
+
+    def test_query_update_typed(self):
+        MSession.drop_all(TypedCollection)
+        self.addCleanup(MSession.drop_all, TypedCollection)
+        MSession.add(TypedCollection(number=1, title='typed'))
+        query = MSession.query(TypedCollection).filter(title='typed')
+        query.update(inc={TypedCollection.number: 2},
+                     set={TypedCollection.price: '1.50',
+                          'sub.count': 4},
+                     current_date=[TypedCollection.stamp])
+        typed = query.find_one({})
+        self.assertEqual(typed.number, 3)
+        self.assertEqual(typed.price, decimal.Decimal('1.50'))
+        self.assertEqual(typed.sub.count, 4)
+        self.assertIsInstance(typed.stamp, datetime.datetime)
+        self.assertRaises(ValidationException, query.update,
+                          set={TypedCollection.number: 'three'})
+        self.assertRaises(ValueError, query.update,
+                          inc={TypedCollection.title: 1})
+        self.assertRaises(ValueError, query.update,
+                          set={'number.digits': 1})
+        self.assertRaises(ValueError, query.update,
+                          current_date=[TypedCollection.number])
+
+    def test_ensure_indexes(self):
+        MSession.connection['charlie'].drop_collection('indexed')
+        self.addCleanup(MSession.connection['charlie'].drop_collection,
+                        'indexed')
+        names = MSession.ensure_indexes(IndexedCollection)
+        self.assertEqual(names, MSession.ensure_indexes(IndexedCollection))
+        collection = MSession.connection['charlie']['indexed']
+        information = collection.index_information()
+        self.assertTrue(set(names).issubset(information))
+        self.assertEqual(information['token_partial']['key'],
+                         [('token', ASCENDING)])
+        self.assertEqual(MSession.ensure_indexes(TypedCollection), [])
+
+        MSession.add(IndexedCollection(code='a', email='a@example.com'))
+        self.assertRaises(DuplicateKeyError, MSession.add,
+                          IndexedCollection(code='b', email='a@example.com'))
+        MSession.add(IndexedCollection(code='b', email='b@example.com'))
+        self.assertRaises(DuplicateKeyError, MSession.update,
+                          IndexedCollection, {'code': 'b'}, {'code': 'a'})
+        self.assertEqual(MSession.query(IndexedCollection).count(
+            {'code': 'b'}), 1)
+
+        collection.drop_index('expires_1')
+        collection.create_index('expires', expireAfterSeconds=60)
+        self.assertRaises(OperationFailure, MSession.ensure_indexes,
+                          IndexedCollection)
+
+    def test_check_plan(self):
+        MSession.connection['charlie'].drop_collection('indexed')
+        self.addCleanup(MSession.connection['charlie'].drop_collection,
+                        'indexed')
+        MSession.ensure_indexes(IndexedCollection)
+        MSession.add(IndexedCollection(code='a', email='a@example.com',
+                                       owner='o'))
+        query = MSession.query(IndexedCollection).check_plan('raise')
+        self.assertEqual(query.find_one({'code': 'a'}).email,
+                         'a@example.com')
+        self.assertEqual(len(list(query.filter({'owner': 'o'}))), 1)
+        self.assertEqual(len(list(query.sort('score'))), 1)
+        self.assertEqual(len(list(query)), 1)
+        self.assertRaises(CollectionScanException, query.find_one,
+                          {'started': 1})
+        self.assertRaises(CollectionScanException, query.find_one,
+                          {'started': 1})
+        self.assertRaises(CollectionScanException, list,
+                          query.filter({'started': {'$gt': 1}}))
+        self.assertEqual(list(query.filter({'token': 't'})), [])
+        self.assertRaises(ValueError, query.check_plan, 'log')
+
+        session = MongoSession(client, plan_check='warn')
+        query = session.query(IndexedCollection)
+        self.assertEqual(query.explain()['queryPlanner']['winningPlan'][
+            'stage'], 'COLLSCAN')
+        self.assertWarns(CollectionScanWarning, query.find_one,
+                         {'started': 1})
+        self.assertEqual(session._checked_plans, set([
+            ('charlie', 'indexed', (('started', None),), ())]))
+        query.find_one({'started': 2})
+        self.assertIsNone(query.check_plan(None).find_one({'owner': 'x'}))
+
+    def test_collection_handles(self):
+        session = MongoSession(client)
+        self.addCleanup(session.drop_all, ConcernCollection)
+        query = session.query(ConcernCollection)
+        session.drop_all(ConcernCollection)
+        self.assertEqual(ConcernCollection.built, 0)
+        collection = session._get_collection_from_object(ConcernCollection)
+        self.assertIs(query.collection, collection)
+        self.assertIs(session.query(ConcernCollection).collection, collection)
+        self.assertIs(session._get_handles(ConcernCollection)[0],
+                      query.database)
+
+        stamp = datetime.datetime(2020, 1, 1)
+        doc = ConcernCollection(stamp=stamp)
+        session.add(doc)
+        loaded = query.find_one({'_id': doc._id})
+        self.assertIs(loaded.collection, collection)
+        self.assertIsNotNone(loaded.stamp.tzinfo)
+        self.assertEqual(loaded.stamp.replace(tzinfo=None), stamp)
+
+        remote = MongoSession(MongoDBConnection(connect=False, shared=False))
+        self.addCleanup(remote.client.close)
+        collection = remote.query(ConcernCollection).collection
+        self.assertEqual(collection.write_concern, WriteConcern(w=1, j=True))
+        self.assertEqual(collection.read_concern.level, 'local')
+        self.assertTrue(collection.codec_options.tz_aware)
+        self.assertIs(remote.query(TempCollection).collection.codec_options,
+                      remote.connection['charlie'].codec_options)
+
     def tearDown(self):
         tc = TempCollection.get_by_oid(self.oid)
         tc.remove()
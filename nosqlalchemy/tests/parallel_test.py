@@ -0,0 +1,67 @@
+import operator
+import os
+import unittest
+
+from nosqlalchemy import MemoryDBConnection, MongoDBConnection, MongoSession
+from nosqlalchemy.parallel import split_ranges
+from nosqlalchemy.tests.nosqlalchemy_test import BACKEND, TempCollection
+
+
+def update_key(doc):
+    return doc.update_key1
+
+
+def checked_pid(doc):
+    assert isinstance(doc, TempCollection)
+    return os.getpid()
+
+
+class TestParallelScan(unittest.TestCase):
+    size = 1000
+
+    def setUp(self):
+        if BACKEND == 'mongodb':
+            client = MongoDBConnection()
+        else:
+            client = MemoryDBConnection()
+        self.session = MongoSession(client)
+        self.session.drop_all(TempCollection)
+        self.session.add_all(TempCollection(test_key_1='scan', update_key1=i)
+                             for i in range(self.size))
+        self.query = self.session.query(TempCollection)
+
+    def tearDown(self):
+        self.session.drop_all(TempCollection)
+
+    def test_split_ranges(self):
+        ranges = split_ranges(self.query, 7)
+        self.assertEqual(len(ranges), 7)
+        self.assertEqual(ranges[0][0], None)
+        self.assertEqual(ranges[-1][1], None)
+        for (_, upper), (lower, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(upper, lower)
+        self.assertEqual(split_ranges(self.query.filter({'_id': None}), 4),
+                         [(None, None)])
+
+    def test_parallel_scan(self):
+        results = list(self.query.parallel_scan(update_key, workers=3,
+                                                start_method='fork'))
+        self.assertEqual(results, list(range(self.size)))
+
+        query = self.query.filter({'update_key1': {'$lt': 100}})
+        total = query.parallel_scan(update_key, workers=3,
+                                    reduce=operator.add, start_method='fork')
+        self.assertEqual(total, sum(range(100)))
+
+        pids = set(self.query.parallel_scan(checked_pid, workers=2,
+                                            start_method='fork'))
+        self.assertTrue(0 < len(pids) <= 2)
+        self.assertFalse(os.getpid() in pids)
+
+        local = self.query.lazy().parallel_scan(lambda doc: doc.update_key1,
+                                                workers=1, ranges=5)
+        self.assertEqual(list(local), list(range(self.size)))
+        self.assertIsNone(self.query.filter({'_id': None}).parallel_scan(
+            update_key, workers=2, reduce=operator.add))
+        self.assertRaises(ValueError, self.query.limit(1).parallel_scan,
+                          update_key)
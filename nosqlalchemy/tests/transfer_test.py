@@ -0,0 +1,112 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from nosqlalchemy import (
+    BulkWriteException,
+    MemoryDBConnection,
+    MongoDBConnection,
+    MongoSession,
+    ValidationException
+)
+from nosqlalchemy.transfer import read_documents
+from nosqlalchemy.tests.nosqlalchemy_test import (
+    BACKEND,
+    TempCollection,
+    TypedCollection
+)
+
+
+class TestTransfer(unittest.TestCase):
+    size = 250
+
+    def setUp(self):
+        if BACKEND == 'mongodb':
+            client = MongoDBConnection()
+        else:
+            client = MemoryDBConnection()
+        self.session = MongoSession(client)
+        self.session.drop_all(TempCollection)
+        self.session.add_all(
+            TempCollection(test_key_1='doc', update_key1=i,
+                           sub_collection={'subkey1': i},
+                           sub_collection_list=[{'x_item1': i}])
+            for i in range(self.size))
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.addCleanup(self.session.drop_all, TempCollection)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def stored(self):
+        return [dict(doc) for doc in
+                self.session.query(TempCollection).sort('_id')]
+
+    def test_round_trip(self):
+        stored = self.stored()
+        for name in ['c.bson', 'c.bson.gz', 'c.ndjson.bz2', 'c.jsonl.xz']:
+            file_format = 'ndjson' if 'json' in name else 'bson'
+            checkpoints = list()
+            result = self.session.export(TempCollection, self.path(name),
+                                         format=file_format, batch_size=100,
+                                         checkpoint=checkpoints.append)
+            self.assertEqual(result, (self.size, stored[-1]['_id']))
+            self.assertEqual([c.count for c in checkpoints], [100, 200, 250])
+
+            self.session.drop_all(TempCollection)
+            checkpoints = list()
+            result = self.session.import_(TempCollection, self.path(name),
+                                          batch_size=60, window=3,
+                                          checkpoint=checkpoints.append)
+            self.assertEqual(result.count, self.size)
+            self.assertEqual([c.count for c in checkpoints],
+                             [60, 120, 180, 240, 250])
+            self.assertEqual(self.stored(), stored)
+
+    def test_resume(self):
+        stored = self.stored()
+        checkpoint = stored[99]['_id']
+        self.session.export(TempCollection, self.path('head.bson'),
+                            spec={'update_key1': {'$lt': 100}})
+        result = self.session.export(TempCollection, self.path('tail.ndjson'),
+                                     format='ndjson', after=checkpoint)
+        self.assertEqual(result.count, self.size - 100)
+        self.assertEqual(
+            next(read_documents(self.path('tail.ndjson')))['_id'],
+            stored[100]['_id'])
+
+        self.session.drop_all(TempCollection)
+        self.session.import_(TempCollection, self.path('head.bson'))
+        self.session.import_(TempCollection, self.path('tail.ndjson'))
+        self.assertEqual(self.stored(), stored)
+
+        self.session.export(TempCollection, self.path('all.bson'))
+        with self.assertRaises(BulkWriteException) as error:
+            self.session.import_(TempCollection, self.path('all.bson'),
+                                 batch_size=50, window=1)
+        self.assertEqual(len(error.exception.result.errors), 1)
+        result = self.session.import_(TempCollection, self.path('all.bson'),
+                                      after=checkpoint, replace=True)
+        self.assertEqual(result.count, self.size - 100)
+        self.assertEqual(self.stored(), stored)
+        self.assertRaises(ValueError, self.session.import_, TempCollection,
+                          self.path('tail.ndjson'), after=checkpoint)
+
+    def test_validate(self):
+        self.session.export(TempCollection, self.path('c.bson'))
+        self.assertRaises(ValidationException, self.session.import_,
+                          TypedCollection, self.path('c.bson'),
+                          validate=True)
+        with open(self.path('typed.ndjson'), 'w') as fp:
+            fp.write('{"number": "1", "ratio": 2}\n\n{"number": "x"}\n')
+        self.session.drop_all(TypedCollection)
+        self.addCleanup(self.session.drop_all, TypedCollection)
+        self.assertRaises(ValidationException, self.session.import_,
+                          TypedCollection, self.path('typed.ndjson'),
+                          validate=True, batch_size=1)
+        typed = list(self.session.query(TypedCollection))
+        self.assertEqual([(t.number, t.ratio) for t in typed], [(1, 2.0)])
+        self.assertRaises(ValueError, self.session.export, TempCollection,
+                          self.path('c.csv'), format='csv')
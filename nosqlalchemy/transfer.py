@@ -0,0 +1,241 @@
+"""
+Streaming export and import of collections.
+
+session.export(User, 'users.bson.gz')
+session.import_(User, 'users.bson.gz', batch_size=1000)
+
+Exports read the collection in _id order as raw BSON, documents are not
+hydrated. bson files are BSON documents one after the other, the format of
+mongodump, ndjson files hold one relaxed MongoDB Extended JSON document per
+line, the format of mongoexport. Paths ending in .gz, .bz2 or .xz are
+compressed.
+
+Documents are streamed, memory does not grow with the size of the
+collection. Imports read the next batch while up to window bulk inserts
+are in flight.
+
+Both report their progress as TransferResult(count, last_id) to checkpoint
+after every batch, last_id being the _id of the last document written.
+To resume an interrupted export, export after the last checkpoint to a new
+file; to resume an import, import after it, or with replace, which makes
+importing the same documents again harmless.
+"""
+import bz2
+import gzip
+import lzma
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import bson
+from bson import json_util
+from pymongo import InsertOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from nosqlalchemy.nosql import (
+    BulkResult,
+    BulkWriteException,
+    ValidationException,
+)
+
+
+__all__ = [
+    'TransferResult',
+    'export',
+    'import_',
+    'read_documents'
+]
+
+
+TransferResult = namedtuple('TransferResult', 'count last_id')
+
+_OPENERS = {
+    None: open,
+    'gzip': gzip.open,
+    'bz2': bz2.open,
+    'xz': lzma.open,
+}
+
+_SUFFIXES = [('.gz', 'gzip'), ('.bz2', 'bz2'), ('.xz', 'xz')]
+
+_JSON_SUFFIXES = ('.ndjson', '.jsonl', '.json')
+
+
+def _compression(path, compression):
+    if compression == 'infer':
+        for suffix, name in _SUFFIXES:
+            if path.endswith(suffix):
+                return name
+        return None
+    if compression not in _OPENERS:
+        raise ValueError('compression is one of infer, %s' % ', '.join(
+            str(name) for name in _OPENERS))
+    return compression
+
+
+def _format(path, file_format):
+    if file_format is None:
+        for suffix, _ in _SUFFIXES:
+            if path.endswith(suffix):
+                path = path[:-len(suffix)]
+        return 'ndjson' if path.endswith(_JSON_SUFFIXES) else 'bson'
+    if file_format not in ('bson', 'ndjson'):
+        raise ValueError('format is bson or ndjson')
+    return file_format
+
+
+def _open(path, mode, compression):
+    return _OPENERS[_compression(path, compression)](path, mode)
+
+
+def export(session, collection_cls, path, format='bson', compression='infer',
+           spec=None, after=None, batch_size=1000, checkpoint=None):
+    """
+    Write the documents of collection_cls matching spec to path, in _id
+    order, after the _id after when it is given. Returns a TransferResult.
+    """
+    file_format = _format(path, format)
+    query = session.query(collection_cls).filter(spec).sort('_id')
+    if after is not None:
+        query = query.after(after)
+    query = query.batch_size(batch_size)
+    codec_options = query.collection.codec_options
+    count = 0
+    last_id = None
+    with _open(path, 'wb', compression) as fp:
+        for raw in query.cursor(raw=True):
+            if file_format == 'bson':
+                fp.write(raw.raw)
+            else:
+                fp.write(json_util.dumps(
+                    bson.decode(raw.raw, codec_options),
+                    json_options=json_util.RELAXED_JSON_OPTIONS
+                ).encode('utf-8') + b'\n')
+            count += 1
+            last_id = raw['_id']
+            if checkpoint is not None and count % batch_size == 0:
+                fp.flush()
+                checkpoint(TransferResult(count, last_id))
+    result = TransferResult(count, last_id)
+    if checkpoint is not None and count % batch_size:
+        checkpoint(result)
+    return result
+
+
+def read_documents(path, format=None, compression='infer'):
+    """
+    generator of the documents of an exported file, as dicts.
+    """
+    file_format = _format(path, format)
+    with _open(path, 'rb', compression) as fp:
+        if file_format == 'bson':
+            for document in bson.decode_file_iter(fp):
+                yield document
+        else:
+            for line in fp:
+                if line.strip():
+                    yield json_util.loads(line)
+
+
+def _skip_through(documents, after):
+    documents = iter(documents)
+    for document in documents:
+        if document.get('_id') == after:
+            return documents
+    raise ValueError('the checkpoint %r is not in the file' % (after,))
+
+
+def _validated(collection_cls, document):
+    unknown = set(document).difference(collection_cls.__schema__.keys)
+    if unknown:
+        raise ValidationException('%s has no keys %s' % (
+            collection_cls.__name__, ', '.join(sorted(unknown))))
+    return collection_cls(**document)
+
+
+def _batches(documents, batch_size):
+    batch = list()
+    for document in documents:
+        batch.append(document)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = list()
+    if batch:
+        yield batch
+
+
+def import_(session, collection_cls, path, format=None, compression='infer',
+            batch_size=1000, window=2, validate=False, replace=False,
+            after=None, checkpoint=None):
+    """
+    Insert the documents of an exported file, in bulk writes of batch_size
+    documents, with up to window of them in flight. format is inferred
+    from the path when it is not given.
+
+    With validate, documents are built as collection_cls, which checks
+    their typed keys, and keys which the class does not declare raise
+    ValidationException. With replace, documents which exist are
+    replaced rather than reported as duplicates. With after, the documents
+    up to and including the one with that _id are skipped, ValueError is
+    raised when the file has no such document.
+
+    Returns a TransferResult, checkpoint is called with one after each
+    batch. Failed writes raise BulkWriteException once the writes in
+    flight are done, checkpoints stop at the last batch written in full.
+    """
+    documents = read_documents(path, format, compression)
+    if after is not None:
+        documents = _skip_through(documents, after)
+    if validate:
+        documents = (_validated(collection_cls, document)
+                     for document in documents)
+    collection = session._get_collection_from_object(collection_cls)
+
+    def write(batch):
+        requests = list()
+        for document in batch:
+            if replace and '_id' in document:
+                requests.append(ReplaceOne({'_id': document['_id']},
+                                           document, upsert=True))
+            else:
+                requests.append(InsertOne(document))
+        return collection.bulk_write(requests, ordered=True)
+
+    result = BulkResult()
+    count = 0
+    last_id = None
+
+    def finish(future, batch):
+        nonlocal count, last_id
+        try:
+            result._add_bulk_result(future.result())
+        except BulkWriteError as e:
+            details = e.details
+            result._add_counts(details['nInserted'], details['nMatched'],
+                               details['nModified'], details['nRemoved'],
+                               details['nUpserted'])
+            for error in details['writeErrors']:
+                result.errors.append((batch[error['index']], error))
+            return
+        if not result.errors:
+            count += len(batch)
+            last_id = batch[-1].get('_id')
+            if checkpoint is not None:
+                checkpoint(TransferResult(count, last_id))
+
+    window = max(1, window)
+    in_flight = deque()
+    try:
+        with ThreadPoolExecutor(window) as executor:
+            for batch in _batches(documents, batch_size):
+                while len(in_flight) >= window:
+                    finish(*in_flight.popleft())
+                if result.errors:
+                    break
+                in_flight.append((executor.submit(write, batch), batch))
+            while in_flight:
+                finish(*in_flight.popleft())
+    finally:
+        session._invalidate_collection(collection_cls)
+    if result.errors:
+        raise BulkWriteException(result)
+    return TransferResult(count, last_id)
@@ -7,7 +7,7 @@ README = open(os.path.join(here, 'README')).read()
 CHANGES = open(os.path.join(here, 'CHANGES')).read()
 
 requires = [
-    'pymongo'
+    'pymongo>=3.0'
 ]
 
 setup(name='nosqlalchemy',
@@ -25,6 +25,9 @@ setup(name='nosqlalchemy',
       zip_safe=False,
       test_suite='nosqlalchemy.tests',
       install_requires=requires,
+      extras_require={
+          'numpy': ['numpy'],
+      },
       entry_points="""
       """,
       )